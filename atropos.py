@@ -18,6 +18,11 @@ class Atropos(discord.Client):
     
     print('Atropos initialized.')
 
+  async def close(self):
+    # Write out what the interpreter keeps in memory before disconnecting.
+    commands.Command.builder.dicelang.close()
+    await super().close()
+
   async def on_ready(self):
     a = discord.Activity(
       type=discord.ActivityType.listening,
@@ -0,0 +1,189 @@
+import ast
+import base64
+import marshal
+from django.db import migrations
+
+
+# The codec as it was when these migrations were written, so that later
+# changes to dicelang.codec do not change what they do. 0005 uses it too.
+# Binary values are written in version 2 of the format, which every later
+# version of the codec reads.
+MAGIC = b'DL'
+VERSION = 2
+TEXT_PREFIX = '#dl:'
+PLAIN = b'p'
+STRUCTURED = b's'
+TUPLE, UNDEFINED, FUNCTION, ALIAS, TREE, TOKEN, RANGE = 'tufarkg'
+
+
+def classes():
+    from lark import Tree, Token
+    from dicelang.alias import Alias
+    from dicelang.function import Function
+    from dicelang.ranges import Range
+    from dicelang.undefined import Undefined
+    return Tree, Token, Alias, Function, Range, Undefined
+
+
+def encode(value):
+    header = MAGIC + bytes([VERSION])
+    try:
+        return header + PLAIN + marshal.dumps(value, 4)
+    except ValueError:
+        return header + STRUCTURED + marshal.dumps(flatten(value), 4)
+
+
+def decode(data):
+    if data[:2] != MAGIC or data[2] not in (1, 2):
+        raise ValueError('Stored value is not in format version 1 or 2.')
+    out = marshal.loads(data[4:])
+    return unflatten(out) if data[3:4] == STRUCTURED else out
+
+
+def dumps(value):
+    return TEXT_PREFIX + base64.b64encode(encode(value)).decode('ascii')
+
+
+def loads(text):
+    if text.startswith(TEXT_PREFIX):
+        return decode(base64.b64decode(text[len(TEXT_PREFIX):]))
+    return legacy_loads(text)
+
+
+def legacy_dumps(value):
+    Function = classes()[3]
+    with Function.SerializableRepr():
+        return repr(value)
+
+
+def legacy_loads(text):
+    """Read a value stored as its repr without running any code."""
+    return legacy_value(ast.parse(text.strip(), mode='eval').body)
+
+
+def legacy_value(node):
+    Tree, Token, Alias, Function, Range, Undefined = classes()
+    names = {'Undefined': Undefined, 'inf': float('inf'), 'nan': float('nan')}
+    calls = {'Function': Function, 'Alias': Alias}
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.List):
+        return [legacy_value(x) for x in node.elts]
+    if isinstance(node, ast.Tuple):
+        return tuple(legacy_value(x) for x in node.elts)
+    if isinstance(node, ast.Dict) and None not in node.keys:
+        return {legacy_value(k): legacy_value(v)
+                for k, v in zip(node.keys, node.values)}
+    if isinstance(node, ast.Name) and node.id in names:
+        return names[node.id]
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return -legacy_number(node.operand)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub)):
+        left, right = legacy_number(node.left), legacy_number(node.right)
+        return left + right if isinstance(node.op, ast.Add) else left - right
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+            and node.func.id in calls and all(k.arg for k in node.keywords)):
+        args = [legacy_value(x) for x in node.args]
+        kwargs = {k.arg: legacy_value(k.value) for k in node.keywords}
+        return calls[node.func.id](*args, **kwargs)
+    raise ValueError(f'Cannot load `{ast.unparse(node)}` from a repr.')
+
+
+def legacy_number(node):
+    out = legacy_value(node)
+    if isinstance(out, bool) or not isinstance(out, (int, float, complex)):
+        raise ValueError('Only numbers can be negated or added in a repr.')
+    return out
+
+
+def flatten(value):
+    Tree, Token, Alias, Function, Range, Undefined = classes()
+    if isinstance(value, (bool, int, float, complex, str)) or value is None:
+        return value
+    if isinstance(value, list):
+        return [flatten(x) for x in value]
+    if isinstance(value, dict):
+        return {flatten(k): flatten(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return (TUPLE,) + tuple(flatten(x) for x in value)
+    if value is Undefined:
+        return (UNDEFINED,)
+    if isinstance(value, Function):
+        code = flatten_tree(value.code)
+        return (FUNCTION, tuple(value.params), code, flatten(value.closed))
+    if isinstance(value, Alias):
+        return (ALIAS, flatten(value.aliased))
+    if isinstance(value, Range):
+        return (RANGE, value.start, value.step, value.size)
+    raise ValueError(f'Cannot store a {value.__class__.__name__}.')
+
+
+def flatten_tree(tree):
+    Tree = classes()[0]
+    if isinstance(tree, Tree):
+        children = tuple(flatten_tree(c) for c in tree.children)
+        return (TREE, tree.data) + children
+    return (TOKEN, tree.type, tree.value)
+
+
+def unflatten(data):
+    Tree, Token, Alias, Function, Range, Undefined = classes()
+    if isinstance(data, list):
+        return [unflatten(x) for x in data]
+    if isinstance(data, dict):
+        return {unflatten(k): unflatten(v) for k, v in data.items()}
+    if not isinstance(data, tuple):
+        return data
+    if data[0] == TUPLE:
+        return tuple(unflatten(x) for x in data[1:])
+    if data[0] == UNDEFINED:
+        return Undefined
+    if data[0] == FUNCTION:
+        _, params, code, closed = data
+        return Function(unflatten_tree(code), param_names=list(params),
+                        closed_vars=unflatten(closed))
+    if data[0] == ALIAS:
+        return Alias(unflatten(data[1]))
+    if data[0] == RANGE:
+        return Range(*data[1:])
+    raise ValueError(f'Unknown tag in stored value: {data[0]!r}.')
+
+
+def unflatten_tree(data):
+    Tree, Token = classes()[:2]
+    if data[0] == TREE:
+        return Tree(data[1], [unflatten_tree(c) for c in data[2:]])
+    return Token(data[1], data[2])
+
+
+def encode_values(apps, schema_editor):
+    '''Rewrite values stored as Python expressions in the binary format.'''
+    Variable = apps.get_model('atropos_db', 'Variable')
+    for variable in Variable.objects.iterator():
+        if variable.value_string.startswith(TEXT_PREFIX):
+            continue
+        value = legacy_loads(variable.value_string)
+        variable.value_string = dumps(value)
+        variable.save(update_fields=['value_string'])
+
+
+def decode_values(apps, schema_editor):
+    '''Rewrite values stored in the binary format as Python expressions.'''
+    Variable = apps.get_model('atropos_db', 'Variable')
+    for variable in Variable.objects.iterator():
+        if not variable.value_string.startswith(TEXT_PREFIX):
+            continue
+        value = loads(variable.value_string)
+        variable.value_string = legacy_dumps(value)
+        variable.save(update_fields=['value_string'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('atropos_db', '0003_auto_20200424_2258'),
+    ]
+
+    operations = [
+        migrations.RunPython(encode_values, decode_values),
+    ]
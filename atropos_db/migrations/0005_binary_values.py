@@ -0,0 +1,63 @@
+import importlib
+from django.db import migrations, models
+
+# The codec frozen in 0004, as it was when this migration was written.
+codec = importlib.import_module(
+    'atropos_db.migrations.0004_encode_value_strings')
+
+
+def encode_values(apps, schema_editor):
+    '''Move every value from its text column to the binary column.'''
+    Variable = apps.get_model('atropos_db', 'Variable')
+    for variable in Variable.objects.iterator():
+        value = codec.loads(variable.value_string)
+        variable.value = codec.encode(value)
+        variable.size = len(variable.value)
+        variable.save(update_fields=['value', 'size'])
+
+
+def decode_values(apps, schema_editor):
+    '''Move every value from its binary column back to the text column.'''
+    Variable = apps.get_model('atropos_db', 'Variable')
+    for variable in Variable.objects.iterator():
+        value = codec.decode(bytes(variable.value))
+        variable.value_string = codec.dumps(value)
+        variable.save(update_fields=['value_string'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('atropos_db', '0004_encode_value_strings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='variable',
+            name='value',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='variable',
+            name='size',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(encode_values, decode_values),
+        # Lets the column be added back to existing rows when reversing.
+        migrations.AlterField(
+            model_name='variable',
+            name='value_string',
+            field=models.TextField(default=''),
+        ),
+        migrations.RemoveField(
+            model_name='variable',
+            name='value_string',
+        ),
+        migrations.AddIndex(
+            model_name='variable',
+            index=models.Index(
+                fields=['var_type', 'owner_id'],
+                name='variable_type_owner'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+import importlib
+import marshal
+from django.db import migrations
+
+# The codec frozen in 0004 wrote version 2 of the format. Version 3 adds the
+# version of marshal a value was written in after the format's own.
+codec = importlib.import_module(
+    'atropos_db.migrations.0004_encode_value_strings')
+VERSION = 3
+MARSHAL_VERSION = 4
+
+
+def encode(value):
+    header = codec.MAGIC + bytes([VERSION, MARSHAL_VERSION])
+    try:
+        return header + codec.PLAIN + marshal.dumps(value, MARSHAL_VERSION)
+    except ValueError:
+        flat = codec.flatten(value)
+        return header + codec.STRUCTURED + marshal.dumps(flat, MARSHAL_VERSION)
+
+
+def decode(data):
+    if data[:2] != codec.MAGIC or data[2] > VERSION:
+        raise ValueError('Stored value is not in format version 1 to 3.')
+    if data[2] < VERSION:
+        return codec.decode(data)
+    out = marshal.loads(data[5:])
+    return codec.unflatten(out) if data[4:5] == codec.STRUCTURED else out
+
+
+def rewrite(apps, write):
+    Variable = apps.get_model('atropos_db', 'Variable')
+    for variable in Variable.objects.iterator():
+        variable.value = write(decode(bytes(variable.value)))
+        variable.size = len(variable.value)
+        variable.save(update_fields=['value', 'size'])
+
+
+def encode_values(apps, schema_editor):
+    '''Rewrite every value in version 3 of the format.'''
+    rewrite(apps, encode)
+
+
+def decode_values(apps, schema_editor):
+    '''Rewrite every value in version 2 of the format, as 0005 expects.'''
+    rewrite(apps, codec.encode)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('atropos_db', '0005_binary_values'),
+    ]
+
+    operations = [
+        migrations.RunPython(encode_values, decode_values),
+    ]
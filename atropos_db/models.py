@@ -1,4 +1,5 @@
-from django.db.models import CharField, IntegerField, TextField
+from django.db.models import BinaryField, CharField, IntegerField
+from django.db.models import PositiveIntegerField
 from django.db import models
 
 
@@ -17,9 +18,16 @@ class Variable(models.Model):
     ]
     var_type = CharField(max_length=7, choices=VARIABLE_TYPES, default=SERVER)
 
-    value_string = TextField()
+    # The value as encoded by dicelang.codec, and its length in bytes.
+    value = BinaryField()
+    size = PositiveIntegerField(default=0)
     name = CharField(max_length=2000)
 
     class Meta:
         unique_together = [['name', 'owner_id', 'var_type']]
+        indexes = [
+            models.Index(
+                fields=['var_type', 'owner_id'],
+                name='variable_type_owner'),
+        ]
 
@@ -77,6 +77,12 @@ class Builder(object):
     self.dicelang = dicelang_interpreter
     self.helptable = helptext_engine
   
+  async def in_worker(self, method, *args):
+    '''Build a reply on one of the interpreter's worker threads, so that
+    evaluating a command or querying the database never blocks the event
+    loop.'''
+    return await self.dicelang.call_async(method, *args)
+  
   def get_server_id(self, msg):
     is_dm = isinstance(msg.channel, (discord.GroupChannel, discord.DMChannel))
     return msg.channel.id if is_dm else msg.channel.guild.id
@@ -142,14 +148,14 @@ class Builder(object):
       act = 'Interpreter Error'
       traceback.print_tb(e.__traceback__)
     except DicelangError as e:
-      act = self.dicelang.get_print_queue_on_error(msg.author.id)
+      act = self.dicelang.get_print_queue_on_error(e)
       classname = e.__class__.__name__
       try:
         res = f'{classname}: {e.msg}'
       except AttributeError:
         res = f'{classname}: {e.args[0]!s}'
     except Exception as e:
-      act = self.dicelang.get_print_queue_on_error(msg.author.id)
+      act = self.dicelang.get_print_queue_on_error(e)
       res = f'{e.__class__.__name__}: {e!s}'
       traceback.print_tb(e.__traceback__)
     else:
@@ -320,7 +326,8 @@ class Command(object):
     '''Construct a reply for the type of command we are.'''
     username = self.originator.author.display_name
     if self.type == CommandType.roll_code:
-      self.stashed = Command.builder.dice_reply(
+      self.stashed = await Command.builder.in_worker(
+        Command.builder.dice_reply,
         self.kwargs['value'],
         self.originator)
       
@@ -329,7 +336,8 @@ class Command(object):
       reply = self.pack_content(header, **self.stashed)
     
     elif self.type == CommandType.roll_lit:
-      self.stashed = Command.builder.dice_reply(
+      self.stashed = await Command.builder.in_worker(
+        Command.builder.dice_reply,
         self.kwargs['value'],
         self.originator)
       
@@ -342,7 +350,10 @@ class Command(object):
       reply = {'content' : 'See `+atropos help quickstart` for more info.'}
     
     elif self.type in CommandType.views:
-      self.stashed = Command.builder.view_reply(self.type, self.originator)
+      self.stashed = await Command.builder.in_worker(
+        Command.builder.view_reply,
+        self.type,
+        self.originator)
       noun = 'help' if self.stashed['help'] else 'view'
       title = f'Database {noun} for {username}'
       desc = f'```{self.originator.content}```'
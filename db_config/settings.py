@@ -78,6 +78,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Seconds to wait for other processes writing to the database.
+        'OPTIONS': {'timeout': 20},
     }
 }
 
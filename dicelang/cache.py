@@ -0,0 +1,121 @@
+import sys
+import threading
+from collections import OrderedDict
+from lark import Tree
+from dicelang.alias import Alias
+from dicelang.function import Function
+
+def size_of(value):
+  '''Rough number of bytes held by a variable's value, counting its
+  contents but not objects shared with other values, like interned
+  strings. Classes, like the markers the datastore caches for missing
+  variables, are shared and so count for nothing.'''
+  if isinstance(value, type):
+    return 0
+  out = sys.getsizeof(value)
+  if isinstance(value, (list, tuple)):
+    out += sum(size_of(x) for x in value)
+  elif isinstance(value, dict):
+    out += sum(size_of(k) + size_of(v) for k, v in value.items())
+  elif isinstance(value, Function):
+    out += size_of(value.code) + size_of(value.closed)
+  elif isinstance(value, Alias):
+    out += size_of(value.aliased)
+  elif isinstance(value, Tree):
+    out += sys.getsizeof(value.children)
+    out += sum(size_of(child) for child in value.children)
+  return out
+
+class LruCache(object):
+  '''Cache of variables that evicts the least recently used ones once it
+  holds more than `max_entries` of them or more than `max_bytes` as
+  measured by `size_of`. Variables of the modes in `pinned` are never
+  evicted and don't count against either limit, because `core` variables
+  are usually large, often-used, and well-curated, which makes them good
+  candidates for remaining loaded.
+
+  Every method may be called from any thread. A different cache may be
+  given to a DataStore as long as it has the same methods.'''
+  def __init__(self, max_entries=4096, max_bytes=64 * 2**20,
+      pinned=('core',)):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.pinned_modes = frozenset(pinned)
+    self.entries = OrderedDict()
+    self.pinned = { }
+    self.bytes = 0
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.entries) + len(self.pinned)
+
+  def get(self, owner_id, key, mode, default=None):
+    '''The cached value of a variable, or `default` if it isn't cached.'''
+    name = (mode, owner_id, key)
+    with self.lock:
+      if name in self.pinned:
+        out = self.pinned[name]
+      elif name in self.entries:
+        self.entries.move_to_end(name)
+        out, _ = self.entries[name]
+      else:
+        self.misses += 1
+        return default
+      self.hits += 1
+    return out
+
+  def put(self, owner_id, key, value, mode):
+    name = (mode, owner_id, key)
+    if mode in self.pinned_modes:
+      with self.lock:
+        self.pinned[name] = value
+      return value
+
+    size = size_of(value)
+    with self.lock:
+      self._remove(name)
+      self.entries[name] = (value, size)
+      self.bytes += size
+      while self.entries and (len(self.entries) > self.max_entries
+          or self.bytes > self.max_bytes):
+        oldest = next(iter(self.entries))
+        self._remove(oldest)
+        self.evictions += 1
+    return value
+
+  def drop(self, owner_id, key, mode):
+    '''Forget a variable, giving back its cached value or None.'''
+    name = (mode, owner_id, key)
+    with self.lock:
+      if name in self.pinned:
+        return self.pinned.pop(name)
+      return self._remove(name)
+
+  def _remove(self, name):
+    '''Take an unpinned entry out of the cache. The lock must be held.'''
+    if name not in self.entries:
+      return None
+    value, size = self.entries.pop(name)
+    self.bytes -= size
+    return value
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.pinned.clear()
+      self.bytes = 0
+
+  def stats(self):
+    with self.lock:
+      out = {
+        'hits'      : self.hits,
+        'misses'    : self.misses,
+        'evictions' : self.evictions,
+        'entries'   : len(self.entries),
+        'pinned'    : len(self.pinned),
+        'bytes'     : self.bytes,
+      }
+    return out
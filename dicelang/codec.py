@@ -0,0 +1,223 @@
+import ast
+import base64
+import marshal
+from lark import Tree
+from lark import Token
+
+from dicelang.alias import Alias
+from dicelang.function import Function
+from dicelang.ranges import Range
+from dicelang.undefined import Undefined
+from dicelang.float_special import inf
+from dicelang.float_special import nan
+from dicelang.exceptions import StorageError
+
+# Encoded values start with MAGIC and the version of the format they were
+# written in. Bump VERSION whenever the layout below changes, and keep a
+# decoder for every version that may still be stored somewhere.
+MAGIC = b'DL'
+VERSION = 3
+
+# From version 3, the version of marshal's own format comes next. Values
+# are always written in the same one, whichever Python writes them, and
+# those written in one newer than this Python reads are refused. Versions 1
+# and 2 were always written in marshal's version 4.
+MARSHAL_VERSION = 4
+
+# Marks values encoded for a text column. A Python expression, which is how
+# values were stored before this format existed, can never start with it.
+TEXT_PREFIX = '#dl:'
+
+# After the version comes the kind of encoding. Plain values, made only of
+# Python builtins, are marshalled directly. Values holding any dicelang
+# objects are flattened into a tagged structure first.
+PLAIN      = b'p'
+STRUCTURED = b's'
+
+# In the tagged structure, numbers, strings, lists and dicts appear as they
+# are. Every tuple starts with one of these tags, so user tuples and
+# dicelang objects cannot be mistaken for one another.
+TUPLE     = 't'
+UNDEFINED = 'u'
+FUNCTION  = 'f'
+ALIAS     = 'a'
+TREE      = 'r'
+TOKEN     = 'k'
+RANGE     = 'g'
+
+def encode(value):
+  '''Serialize a dicelang value to bytes.'''
+  header = MAGIC + bytes([VERSION, MARSHAL_VERSION])
+  try:
+    out = header + PLAIN + marshal.dumps(value, MARSHAL_VERSION)
+  except ValueError: # Holds objects marshal does not know about.
+    flat = flatten(value)
+    out = header + STRUCTURED + marshal.dumps(flat, MARSHAL_VERSION)
+  return out
+
+def decode(data):
+  '''Rebuild a dicelang value from bytes made by `encode`.'''
+  start = len(MAGIC) + 1
+  if data[:len(MAGIC)] != MAGIC:
+    raise StorageError('Stored value is not in the dicelang value format.')
+  version = data[len(MAGIC)]
+  try:
+    unflatten = decoders[version]
+  except KeyError:
+    raise StorageError(f'Unknown dicelang value format version: {version}.')
+  if version >= 3:
+    marshalled = data[start]
+    if marshalled > marshal.version:
+      raise StorageError(f'Stored value was written in version {marshalled} '
+        + f'of marshal, but only versions up to {marshal.version} can be read.')
+    start += 1
+  kind = data[start:start + 1]
+  out = marshal.loads(data[start + 1:])
+  return unflatten(out) if kind == STRUCTURED else out
+
+def dumps(value):
+  '''Serialize a dicelang value for a text column.'''
+  return TEXT_PREFIX + base64.b64encode(encode(value)).decode('ascii')
+
+def loads(text):
+  '''Rebuild a dicelang value stored by `dumps`, or by `repr` before the
+  binary format existed.'''
+  if text.startswith(TEXT_PREFIX):
+    out = decode(base64.b64decode(text[len(TEXT_PREFIX):]))
+  else:
+    out = legacy_loads(text)
+  return out
+
+# The names and constructors that may appear in the old repr format.
+legacy_names = {
+  'Undefined' : Undefined,
+  'inf'       : inf,
+  'nan'       : nan,
+}
+legacy_calls = {
+  'Function' : Function,
+  'Alias'    : Alias,
+}
+
+def legacy_loads(text):
+  '''Values used to be stored as their repr and restored with eval. They are
+  read back without running any code: only literals, the names above and
+  calls of the constructors above are accepted.'''
+  try:
+    tree = ast.parse(text.strip(), mode='eval')
+  except SyntaxError:
+    raise StorageError('Stored value is not in the old repr format.')
+  return legacy_value(tree.body)
+
+def legacy_value(node):
+  '''The value of one node of an expression in the old repr format.'''
+  if isinstance(node, ast.Constant):
+    out = node.value
+  elif isinstance(node, ast.List):
+    out = [legacy_value(x) for x in node.elts]
+  elif isinstance(node, ast.Tuple):
+    out = tuple(legacy_value(x) for x in node.elts)
+  elif isinstance(node, ast.Dict) and None not in node.keys:
+    keys = [legacy_value(k) for k in node.keys]
+    out = dict(zip(keys, [legacy_value(v) for v in node.values]))
+  elif isinstance(node, ast.Name) and node.id in legacy_names:
+    out = legacy_names[node.id]
+  elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+    out = -legacy_number(node.operand)
+  elif isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub)):
+    # Complex numbers, like (1+2j), are written as sums.
+    left, right = legacy_number(node.left), legacy_number(node.right)
+    out = left + right if isinstance(node.op, ast.Add) else left - right
+  elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+      and node.func.id in legacy_calls and all(k.arg for k in node.keywords):
+    args = [legacy_value(x) for x in node.args]
+    kwargs = {k.arg: legacy_value(k.value) for k in node.keywords}
+    out = legacy_calls[node.func.id](*args, **kwargs)
+  else:
+    source = ast.unparse(node)
+    raise StorageError(f'Cannot load `{source}` from the old repr format.')
+  return out
+
+def legacy_number(node):
+  out = legacy_value(node)
+  if isinstance(out, bool) or not isinstance(out, (int, float, complex)):
+    raise StorageError('Only numbers can be negated or added in stored values.')
+  return out
+
+def legacy_dumps(value):
+  '''The old repr format, kept so that migrations can be reversed.'''
+  with Function.SerializableRepr():
+    out = repr(value)
+  return out
+
+def flatten(value):
+  '''Convert a value to a structure that marshal can serialize.'''
+  if isinstance(value, (bool, int, float, complex, str)) or value is None:
+    out = value
+  elif isinstance(value, list):
+    out = [flatten(x) for x in value]
+  elif isinstance(value, dict):
+    out = {flatten(k): flatten(v) for k, v in value.items()}
+  elif isinstance(value, tuple):
+    out = (TUPLE,) + tuple(flatten(x) for x in value)
+  elif value is Undefined:
+    out = (UNDEFINED,)
+  elif isinstance(value, Function):
+    code = flatten_tree(value.code)
+    out = (FUNCTION, tuple(value.params), code, flatten(value.closed))
+  elif isinstance(value, Alias):
+    out = (ALIAS, flatten(value.aliased))
+  elif isinstance(value, Range):
+    out = (RANGE, value.start, value.step, value.size)
+  else:
+    name = value.__class__.__name__
+    raise StorageError(f'Values of type {name} cannot be stored.')
+  return out
+
+def flatten_tree(tree):
+  '''Function bodies are stored as their syntax trees, so that loading a
+  function never has to parse its source again.'''
+  if isinstance(tree, Tree):
+    out = (TREE, tree.data) + tuple(flatten_tree(c) for c in tree.children)
+  else:
+    out = (TOKEN, tree.type, tree.value)
+  return out
+
+def unflatten(data):
+  '''Inverse of `flatten` for versions 1 and 2 of the format.'''
+  if isinstance(data, list):
+    out = [unflatten(x) for x in data]
+  elif isinstance(data, dict):
+    out = {unflatten(k): unflatten(v) for k, v in data.items()}
+  elif not isinstance(data, tuple):
+    out = data
+  elif data[0] == TUPLE:
+    out = tuple(unflatten(x) for x in data[1:])
+  elif data[0] == UNDEFINED:
+    out = Undefined
+  elif data[0] == FUNCTION:
+    _, params, code, closed = data
+    code, closed = unflatten_tree(code), unflatten(closed)
+    out = Function(code, param_names=list(params), closed_vars=closed)
+  elif data[0] == ALIAS:
+    out = Alias(unflatten(data[1]))
+  elif data[0] == RANGE:
+    out = Range(*data[1:])
+  else:
+    raise StorageError(f'Unknown tag in stored value: {data[0]!r}.')
+  return out
+
+def unflatten_tree(data):
+  if data[0] == TREE:
+    out = Tree(data[1], [unflatten_tree(c) for c in data[2:]])
+  else:
+    out = Token(data[1], data[2])
+  return out
+
+# Version 2 added ranges, which version 1 values never hold. Version 3 added
+# the version of marshal to the header.
+decoders = {
+  1: unflatten,
+  2: unflatten,
+  3: unflatten,
+}
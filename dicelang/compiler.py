@@ -0,0 +1,79 @@
+import copy
+from numbers import Number
+from lark import Tree
+from dicelang.undefined import Undefined
+
+class Instruction(Tree):
+  '''A syntax tree node that carries the handler which executes it, chosen
+  once when the tree is compiled instead of every time the node is visited.
+  It is still a lark Tree, so the decompiler and equality checks treat it
+  exactly like the tree it was compiled from. The handler is called with
+  `operands`, which are the node's children unless the node was collapsed
+  into its only child.'''
+  def __init__(self, data, children, handler, meta=None, operands=None):
+    super().__init__(data, children, meta)
+    self.handler = handler
+    self.operands = children if operands is None else operands
+
+  def __deepcopy__(self, memo):
+    children = copy.deepcopy(self.children, memo)
+    operands = copy.deepcopy(self.operands, memo)
+    return type(self)(
+      self.data, children, self.handler, self._meta, operands)
+
+class Constant(object):
+  '''Handler of an Instruction whose value was worked out when it was
+  compiled. Each execution gets its own copy of a mutable value, since the
+  value may be stored in a variable and then modified in place.'''
+  def __init__(self, value):
+    self.value = value
+    if is_frozen(value):
+      self.copy = None
+    elif all(map(is_frozen, contents(value))):
+      self.copy = copy.copy
+    else:
+      self.copy = copy.deepcopy
+
+  def __call__(self, visitor, operands):
+    return self.value if self.copy is None else self.copy(self.value)
+
+  def __repr__(self):
+    return f'Constant({self.value!r})'
+
+def contents(value):
+  '''Elements of a list or tuple, or the keys and values of a dict.'''
+  if isinstance(value, dict):
+    return list(value.keys()) + list(value.values())
+  return value if isinstance(value, (list, tuple)) else [value]
+
+def is_frozen(value):
+  '''Whether nothing can change a value in place.'''
+  if isinstance(value, tuple):
+    return all(map(is_frozen, value))
+  return isinstance(value, (Number, str, slice)) or value is Undefined
+
+def is_constant(tree):
+  return isinstance(tree, Instruction) and isinstance(tree.handler, Constant)
+
+def compile_tree(tree, select_handler, pass_through=(), fold=None):
+  '''Turn a syntax tree into a tree of Instructions, asking
+  `select_handler(rule)` for the handler of each node. Nodes of the rules in
+  `pass_through` only wrap one other node, so they are collapsed: they take
+  on the handler and operands of that node and are never executed
+  themselves. If `fold` is given, each new Instruction is passed through it,
+  children first, so that it can be replaced with a constant. Tokens are
+  left as they are, and trees that are already compiled are returned
+  unchanged.'''
+  if isinstance(tree, Instruction) or not isinstance(tree, Tree):
+    return tree
+  children = [
+    compile_tree(child, select_handler, pass_through, fold)
+    for child in tree.children]
+  if tree.data in pass_through and len(children) == 1:
+    child, = children
+    if isinstance(child, Instruction):
+      return Instruction(
+        tree.data, children, child.handler, tree._meta, child.operands)
+  handler = select_handler(tree.data)
+  out = Instruction(tree.data, children, handler, tree._meta)
+  return out if fold is None else fold(out)
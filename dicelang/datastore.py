@@ -1,7 +1,10 @@
 import os
+import sys
 import copy
-import threading
 import time
+import random
+import threading
+import contextvars
 from collections.abc import Iterable
 from collections import defaultdict
 
@@ -9,141 +12,368 @@ os.environ['DJANGO_SETTINGS_MODULE'] = 'db_config.settings'
 import django
 django.setup()
 from atropos_db.models import Variable
-from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db import OperationalError
+from django.db.models import Q
 
-# The following imports are not used by name in this file, but are
-# necessary for enabling `eval` to work correctly. Do not let
-# PyCharm "optimize" them out.
-from dicelang.undefined import Undefined
-from dicelang.function  import Function
-from dicelang.alias import Alias
-from dicelang.float_special import inf
-from dicelang.float_special import nan
+from dicelang import codec
+from dicelang.cache import LruCache
 
 VAR_MODES = ['private', 'server', 'core', 'global']
 
-class Cache(object):
-  def __init__(self, modes=VAR_MODES, prune_below=10):
-    self.vars = {}
-    self.uses = {}
-    self.threshold = prune_below
-    for mode in modes:
-      self.vars[mode] = {}
-      self.uses[mode] = {}
-  
-  def get(self, owner_id, key, mode):
-    try:
-      out = self.vars[mode][owner_id][key]
-      self.uses[mode][owner_id][key] += 1
-    except KeyError:
-      out = None
+# Name of the variable holding the result of the latest command.
+LAST = '_'
+
+# Marks a variable that has been dropped but not yet deleted from the
+# database.
+class Deleted(object):
+  pass
+
+# Cached in place of a variable that is not in the database, so that looking
+# it up again does not query the database again.
+class Missing(object):
+  pass
+
+# Returned by the cache for variables it knows nothing about, as opposed to
+# variables whose cached value is None or Missing.
+class NotCached(object):
+  pass
+
+class Encoded(object):
+  '''A variable preloaded from the database but not decoded yet. Most
+  preloaded variables are never used by the command they were loaded for,
+  so they are only decoded when first read.'''
+  __slots__ = ('data',)
+  
+  def __init__(self, data):
+    self.data = data
+  
+  def __sizeof__(self):
+    return object.__sizeof__(self) + sys.getsizeof(self.data)
+
+class Unit(object):
+  '''The changes made by one command, which are saved or forgotten
+  together. Until they are saved, only that command sees them.'''
+  def __init__(self):
+    self.pending = { }
+    self.last_undo = { }
+    self.committed = [ ]
+
+class DataStore(object):
+  # How many times a commit is tried while other processes hold the
+  # database, and about how long to wait before the first retry.
+  write_attempts = 8
+  write_retry_delay = 0.01
+  
+  def __init__(self, cache=None, last_interval=60, preload_limit=256):
+    '''Variables read from the database are kept in `cache`, which is a
+    default LruCache if not given. `preload` reads at most `preload_limit`
+    variables at once. `_` changes with every command, so it is kept in
+    memory and only written to the database by the first commit every
+    `last_interval` seconds.'''
+    self.cache = LruCache() if cache is None else cache
+    self.units = contextvars.ContextVar('unit', default=None)
+    self.lock = threading.Lock()
+    self.write_lock = threading.Lock()
+    self.preload_limit = preload_limit
+    self.preloaded = set()
+    self.last = { }
+    self.last_dirty = set()
+    self.last_interval = last_interval
+    self.last_persisted = time.monotonic()
+    self.last_updates = 0
+    self.last_writes = 0
+  
+  @property
+  def unit(self):
+    '''The Unit of the command running in the current thread or task.'''
+    out = self.units.get()
+    if out is None:
+      out = Unit()
+      self.units.set(out)
     return out
   
-  def put(self, owner_id, key, value, mode):
-    if owner_id not in self.vars[mode]:
-      self.vars[mode][owner_id] = {}
-      self.uses[mode][owner_id] = defaultdict(int)
-    self.vars[mode][owner_id][key] = value
-    self.uses[mode][owner_id][key] += 1
-    return value
+  @property
+  def pending(self):
+    return self.unit.pending
   
-  def drop(self, owner_id, key, mode):
-    if owner_id in self.vars[mode] and key in self.vars[mode][owner_id]:
-      out = copy.copy(self.vars[mode][owner_id][key])
-      del self.vars[mode][owner_id][key]
-      del self.uses[mode][owner_id][key]
-    else:
-      out = None
+  @property
+  def last_undo(self):
+    return self.unit.last_undo
+  
+  @property
+  def committed(self):
+    '''(owner_tag, key, mode) of the variables the last commit saved.'''
+    return self.unit.committed
+  
+  @committed.setter
+  def committed(self, keys):
+    self.unit.committed = keys
+  
+  def view(self, mode, owner_id, sizes=False):
+    '''Names of an owner's variables. If `sizes` is set, (name, size)
+    pairs instead, where size is the length of the encoded value in bytes.
+    Values are not read from the database to list them.'''
+    listing = dict(Variable.objects.filter(
+      var_type=mode,
+      owner_id=owner_id).values_list('name', 'size'))
+    for (owner_tag, key, var_type), value in self.pending.items():
+      if owner_tag != owner_id or var_type != mode:
+        continue
+      if value is Deleted:
+        listing.pop(key, None)
+      else:
+        listing[key] = len(codec.encode(value)) if sizes else 0
+    return list(listing.items()) if sizes else list(listing)
+  
+  def get(self, owner_tag, key, mode):
+    if key == LAST:
+      return self.get_last(owner_tag, mode)
+    out = self.pending.get((owner_tag, key, mode), NotCached)
+    if out is NotCached:
+      out = self.cache.get(owner_tag, key, mode, NotCached)
+    if isinstance(out, Encoded):
+      out = self.decode(out.data)
+      if out is not NotCached:
+        self.cache.put(owner_tag, key, out, mode)
+    if out is NotCached:
+      out = self.load(owner_tag, key, mode)
+      if out is not NotCached:
+        self.cache.put(owner_tag, key, out, mode)
+    if out is Missing or out is Deleted or out is NotCached:
+      return None
     return out
   
-  def prune(self):
-    '''Don't prune `core` variables -- they're usually large, often-used, and
-    well-curated, which means they're good candidates for remaining loaded.'''
-    marked = [ ]
-    for mode in filter(lambda s: s != 'core', self.uses):
-      for owner in self.uses[mode]:
-        for key in self.uses[mode][owner]:
-          uses = self.uses[mode][owner][key]
-          is_function = isinstance(self.vars[mode][owner][key], Function)
-          function_sweep =     is_function and uses < self.threshold / 2
-          value_sweep    = not is_function and uses < self.threshold
-          if function_sweep or value_sweep:
-            marked.append((mode, owner, key))
-          else:
-            self.uses[mode][owner][key] = 0
-    
-    objects_pruned = 0
-    for item in marked:
-      objects_pruned += self._remove(*item)
-    return objects_pruned
-  
-  def _remove(self, mode, owner, key):
-    print(f'prune {(mode, owner, key)} from cache')
-    del self.vars[mode][owner][key]
-    del self.uses[mode][owner][key]
-    return 1
- 
-class DataStore(object):
-  def __init__(self, cache_time=6*60*60):
-    self.cache = Cache()
-    
-    def pruning_task(cycle_time):
-      while True:
-        time.sleep(cycle_time)
-        pruned = self.cache.prune()
-        print(f'{pruned} objects pruned from cache')
+  def load(self, owner_tag, key, mode):
+    '''Read a variable from the database. Give back Missing if it is not
+    there, or NotCached if it could not be read, so that it is tried again
+    next time.'''
+    try:
+      stored = Variable.objects.values_list('value', flat=True).get(
+        owner_id=owner_tag,
+        var_type=mode,
+        name=key)
+    except Variable.DoesNotExist:
+      return Missing
+    except Exception as e:
+      return NotCached
+    return self.decode(stored)
+  
+  def decode(self, stored):
+    try:
+      out = codec.decode(bytes(stored))
+    except Exception as e:
+      out = NotCached
+    return out
+  
+  def preload(self, *namespaces):
+    '''Cache the variables of every (owner_tag, mode) in `namespaces` that
+    has not been preloaded before, using one query, so that a command using
+    many of them does not need a query for each. Each namespace is only
+    preloaded once, since the cache is kept up to date with every change
+    made afterwards. Variables are decoded when they are first read. Returns
+    how many variables were cached.'''
+    namespaces = [ns for ns in namespaces if ns not in self.preloaded]
+    if not namespaces or self.preload_limit <= 0:
+      return 0
+    self.preloaded.update(namespaces)
+    query = Q()
+    for owner_tag, mode in namespaces:
+      query |= Q(owner_id=owner_tag, var_type=mode)
+    rows = Variable.objects.filter(query).exclude(name=LAST).values_list(
+      'owner_id', 'var_type', 'name', 'value')[:self.preload_limit]
     
-    self.pruner = threading.Thread(
-      target=pruning_task,
-      args=(cache_time,),
-      daemon=True)
-    self.pruner.start()
-  
-  def view(self, mode, owner_id):
-    results = Variable.objects.filter(var_type=mode, owner_id=owner_id)
-    names = [ ]
-    for result in results:
-      names.append(result.name)
-    return names
+    count = 0
+    for owner_tag, mode, key, stored in rows:
+      if self.cache.get(owner_tag, key, mode, NotCached) is NotCached:
+        self.cache.put(owner_tag, key, Encoded(stored), mode)
+        count += 1
+    return count
   
-  def get(self, owner_tag, key, mode):
-    out = self.cache.get(owner_tag, key, mode)
-    if out is None:
-      try:
-        out_repr = Variable.objects.get(
-          owner_id=owner_tag,
-          var_type=mode,
-          name=key).value_string
-        out = eval(out_repr)
-      except Exception as e:
+  def get_last(self, owner_tag, mode):
+    '''`_` is read from the database only the first time it is needed.'''
+    if (owner_tag, mode) not in self.last:
+      if self.pending.get((owner_tag, LAST, mode)) is Deleted:
+        return None
+      out = self.load(owner_tag, LAST, mode)
+      if out is Missing or out is NotCached:
         out = None
-      else:
-        self.cache.put(owner_tag, key, out, mode)
+      self.last[(owner_tag, mode)] = out
+    out = self.last[(owner_tag, mode)]
+    if isinstance(out, Encoded):
+      out = self.decode(out.data)
+      out = None if out is NotCached else out
+      self.last[(owner_tag, mode)] = out
     return out
+  
+  def put_last(self, owner_tag, value, mode):
+    '''Set `_` for one owner without writing it to the database.'''
+    with self.lock:
+      self.last[(owner_tag, mode)] = value
+      self.last_dirty.add((owner_tag, mode))
+      self.last_updates += 1
+    return value
+  
+  def remember_last(self, owner_tag, value, mode):
+    '''Set `_` to a value that some other datastore is responsible for
+    writing to the database. `value` may be Encoded.'''
+    with self.lock:
+      self.last[(owner_tag, mode)] = value
+      self.last_dirty.discard((owner_tag, mode))
+  
+  def forget(self, owner_tag, key, mode):
+    '''Drop a variable from the cache after it was changed in the database
+    by someone else.'''
+    if key == LAST:
+      with self.lock:
+        self.last.pop((owner_tag, mode), None)
+        self.last_dirty.discard((owner_tag, mode))
+    self.cache.drop(owner_tag, key, mode)
+  
+  def persist_last(self):
+    '''Have the next commit write every `_` changed since the last time
+    they were written. Called by `commit` every `last_interval` seconds, and
+    by `Interpreter.close` and the pool's workers before shutting down.'''
+    pending = self.pending
+    with self.lock:
+      for owner_tag, mode in self.last_dirty:
+        pending[(owner_tag, LAST, mode)] = self.last[(owner_tag, mode)]
+      self.last_writes += len(self.last_dirty)
+      self.last_dirty.clear()
+      self.last_persisted = time.monotonic()
+  
+  def last_stats(self):
+    '''Database writes of `_` avoided by keeping it in memory.'''
+    return {
+      'updates' : self.last_updates,
+      'writes'  : self.last_writes,
+      'saved'   : self.last_updates - self.last_writes,
+      'dirty'   : len(self.last_dirty),
+    }
 
   def put(self, owner_tag, key, value, mode):
-    self.cache.put(owner_tag, key, value, mode)
+    '''Store `value` and give back a copy of it, independent of the stored
+    value as if it had been read back from the database. The value is
+    written to the database and cached by the next `commit`.'''
+    if key == LAST:
+      self.last_undo.setdefault(
+        (owner_tag, mode), self.last.get((owner_tag, mode), Deleted))
+      self.put_last(owner_tag, value, mode)
+      return copy.deepcopy(value)
+    self.pending[(owner_tag, key, mode)] = value
+    return copy.deepcopy(value)
+
+  def drop(self, owner_tag, key, mode):
+    '''Remove a variable, giving back its value. The row is deleted from
+    the database by the next `commit`.'''
+    out = self.get(owner_tag, key, mode)
+    if key == LAST:
+      self.last_undo.setdefault((owner_tag, mode), out)
+      with self.lock:
+        self.last[(owner_tag, mode)] = None
+        self.last_dirty.discard((owner_tag, mode))
+    if out is not None:
+      self.pending[(owner_tag, key, mode)] = Deleted
+    return out
+  
+  def commit(self):
+    '''Write every change made since the last commit or rollback to the
+    database in one transaction, and return how many variables changed.
+    Their (owner_tag, key, mode) are kept in `committed` until the next
+    commit.'''
+    unit = self.unit
+    unit.last_undo.clear()
+    interval = time.monotonic() - self.last_persisted
+    if self.last_dirty and interval >= self.last_interval:
+      self.persist_last()
+    pending, unit.pending = unit.pending, { }
+    unit.committed = list(pending)
+    groups = defaultdict(dict)
+    for (owner_tag, key, mode), value in pending.items():
+      groups[(owner_tag, mode)][key] = value
+    
+    try:
+      self.write(groups)
+    except Exception:
+      # Another process may have changed the same variables at once. None
+      # of the changes were saved, so none of them may stay cached.
+      for owner_tag, key, mode in pending:
+        self.forget(owner_tag, key, mode)
+      unit.committed = [ ]
+      raise
     
-    with Function.SerializableRepr() as _:
-      mutating = {'value_string': repr(value)}
+    for (owner_tag, key, mode), value in pending.items():
+      if key != LAST:
+        value = Missing if value is Deleted else value
+        self.cache.put(owner_tag, key, value, mode)
+    return len(pending)
+  
+  def write(self, groups):
+    '''Write the changes to each owner and mode in one transaction. SQLite
+    allows one writer at a time. Threads of this process take turns, but a
+    transaction that has read from the database while another process was
+    writing to it fails at once instead of waiting, so it is tried again
+    after a while, waiting longer each time.'''
+    for attempt in range(self.write_attempts):
+      try:
+        with self.write_lock, transaction.atomic():
+          for (owner_tag, mode), values in groups.items():
+            self.write_group(owner_tag, mode, values)
+        return
+      except OperationalError as e:
+        if 'locked' not in str(e) or attempt == self.write_attempts - 1:
+          raise
+      time.sleep(self.write_retry_delay * 2 ** attempt * random.uniform(1, 2))
+  
+  def write_group(self, owner_tag, mode, values):
+    '''Apply the changes to the variables of one owner and mode using a
+    query to find their rows and one bulk query for each kind of change.'''
+    deleted = [key for key, value in values.items() if value is Deleted]
+    if deleted:
+      Variable.objects.filter(
+        owner_id=owner_tag,
+        var_type=mode,
+        name__in=deleted).delete()
     
-    variable = Variable.objects.update_or_create(
+    changed = {k: v for k, v in values.items() if v is not Deleted}
+    if not changed:
+      return
+    existing = Variable.objects.filter(
       owner_id=owner_tag,
       var_type=mode,
-      name=key,
-      defaults=mutating)
-    
-    variable = variable[0].value_string
-    return eval(variable)
-
-  def drop(self, owner_tag, key, mode):
-    self.cache.drop(owner_tag, key, mode)
-    try:
-      var = Variable.objects.get(owner_id=owner_tag, var_type=mode, name=key)
-    except Variable.DoesNotExist:
-      out = None
-    else:
-      out = eval(var.value_string)
-      var.delete()
-    return out
-
+      name__in=list(changed)).only('id', 'name')
+    updated = [ ]
+    for variable in existing:
+      variable.value = codec.encode(changed.pop(variable.name))
+      variable.size = len(variable.value)
+      updated.append(variable)
+    Variable.objects.bulk_update(updated, ['value', 'size'])
+    created = [ ]
+    for key, value in changed.items():
+      encoded = codec.encode(value)
+      created.append(Variable(
+        owner_id=owner_tag,
+        var_type=mode,
+        name=key,
+        value=encoded,
+        size=len(encoded)))
+    Variable.objects.bulk_create(created)
+  
+  def rollback(self):
+    '''Forget every change made since the last commit or rollback. Changed
+    variables are also evicted from the cache, since subscript assignments
+    change their values in place, so that they are next read from the
+    database as they were before the changes.'''
+    unit = self.unit
+    pending, unit.pending = unit.pending, { }
+    for owner_tag, key, mode in pending:
+      self.cache.drop(owner_tag, key, mode)
+    with self.lock:
+      for (owner_tag, mode), value in unit.last_undo.items():
+        if value is Deleted:
+          self.last.pop((owner_tag, mode), None)
+          self.last_dirty.discard((owner_tag, mode))
+        else:
+          self.last[(owner_tag, mode)] = value
+    unit.last_undo.clear()
+    return len(pending)
@@ -122,6 +122,10 @@ class Decompiler(object):
     elif tree.data == 'repetition':
       left, right = self.decompile_all(tree.children)
       out = f'{left} ^ {right}'
+    elif tree.data == 'simulation':
+      expression, times, *margin = self.decompile_all(tree.children)
+      out = f'{expression} ^? {times}'
+      out += f' within {margin[0]}' if margin else ''
     elif tree.data == 'bool_or':
       out = self.decompile(tree.children[0])
     elif tree.data == 'logical_or':
@@ -227,6 +231,8 @@ class Decompiler(object):
       out = f'!>{self.decompile(tree.children[0])}'
     elif tree.data == 'stats':
       out = f'?{self.decompile(tree.children[0])}'
+    elif tree.data == 'odds':
+      out = f'??{self.decompile(tree.children[0])}'
     elif tree.data == 'sort':
       out = f'<>{self.decompile(tree.children[0])}'
     elif tree.data == 'shuffle':
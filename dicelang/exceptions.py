@@ -32,6 +32,11 @@ class ExponentiationTimeout(ExecutionTimeout):
 class DiceRollTimeout(ExecutionTimeout):
   pass
 
+class StepLimitExceeded(ExecutionTimeout):
+  def __init__(self, max_steps):
+    super().__init__(f'Dicelang command took more than {max_steps} steps!')
+    self.max_steps = max_steps
+
 class FunctionError(DicelangError):
   pass
 
@@ -0,0 +1,49 @@
+import time
+from dicelang.print_queue import PrintQueue
+from dicelang.exceptions import StepLimitExceeded
+
+class Execution(object):
+  '''Everything the visitor has to remember while it evaluates one command:
+  its variable scopes, how deeply function calls are nested, when it must
+  finish by, and what it has printed. A Visitor keeps the Execution of the
+  command it is running in a context variable, so that one Visitor can run
+  commands on several threads or asyncio tasks at once.
+
+  Work is counted in steps: one for each node of the syntax tree visited,
+  die rolled and multiplication done while raising to a power. At most
+  `max_steps` may be taken, if given. `must_finish_by` is a time on the
+  `time.monotonic` clock, which is only read every `check_every` steps.
+  While loops may set an earlier `loop_must_finish_by`.
+  
+  Small rolls are taken from `dice`, a util.DiceBuffer, when one is set.'''
+  check_every = 256
+
+  def __init__(self, scoping_data, must_finish_by, max_steps=None):
+    self.scoping_data = scoping_data
+    self.must_finish_by = must_finish_by
+    self.loop_must_finish_by = float('inf')
+    self.depth = 0
+    self.print_queue = PrintQueue()
+    self.steps = 0
+    self.max_steps = max_steps
+    self.next_check = 0
+    self.dice = None
+
+  def spend(self, steps, error, *args):
+    '''Count `steps` more steps, raising `error(*args)` if the command has
+    run out of time.'''
+    self.steps += steps
+    if self.steps >= self.next_check:
+      self.check(error, *args)
+
+  def check(self, error, *args):
+    '''Raise `error(*args)` if the command has run out of time, or
+    StepLimitExceeded if it has taken too many steps, and otherwise decide
+    when to check again.'''
+    if self.max_steps is not None and self.steps > self.max_steps:
+      raise StepLimitExceeded(self.max_steps)
+    if time.monotonic() > min(self.must_finish_by, self.loop_must_finish_by):
+      raise error(*args)
+    self.next_check = self.steps + self.check_every
+    if self.max_steps is not None:
+      self.next_check = min(self.next_check, self.max_steps + 1)
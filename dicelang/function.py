@@ -1,46 +1,66 @@
 import copy
-import lark
+import contextvars
 from dicelang import decompiler
-from dicelang import grammar
+from dicelang import parsing
 from dicelang.undefined import Undefined
+from dicelang.ownership import Closure
 from dicelang.exceptions import DefinitionError, CallError
 
 class Function(object):
-  parser = lark.Lark(grammar.raw_text, start='function', parser='earley')
+  # Parses functions made from source unless they are given another parser.
+  parser = parsing.TreeCache(
+    parsing.build('function', 'earley'),
+    compiler=parsing.compact)
   deparser = decompiler.Decompiler()
   
+  # Whether functions are being represented for serialization. It is kept
+  # per thread and task, since other commands may be showing functions to
+  # their users at the same time.
+  serializing = contextvars.ContextVar('serializing', default=False)
+  
   class SerializableRepr:
     def __init__(self):
-      pass
+      self.token = None
     def __enter__(self):
-      Function.__repr__ = Function.serializable_repr
+      self.token = Function.serializing.set(True)
     def __exit__(self, *args):
-      Function.__repr__ = Function.repl_repr
+      Function.serializing.reset(self.token)
   
-  def __init__(self, tree_or_src, param_names=None, closed_vars=None):
+  def __init__(self, tree_or_src, param_names=None, closed_vars=None,
+      parser=None):
+    '''A function is made from its source, parsed by `parser` if given, or
+    from its body's syntax tree and its parameters' names.'''
     if param_names is None:
-      tree = self.parse(tree_or_src)
+      tree = self.parse(tree_or_src, parser)
       self.code = tree.children[-1]
       self.params = tree.children[0:-1]
-      self.src = self.decompile(tree)
+      self._src = self.decompile(tree)
     else:
       self.code = tree_or_src
       self.params = param_names
-      signature, body = ', '.join(param_names), self.decompile(tree_or_src)
-      self.src = f'({signature}) -> {body}'
+      self._src = None
     
     self.normalize()
-    self.visitor = None
-    self.closed = closed_vars if closed_vars else [{}]
+    self.compiled = False
+    if not isinstance(closed_vars, Closure):
+      closed_vars = Closure(closed_vars if closed_vars else [{}])
+    self.closed = closed_vars
     self.this = Undefined
   
   def __deepcopy__(self, memodict={}):
     '''Override __deepcopy__ to prevent bugs when function objects are moved
     or deleted by users.'''
-    newtree = type(self.code)(
-      copy.deepcopy(self.code.data),
-      copy.deepcopy(self.code.children))
-    return type(self)(newtree, self.params[:], copy.deepcopy(self.closed))
+    # Code is never mutated once compiled, so copies can share it.
+    return type(self)(self.code, self.params[:], copy.deepcopy(self.closed))
+  
+  @property
+  def src(self):
+    '''Source code of the function, only decompiled when it is first shown
+    or serialized, since most functions are created just to be called.'''
+    if self._src is None:
+      signature, body = ', '.join(self.params), self.decompile(self.code)
+      self._src = f'({signature}) -> {body}'
+    return self._src
   
   def normalize(self):
     '''Ensure that all parameters are strings and not Lark Tokens, then check
@@ -56,9 +76,9 @@ class Function(object):
       last = param
     self.params = normalized_params
   
-  def parse(self, src):
+  def parse(self, src, parser=None):
     '''Proxy method for parsing a function source string.'''
-    return Function.parser.parse(src)
+    return (Function.parser if parser is None else parser).parse(src)
   
   def decompile(self, tree):
     '''Proxy method for decompiling a function source tree.'''
@@ -72,8 +92,11 @@ class Function(object):
     '''The representation used for serializing function objects.'''
     flat_source = self.src.replace('\n', '\f')
     return f'Function({flat_source!r}, closed_vars={self.closed!r})'
-    
-  __repr__ = repl_repr
+  
+  def __repr__(self):
+    if Function.serializing.get():
+      return self.serializable_repr()
+    return self.repl_repr()
   
   def marshal(self, args):
     scope = dict(zip(self.params, args))
@@ -85,19 +108,25 @@ class Function(object):
       return False
     return self.params == other.params and self.code == other.code
   
-  def __call__(self, visitor, *args):
+  def check_arguments(self, args):
     n, m = len(args), len(self.params)
     if n != m:
       e = f'Arguments mismatch formal parameters in length. '
       e += f'(Got {n}, expected {m}.)'
       raise CallError(e)
+  
+  def __call__(self, visitor, *args):
+    self.check_arguments(args)
     
-    if self.visitor is None:
-      self.visitor = visitor
+    # Compiled code does not depend on the visitor that compiled it, so the
+    # function can still be called from any other visitor or command.
+    if not self.compiled:
+      self.code = visitor.compile(self.code)
+      self.compiled = True
     
-    scoping_data = self.visitor.scoping_data
+    scoping_data = visitor.scoping_data
     scoping_data.push_function_call(self.marshal(args), self.closed)
-    out = self.visitor.walk(self.code, scoping_data)
+    out = visitor.walk(self.code, scoping_data)
     scoping_data.pop_function_call()
     self.this = Undefined
     return out
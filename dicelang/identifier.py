@@ -50,15 +50,9 @@ class Identifier(object):
     elif self.mode == 'global' or self.mode == 'core':
       out = self.datastore.get(-1, self.name, self.mode)
     elif self.mode == 'scoped':
-      lookup = NotLocal
-      try:
-        lookup = builtin.variables[self.name]
-      except KeyError:
-        if self.scoping_data:
-          lookup = self.scoping_data.get(self.name)
-        if not self.scoping_data or lookup is NotLocal:
-          lookup = self.datastore.get(self.scoping_data.server, self.name, 'server')
-      out = lookup
+      out = builtin.variables.get(self.name, NotLocal)
+      if out is NotLocal:
+        out = scoped_get(self.name, self.scoping_data, self.datastore)
     else:
       raise StorageError(f'Unknown identifier type: "{self.mode}".')
     return out if out is not None else Undefined
@@ -79,11 +73,7 @@ class Identifier(object):
       if self.name in builtin.variables:
         e = f'Builtin variable {self.name!r} may not be overwritten.'
         raise ProtectedError(e)
-      if self.scoping_data:
-        put = self.scoping_data.put(self.name, value)
-      if not self.scoping_data or put is NotLocal:
-        put = self.datastore.put(self.scoping_data.server, self.name, value, 'server')
-      out = put
+      out = scoped_put(self.name, value, self.scoping_data, self.datastore)
     else:
       raise StorageError(f'Unknown identifier type: "{self.mode}".')
     return out if out is not None else Undefined
@@ -113,4 +103,55 @@ class Identifier(object):
       raise StorageError(f'Unknown identifier type: "{self.mode}".')
     return out if out is not None else Undefined
 
+def scoped_get(name, scoping_data, datastore):
+  '''Value of a scoped variable that is not a builtin: from the innermost
+  scope that has it, then the closure of the function being run, then the
+  server's variables.'''
+  out = scoping_data.get(name)
+  if out is NotLocal:
+    out = datastore.get(scoping_data.server, name, 'server')
+  return out
+
+def scoped_put(name, value, scoping_data, datastore):
+  '''Assign a scoped variable that is not a builtin, in the local scope
+  that has it or else the innermost one, or among the server's variables
+  when there is no local scope.'''
+  out = scoping_data.put(name, value)
+  if out is NotLocal:
+    out = datastore.put(scoping_data.server, name, value, 'server')
+  return out
 
+class ScopedGet(object):
+  '''Handler of a node reading a scoped variable, holding the variable's
+  name so that reading it needs no Identifier. A builtin is looked up once,
+  when the node is compiled, since builtins never change.'''
+  def __init__(self, name):
+    self.name = name
+    self.builtin = builtin.variables.get(name, NotLocal)
+  
+  def __call__(self, visitor, operands):
+    out = self.builtin
+    if out is NotLocal:
+      out = scoped_get(self.name, visitor.scoping_data, visitor.variable_data)
+    return out if out is not None else Undefined
+  
+  def __repr__(self):
+    return f'ScopedGet({self.name!r})'
+
+class ScopedSet(object):
+  '''Handler of a node assigning a scoped variable; see ScopedGet.'''
+  def __init__(self, name):
+    self.name = name
+    self.protected = name in builtin.variables
+  
+  def __call__(self, visitor, operands):
+    value = visitor.handle_instruction(operands[1])
+    if self.protected:
+      e = f'Builtin variable {self.name!r} may not be overwritten.'
+      raise ProtectedError(e)
+    scoping_data, datastore = visitor.scoping_data, visitor.variable_data
+    out = scoped_put(self.name, value, scoping_data, datastore)
+    return out if out is not None else Undefined
+  
+  def __repr__(self):
+    return f'ScopedSet({self.name!r})'
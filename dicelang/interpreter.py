@@ -1,17 +1,51 @@
 #!/usr/bin/env python3
-from lark import Lark
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from dicelang import visitor
-from dicelang import grammar
+from dicelang import parsing
 from dicelang import datastore
 from dicelang import ownership
 from dicelang import builtin
+from dicelang.exceptions import DicelangError
 
 class Interpreter(object):
   GLOBAL_ID = -1
-  def __init__(self):
-    self.parser = Lark(grammar.raw_text, start='start', parser='earley')
+  def __init__(self, parser='earley', cache_size=256, workers=4,
+      max_steps=None):
+    '''`parser` selects the parsing engine, either 'earley' or 'lalr'. Both
+    produce the same syntax trees, but 'lalr' is much faster. The trees of
+    the `cache_size` most recently executed commands are kept so that
+    repeated commands are not parsed or compiled again. Up to `workers`
+    commands run at once when called through `call_async`. Commands may
+    take at most `max_steps` steps unless `execute` is given another
+    limit.'''
     self.datastore = datastore.DataStore()
     self.visitor = visitor.Visitor(self.datastore)
+    self.visitor.max_steps = max_steps
+    self.parser = parsing.TreeCache(
+      parsing.build('start', parser),
+      cache_size,
+      self.compile)
+    self.workers = ThreadPoolExecutor(
+      max_workers=workers,
+      thread_name_prefix='dicelang')
+  
+  def compile(self, tree):
+    '''Strip the pass-through nodes out of a command's syntax tree and
+    resolve the handlers of the rest.'''
+    return self.visitor.compile(parsing.compact(tree))
+  
+  async def call_async(self, function, *args):
+    '''Call `function(*args)` on one of the interpreter's worker threads
+    and await the result, so that an event loop can go on handling other
+    messages while a command is evaluated, and a long command does not hold
+    up short ones.'''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.workers, function, *args)
+  
+  async def execute_async(self, command, user, server, max_steps=None):
+    return await self.call_async(
+      self.execute, command, user, server, max_steps)
   
   def keys(self, mode, owner_id=GLOBAL_ID):
     return self.datastore.view(mode, owner_id)
@@ -19,23 +53,46 @@ class Interpreter(object):
   def builtin_keys(self):
     return list(builtin.variables.keys())
   
-  def execute(self, command, user, server):
+  def execute(self, command, user, server, max_steps=None):
     '''Passes the abstract syntax tree generated by the parser to the
     interpreter kernel with the user's name and the server's name for
-    variable retrieval and emplacement.'''
+    variable retrieval and emplacement. The user's and server's variables
+    are loaded together the first time either is used. Variables changed by
+    a command are saved together when it finishes, or not at all if it
+    fails. The steps each command takes are counted by server; see
+    `step_stats`.'''
     tree = self.parser.parse(command)
     scoping_data = ownership.ScopingData(user, server) 
-    value, printout = self.visitor.walk(tree, scoping_data, True)
-    self.put_last(user, server, value)
+    self.datastore.preload((user, 'private'), (server, 'server'))
+    try:
+      value, printout = self.visitor.walk(tree, scoping_data, True, max_steps)
+      self.put_last(user, server, value)
+    except DicelangError:
+      self.datastore.rollback()
+      raise
+    finally:
+      self.datastore.commit()
     return (value, printout)
   
   def put_last(self, user, server, value):
     '''Store most-recently acquired value in the special `_` variable for each
-    kind of storage.'''
-    self.datastore.put(user, '_', value, 'private')
-    self.datastore.put(server, '_', value, 'server')
-    self.datastore.put(Interpreter.GLOBAL_ID, '_', 'value', 'global')
+    kind of storage. These are kept in memory by the datastore rather than
+    written to the database after every command.'''
+    self.datastore.put_last(user, value, 'private')
+    self.datastore.put_last(server, value, 'server')
+    self.datastore.put_last(Interpreter.GLOBAL_ID, value, 'global')
+  
+  def close(self):
+    '''Stop the worker threads and write out the `_` values kept in memory.
+    Call before shutting down.'''
+    self.workers.shutdown()
+    self.datastore.persist_last()
+    self.datastore.commit()
+  
+  def get_print_queue_on_error(self, error):
+    '''The debug output a failed command printed before raising `error`.'''
+    return getattr(error, 'printout', '')
   
-  def get_print_queue_on_error(self, user):
-    return self.visitor.get_print_queue_on_error(user)
+  def step_stats(self, server=None):
+    return self.visitor.step_stats(server)
 
@@ -0,0 +1,280 @@
+import math
+import operator
+import functools
+import itertools
+from numbers import Real
+from collections import defaultdict
+from lark import Tree
+from dicelang import util
+from dicelang.alias import Alias
+from dicelang.running_stats import Ranked
+from dicelang.running_stats import quartiles
+from dicelang.compiler import is_constant
+from dicelang.decompiler import Decompiler
+from dicelang.exceptions import OperationError
+from dicelang.exceptions import ExecutionTimeout
+
+timeout_msg = 'Took too long working out the odds!'
+
+class Distribution(object):
+  '''Exact distribution of a random value: `ways[x]` of `total` equally
+  likely ways of rolling the dice give the outcome `x`.'''
+  histogram_size = 1000
+
+  def __init__(self, ways, total):
+    self.ways = ways
+    self.total = total
+
+  @classmethod
+  def point(cls, value):
+    return cls({value: 1}, 1)
+
+  @classmethod
+  def mixture(cls, parts):
+    '''Distribution of a value drawn from one of several distributions,
+    given as (ways, total, distribution) for the chance of using each.'''
+    parts = list(parts)
+    common = lcm(d.total for _, _, d in parts)
+    total = lcm(t for _, t, _ in parts)
+    ways = defaultdict(int)
+    for w, t, d in parts:
+      scale = w * (total // t) * (common // d.total)
+      for x, n in d.ways.items():
+        ways[x] += n * scale
+    return cls(dict(ways), total * common)
+
+  def map(self, operation):
+    ways = defaultdict(int)
+    for x, n in self.ways.items():
+      ways[operation(x)] += n
+    return Distribution(dict(ways), self.total)
+
+  def combine(self, other, operation, execution):
+    '''Distribution of `operation(x, y)`, where x and y are independent
+    values from this distribution and `other`.'''
+    execution.spend(
+      len(self.ways) * len(other.ways), ExecutionTimeout, timeout_msg)
+    ways = defaultdict(int)
+    for x, m in self.ways.items():
+      for y, n in other.ways.items():
+        ways[operation(x, y)] += m * n
+    return Distribution(dict(ways), self.total * other.total)
+
+  def summary(self, percentiles=(5, 10, 25, 50, 75, 90, 95)):
+    '''The statistics `?` gives for a list of rolls, worked out for the
+    distribution itself as if it were a list holding each of the `total`
+    ways to roll, with some percentiles and a histogram.'''
+    if not all(isinstance(x, Real) for x in self.ways):
+      raise OperationError('Odds can only be worked out for real numbers.')
+    ranked = Ranked(self.ways)
+    outcomes = ranked.outcomes
+    total = self.total
+    q1, median, q3 = quartiles(ranked)
+    average = sum(x * n for x, n in self.ways.items()) / total
+    variance = sum(
+      (x - average) ** 2 * (n / total) for x, n in self.ways.items())
+
+    out = { }
+    out['average'] = average
+    out['minimum'] = outcomes[0]
+    out['median' ] = median
+    out['maximum'] = outcomes[-1]
+    out['stddev' ] = math.sqrt(variance)
+    out['q1'] = q1
+    out['q3'] = q3
+    out['percentiles'] = {p: self.percentile(ranked, p) for p in percentiles}
+    out['histogram'] = self.histogram(outcomes)
+    return out
+
+  def percentile(self, ranked, p):
+    '''The lowest outcome that at least `p` percent of rolls are at most.'''
+    return ranked.at(max(-(-p * self.total // 100) - 1, 0))
+
+  def histogram(self, outcomes):
+    '''The chance of each outcome. Past `histogram_size` outcomes, runs of
+    neighbouring outcomes are counted together under the lowest of them, so
+    that there are at most that many.'''
+    width = -(-len(outcomes) // self.histogram_size)
+    out = { }
+    for i in range(0, len(outcomes), width):
+      run = outcomes[i:i + width]
+      out[run[0]] = sum(self.ways[x] for x in run) / self.total
+    return out
+
+def lcm(numbers):
+  return functools.reduce(lambda a, b: a * b // math.gcd(a, b), numbers, 1)
+
+def dice_sum(dice, sides, execution):
+  '''Distribution of the sum of `dice` dice with `sides` sides. Each die
+  adds a die's worth of outcomes to the number of ways to roll each total
+  so far, using running sums of them.'''
+  ways = [1]
+  for die in range(dice):
+    execution.spend(len(ways) + sides, ExecutionTimeout, timeout_msg)
+    sums = list(itertools.accumulate(ways, initial=0))
+    n = len(ways)
+    ways = [
+      sums[min(t, n)] - sums[max(t - sides, 0)] for t in range(n + sides)]
+  return Distribution(
+    {t: n for t, n in enumerate(ways) if n}, sides ** max(dice, 0))
+
+def dice_kept(dice, sides, count, highest, execution):
+  '''Distribution of the sum of the highest or lowest `count` of `dice` dice
+  with `sides` sides. Going through the sides from the first to be kept,
+  it counts the ways that any number of the dice not yet placed can show
+  each side, for each number of dice placed so far and sum of those kept.
+  Once `count` dice are placed, the rest may show any of the sides not yet
+  gone through, and none of them are kept.'''
+  if count < 0:
+    count = max(dice + count, 0)
+  if count >= dice:
+    return dice_sum(dice, sides, execution)
+
+  order = range(sides, 0, -1) if highest else range(1, sides + 1)
+  states = {(0, 0): 1}
+  out = defaultdict(int)
+  for i, side in enumerate(order):
+    later = sides - i - 1
+    execution.spend(len(states) * dice, ExecutionTimeout, timeout_msg)
+    placing = defaultdict(int)
+    for (placed, kept), n in states.items():
+      left = dice - placed
+      for c in range(left + 1):
+        ways = n * math.comb(left, c)
+        total = kept + side * min(c, count - placed)
+        if placed + c >= count:
+          out[total] += ways * later ** (left - c)
+        else:
+          placing[(placed + c, total)] += ways
+    states = placing
+  return Distribution(dict(out), sides ** dice)
+
+binary_operations = {
+  'addition'       : operator.add,
+  'subtraction'    : operator.sub,
+  'multiplication' : operator.mul,
+  'division'       : util.division,
+  'floor_division' : util.floor_division,
+  'remainder'      : util.remainder,
+  'exponent'       : operator.pow,
+}
+
+comparisons = {
+  '==' : operator.eq,
+  '!=' : operator.ne,
+  '>=' : operator.ge,
+  '<=' : operator.le,
+  '>'  : operator.gt,
+  '<'  : operator.lt,
+}
+
+dice_rules = {
+  'scalar_die_all'     : (False, None),
+  'scalar_die_highest' : (False, True),
+  'scalar_die_lowest'  : (False, False),
+  'vector_die_all'     : (True, None),
+  'vector_die_highest' : (True, True),
+  'vector_die_lowest'  : (True, False),
+}
+
+def cannot(node, why=''):
+  source = Decompiler().decompile(node)
+  return OperationError(f'Cannot work out the odds of `{source}`{why}. '
+    + 'Only dice, numbers, variables, arithmetic and single comparisons '
+    + 'can be analyzed.')
+
+def analyze(node, visitor):
+  '''Exact distribution of the value of a compiled syntax tree, built from
+  the distributions of its dice instead of rolling them. Numbers and
+  variables are evaluated as usual, and aliases are analyzed in place.
+  The work is counted as steps of the current execution.'''
+  execution = visitor.execution.get()
+  if not isinstance(node, Tree):
+    raise cannot(node)
+  # Parentheses are compiled into the node they enclose, but keep their
+  # name. Function bodies of one expression only evaluate that expression.
+  while node.data in ('priority', 'short_body', 'block') \
+      and len(node.children) == 1:
+    node = node.children[0]
+  rule = node.data
+
+  if is_constant(node) or rule in ('number_literal', 'boolean_literal'):
+    value = visitor.handle_instruction(node)
+  elif rule == 'identifier_get':
+    value = node.handler(visitor, node.operands)
+    if isinstance(value, Alias):
+      return analyze_alias(value, visitor)
+  else:
+    value = None
+  if value is not None:
+    if not isinstance(value, Real):
+      raise cannot(node, ', which is not a number')
+    return Distribution.point(value)
+
+  if rule in dice_rules:
+    vector, highest = dice_rules[rule]
+    if vector:
+      raise cannot(node, ', which is a list; sum it with & first')
+    return analyze_dice(node, highest, visitor)
+
+  if rule == 'sum_or_join':
+    operand = node.operands[0]
+    if isinstance(operand, Tree) and operand.data in dice_rules:
+      return analyze_dice(operand, dice_rules[operand.data][1], visitor)
+    raise cannot(node)
+
+  if rule in binary_operations:
+    left, right = [analyze(child, visitor) for child in node.operands]
+    return left.combine(right, binary_operations[rule], execution)
+
+  if rule == 'negation':
+    return analyze(node.operands[0], visitor).map(operator.neg)
+
+  if rule == 'comp_math' and len(node.operands) == 3:
+    left, comparison, right = node.operands
+    operation = comparisons[visitor.handle_instruction(comparison)]
+    left, right = analyze(left, visitor), analyze(right, visitor)
+    return left.combine(right, operation, execution)
+
+  if rule == 'repetition':
+    # Every element of `x ^ n` has the distribution of `x`.
+    return analyze(node.operands[0], visitor)
+
+  raise cannot(node)
+
+def analyze_alias(alias, visitor):
+  function = alias.aliased
+  if not function.compiled:
+    function.code = visitor.compile(function.code)
+    function.compiled = True
+  scoping_data = visitor.scoping_data
+  scoping_data.push_function_call(function.marshal([]), function.closed)
+  try:
+    return analyze(function.code, visitor)
+  finally:
+    scoping_data.pop_function_call()
+
+def analyze_dice(node, highest, visitor):
+  '''Distribution of a die node, whose number of dice, sides and dice kept
+  may themselves be random, in which case the distributions for each of
+  their possible values are mixed.'''
+  execution = visitor.execution.get()
+  operands = [analyze(child, visitor) for child in node.operands[::2]]
+  parts = [ ]
+  for choice in itertools.product(*[d.ways.items() for d in operands]):
+    values = [x for x, _ in choice]
+    dice, sides = values[:2]
+    if not all(isinstance(x, int) for x in values):
+      raise cannot(node, ', whose operands must be whole numbers')
+    if dice > 0 and sides < 1:
+      raise cannot(node, ', which has dice without sides')
+    if dice <= 0:
+      d = Distribution.point(0)
+    elif highest is None:
+      d = dice_sum(dice, sides, execution)
+    else:
+      d = dice_kept(dice, sides, values[2], highest, execution)
+    ways = math.prod(n for _, n in choice)
+    total = math.prod(d.total for d in operands)
+    parts.append((ways, total, d))
+  return Distribution.mixture(parts)
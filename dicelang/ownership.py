@@ -1,18 +1,105 @@
 import copy
+import weakref
 
 class StackException(Exception):
   pass
 
 NotLocal = object
 
+class Closure(list):
+  '''The scopes a function closes over, holding the values their variables
+  had when the function was made. Making a closure copies its scopes, but
+  not the values in them, which stay shared with the variables they were
+  taken from until one of them is copied. A value is copied the first time
+  it is read through the closure, so that nothing read from a closure is
+  shared with anything outside it. Before a value is changed in place, the
+  closures that share it are given copies of all their values; see
+  `ScopingData.unshare`. Until then the shared values are as they were when
+  the closure was made, so copying them late gives the same copies as
+  copying them at once. Values copied from the same closure keep sharing
+  whatever parts they shared with each other. Closures still sharing when
+  their command ends are given their copies then; see
+  `ScopingData.release`.'''
+  def __init__(self, scopes=()):
+    super().__init__(scopes)
+    self.memo = None
+    self.copied = None
+    self.reachable = None
+  
+  def is_sharing(self):
+    return self.memo is not None
+  
+  def shares(self, values):
+    '''Whether any of `values` is one of the lists or dicts that the values
+    this closure has not copied yet are made of.'''
+    ids = {id(x) for x in values}
+    if any(id(x) in ids for x in self.shared()):
+      return True
+    if self.reachable is None:
+      self.reachable = containers(self.shared())
+    return not ids.isdisjoint(self.reachable)
+  
+  def shared(self):
+    for i, scope in enumerate(self):
+      for key, value in scope.items():
+        if (i, key) not in self.copied:
+          yield value
+  
+  def detach(self):
+    '''Copy every value still shared.'''
+    for i, scope in enumerate(self):
+      for key in scope:
+        self.own(i, key)
+    self.memo = self.copied = self.reachable = None
+  
+  def own(self, i, key):
+    '''Copy the value at `key` of the `i`th scope if it is still shared.'''
+    if self.memo is not None and (i, key) not in self.copied:
+      self[i][key] = copy.deepcopy(self[i][key], self.memo)
+      self.copied.add((i, key))
+  
+  def lookup(self, key):
+    '''The value of the innermost variable called `key`, or NotLocal.'''
+    for i in range(len(self) - 1, -1, -1):
+      if key in self[i]:
+        if self.memo is not None:
+          self.own(i, key)
+        return self[i][key]
+    return NotLocal
+  
+  def __deepcopy__(self, memo):
+    # A copy may outlive the command that made this closure, and so must
+    # not share anything with it.
+    return Closure(copy.deepcopy(list(self), memo))
+
+def containers(values):
+  '''Ids of the lists, dicts and tuples in `values` at any depth, including
+  those closed over by functions and aliases among them.'''
+  out = set()
+  stack = list(values)
+  while stack:
+    x = stack.pop()
+    if isinstance(x, (list, tuple, dict)):
+      if id(x) not in out:
+        out.add(id(x))
+        stack.extend(x.values() if isinstance(x, dict) else x)
+    elif hasattr(x, 'closed'):
+      stack.append(x.closed)
+    elif hasattr(x, 'aliased'):
+      stack.append(x.aliased)
+  return out
+
 class ScopingData(object):
   def __init__(self, user='', server=''):
     self.user = user
     self.server = server
     self.frame_id = 0
     self.frames = {}
+    self.frame = NotLocal
     self.anonymous_scopes = []
     self.closure = []
+    # Closures made by this command that still share values with it, by id.
+    self.sharing = weakref.WeakValueDictionary()
   
   def push_function_call(self, arguments_dict, closed_vars):
     self.push_frame()
@@ -33,31 +120,51 @@ class ScopingData(object):
     self.closure.clear()
   
   def calling_environment(self):
+    '''The closure of a function made here, which takes as long to make
+    however large the values in it are; see `Closure`.'''
     frame = self.get_frame()
     if frame is NotLocal:
       try:
-        frame = [copy.deepcopy(self.get_scope())]
+        frame = [self.get_scope()]
       except IndexError:
         frame = [{}]
-    else:
-      frame = copy.deepcopy(frame)
-    return frame
+    out = Closure(dict(scope) for scope in frame)
+    out.memo, out.copied = { }, set()
+    self.sharing[id(out)] = out
+    return out
+  
+  def unshare(self, values):
+    '''Give every closure made by this command that shares any of `values`
+    copies of its own, before they are changed in place.'''
+    for closure in list(self.sharing.values()):
+      if not closure.is_sharing():
+        del self.sharing[id(closure)]
+      elif closure.shares(values):
+        closure.detach()
+        del self.sharing[id(closure)]
+  
+  def release(self):
+    '''Give every closure made by this command that still shares values
+    copies of its own, once the command is over. Those left are kept by
+    stored variables, which later commands may change in place without
+    knowing of them.'''
+    for closure in list(self.sharing.values()):
+      closure.detach()
+    self.sharing.clear()
   
   def push_frame(self):
     self.frame_id += 1
-    self.frames[self.frame_id] = [ ]
+    self.frame = self.frames[self.frame_id] = [ ]
   
   def pop_frame(self):
     out = self.frames.pop(self.frame_id)
     self.frame_id -= 1
+    self.frame = self.frames.get(self.frame_id, NotLocal)
     return out
   
   def get_frame(self):
-    try:
-      out = self.frames[self.frame_id]
-    except KeyError:
-      out = NotLocal
-    return out
+    '''The scopes of the function being run, or NotLocal outside of any.'''
+    return self.frame
   
   def push_scope(self, scope=None):
     new_scope = scope if scope is not None else {}
@@ -102,28 +209,14 @@ class ScopingData(object):
     If applicable, the lookup will search the current frame of closed
     variables. If this also fails, the function will return NotLocal.
     Otherwise, a value will be returned.'''
-    out = None
-    frame = self.get_frame()
+    frame = self.frame
+    scopes = self.anonymous_scopes if frame is NotLocal else frame
+    for scope in reversed(scopes):
+      if key in scope:
+        return scope[key]
     if frame is NotLocal:
-      if self.anonymous_scopes:
-        for scope in reversed(self.anonymous_scopes):
-          if key in scope:
-            out = scope[key]
-            break
-      if not self.anonymous_scopes or out is None:
-        out = frame
-    else:
-      for scope in reversed(frame):
-        if key in scope:
-          out = scope[key]
-          break
-    
-    if out is None:
-      for scope in reversed(self.closure[-1]):
-        if key in scope:
-          out = scope[key]
-          break
-    return out if out is not None else NotLocal
+      return NotLocal
+    return self.closure[-1].lookup(key)
   
   def put(self, key, value):
     '''For anonymous scopes, this attempts to emplace a value at a key from
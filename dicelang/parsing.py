@@ -0,0 +1,158 @@
+import re
+import threading
+import lark
+from collections import OrderedDict
+from lark import Tree
+from lark import Token
+from lark.exceptions import ParseError
+from dicelang import grammar
+
+ENGINES = ('earley', 'lalr')
+
+class LalrTreeFixer(lark.Transformer):
+  '''Rewrites the few constructs that `grammar.lalr_text` has to parse
+  differently from `grammar.raw_text` back into the trees the Earley parser
+  would have built, so that the visitor and decompiler never need to know
+  which engine was used.'''
+
+  param_pattern = re.compile(r'[a-zA-Z_]+[a-zA-Z0-9_]*')
+
+  def function(self, children):
+    '''Split the PARAMS token into one PARAM token per parameter name.'''
+    header, body = children
+    names = LalrTreeFixer.param_pattern.findall(header.value)
+    params = [Token.new_borrow_pos('PARAM', name, header) for name in names]
+    return Tree('function', params + [body])
+
+  def assignment(self, children):
+    '''Unwind an assignment target parsed as a primary into an identifier
+    and, if the target was subscripted, a subscript chain.'''
+    target, value = children
+    chain = [ ]
+    while target.data in ('sliced', 'getattr'):
+      obj, subscript = target.children
+      if target.data == 'getattr':
+        chain.append(Tree('identifier_subscript', [subscript]))
+      elif subscript.data == 'not_a_slice':
+        chain.append(Tree('bracket_subscript', subscript.children))
+      else:
+        raise ParseError('Cannot assign to a slice.')
+      target = obj
+
+    ident = self.target_identifier(target)
+    if chain:
+      chain = Tree('subscript_chain', chain[::-1])
+      out = Tree('subscript_set', [ident, chain, value])
+    else:
+      out = Tree('identifier_set', [ident, value])
+    return Tree('assignment', [out])
+
+  def target_identifier(self, target):
+    '''Get the `identifier` subtree out of primary(atom(identifier_get(...))),
+    or raise if the target is anything other than a variable.'''
+    try:
+      atom, = target.children
+      ident_get, = atom.children
+      ident, = ident_get.children
+      valid = target.data == 'primary' and ident_get.data == 'identifier_get'
+    except (AttributeError, ValueError):
+      valid = False
+    if not valid:
+      raise ParseError('Only variables and their subscripts can be assigned.')
+    return ident
+
+def build(start='start', engine='earley'):
+  '''Construct a dicelang parser for the grammar rule `start` using the
+  given parsing engine, which must be one of `ENGINES`.'''
+  if engine == 'earley':
+    out = lark.Lark(grammar.raw_text, start=start, parser='earley')
+  elif engine == 'lalr':
+    out = lark.Lark(
+      grammar.lalr_text,
+      start=start,
+      parser='lalr',
+      lexer='contextual',
+      transformer=LalrTreeFixer())
+  else:
+    raise ValueError(f'Unknown parsing engine: {engine!r}')
+  return out
+
+# Rules that only ever wrap one other node and mean nothing by themselves.
+# `priority` is not one of them, since it stands for parentheses.
+pass_through = frozenset({
+  'body', 'conditional', 'expression', 'import', 'deletable', 'assignment',
+  'subscript', 'keyword_expr', 'if_expr', 'repeat', 'bool_or', 'bool_xor',
+  'bool_and', 'bool_not', 'comp', 'arithm', 'term', 'factor', 'power',
+  'reduction', 'die', 'primary', 'slice', 'atom', 'tuple_literal',
+  'identifier',
+})
+
+def compact(tree):
+  '''Copy a syntax tree without its pass-through nodes, so that the literal
+  `3` is a single number_literal node rather than the bottom of a chain of
+  seventeen wrappers. The visitor and decompiler give the same results for
+  both forms of a tree.'''
+  if not isinstance(tree, Tree):
+    return tree
+  while tree.data in pass_through and len(tree.children) == 1:
+    child, = tree.children
+    if not isinstance(child, Tree):
+      break
+    tree = child
+  return Tree(tree.data, [compact(c) for c in tree.children], tree._meta)
+
+class TreeCache(object):
+  '''Bounded least-recently-used cache of syntax trees keyed by source
+  text, placed in front of a parser. Trees may be shared between callers
+  because nothing that walks them ever mutates them. If `compiler` is given,
+  trees are stored in the form it turns them into.'''
+  def __init__(self, parser, size=256, compiler=None):
+    self.parser = parser
+    self.compiler = compiler
+    self.size = size
+    self.trees = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+  
+  def __len__(self):
+    return len(self.trees)
+  
+  def normalize(self, source):
+    '''Surrounding whitespace never changes the parse, so ignore it.'''
+    return source.strip()
+  
+  def parse(self, source):
+    '''Get the tree for `source` from the cache, or parse and cache it.
+    Source that fails to parse is not cached, and is parsed as given so that
+    error positions refer to the caller's text.'''
+    key = self.normalize(source)
+    with self.lock:
+      tree = self.trees.get(key)
+      if tree is not None:
+        self.trees.move_to_end(key)
+        self.hits += 1
+        return tree
+      self.misses += 1
+    
+    tree = self.parser.parse(source)
+    if self.compiler is not None:
+      tree = self.compiler(tree)
+    if self.size > 0:
+      with self.lock:
+        self.trees[key] = tree
+        while len(self.trees) > self.size:
+          self.trees.popitem(last=False)
+    return tree
+  
+  def stats(self):
+    return {
+      'hits'   : self.hits,
+      'misses' : self.misses,
+      'size'   : len(self.trees),
+      'limit'  : self.size,
+    }
+  
+  def clear(self):
+    with self.lock:
+      self.trees.clear()
@@ -0,0 +1,228 @@
+import os
+import queue
+import pickle
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from dicelang import codec
+from dicelang.datastore import LAST
+from dicelang.datastore import Encoded
+from dicelang.exceptions import DicelangError
+from dicelang.exceptions import ExecutionTimeout
+from dicelang.interpreter import Interpreter
+
+timeout_msg = ' '.join([
+  'Dicelang command took too long! You may have chained too many dice',
+  'together, constructed an extremely large number, or just tried to do',
+  'too much at once.',
+])
+
+class WorkerError(DicelangError):
+  pass
+
+def pack_error(e):
+  '''Exceptions are sent between processes as their class, arguments and
+  attributes, since many of them, like lark's parse errors, cannot be
+  rebuilt by calling their class with their arguments. Attributes that
+  cannot be pickled are left out.'''
+  state = { }
+  for name, value in vars(e).items():
+    try:
+      pickle.dumps(value)
+    except Exception:
+      continue
+    state[name] = value
+  return type(e), e.args, state
+
+def unpack_error(cls, args, state):
+  out = cls.__new__(cls)
+  out.args = args
+  out.__dict__.update(state)
+  return out
+
+def serve(conn, parser, cache_size):
+  '''Main loop of a worker process. Each message names an Interpreter
+  method to call with some arguments, and carries the changes other workers
+  made since the last message. Results are sent back in the codec's format
+  along with the variables the call changed.'''
+  interpreter = Interpreter(parser, cache_size)
+  interpreter.visitor.execution_timeout = float('inf')
+  datastore = interpreter.datastore
+  conn.send('ready')
+  while True:
+    try:
+      message = conn.recv()
+    except EOFError:
+      break
+    if message is None:
+      break
+    method, args, forgotten, last = message
+    for owner_tag, key, mode in forgotten:
+      datastore.forget(owner_tag, key, mode)
+    for (owner_tag, mode), data in last:
+      datastore.remember_last(owner_tag, Encoded(data), mode)
+
+    datastore.committed = [ ]
+    try:
+      out = getattr(interpreter, method)(*args)
+      value = codec.encode(out[0]) if method == 'execute' else None
+      reply = ('ok', codec.encode(out), value)
+    except Exception as e:
+      reply = ('error', pack_error(e), None)
+    changed = [key for key in datastore.committed if key[1] != LAST]
+    conn.send(reply + (changed,))
+
+  datastore.persist_last()
+  datastore.commit()
+
+class Worker(object):
+  def __init__(self, context, parser, cache_size):
+    self.conn, child = context.Pipe()
+    self.process = context.Process(
+      target=serve,
+      args=(child, parser, cache_size),
+      daemon=True)
+    self.process.start()
+    child.close()
+    self.ready = False
+    self.forgotten = [ ]
+    self.last = { }
+
+  def wait_until_ready(self):
+    '''Building an interpreter takes a while, and should not count against
+    the time limit of the worker's first command.'''
+    if not self.ready:
+      self.conn.recv()
+      self.ready = True
+
+  def kill(self):
+    self.process.kill()
+    self.process.join()
+    self.conn.close()
+
+  def close(self, timeout):
+    try:
+      self.conn.send(None)
+    except (OSError, ValueError):
+      pass
+    self.process.join(timeout)
+    if self.process.is_alive():
+      self.process.kill()
+    self.conn.close()
+
+class ProcessPool(object):
+  '''Runs dicelang commands on a pool of worker processes, each with its
+  own interpreter, so that commands that keep the CPU busy run side by side
+  instead of taking turns under the GIL. It has the methods of an
+  Interpreter that the bot uses, so it can stand in for one.
+
+  Every worker writes its own changes to the database. When a command
+  changes variables, the other workers are told to forget their cached
+  copies before they run their next command, so that a command never sees
+  values older than those left by commands that finished before it began.
+  `_` is passed on to the other workers the same way.
+
+  A command running for more than `timeout` seconds is stopped by killing
+  its worker, which is then replaced. Its changes are never committed.'''
+  def __init__(self, size=None, parser='lalr', cache_size=256, timeout=36):
+    self.size = size or os.cpu_count() or 1
+    self.parser = parser
+    self.cache_size = cache_size
+    self.timeout = timeout
+    self.context = multiprocessing.get_context('spawn')
+    self.lock = threading.Lock()
+    self.workers = [self.start_worker() for _ in range(self.size)]
+    self.idle = queue.Queue()
+    for worker in self.workers:
+      self.idle.put(worker)
+    self.threads = ThreadPoolExecutor(
+      max_workers=self.size,
+      thread_name_prefix='dicelang-pool')
+    self.timeouts = 0
+
+  def start_worker(self):
+    return Worker(self.context, self.parser, self.cache_size)
+
+  def call(self, method, *args):
+    '''Call an Interpreter method on the next idle worker.'''
+    worker = self.idle.get()
+    try:
+      with self.lock:
+        forgotten, worker.forgotten = worker.forgotten, [ ]
+        last, worker.last = worker.last, { }
+      try:
+        worker.wait_until_ready()
+        worker.conn.send((method, args, forgotten, list(last.items())))
+        finished = worker.conn.poll(self.timeout)
+        reply = worker.conn.recv() if finished else None
+      except (EOFError, OSError) as e:
+        worker = self.replace(worker)
+        raise WorkerError(f'Dicelang worker failed: {e!s}')
+      if reply is None:
+        worker = self.replace(worker)
+        self.timeouts += 1
+        raise ExecutionTimeout(timeout_msg)
+    finally:
+      self.idle.put(worker)
+
+    status, out, extra, changed = reply
+    if method == 'execute' and status == 'ok':
+      command, user, server = args[:3]
+      self.spread(worker, changed, [
+        ((user, 'private'), extra),
+        ((server, 'server'), extra),
+        ((Interpreter.GLOBAL_ID, 'global'), extra)])
+    else:
+      self.spread(worker, changed, [ ])
+
+    if status == 'error':
+      raise unpack_error(*out)
+    return codec.decode(out)
+
+  def spread(self, source, changed, last):
+    '''Queue changes made by one worker for all of the others.'''
+    with self.lock:
+      for worker in self.workers:
+        if worker is not source:
+          worker.forgotten.extend(changed)
+          worker.last.update(last)
+
+  def replace(self, worker):
+    '''Kill a worker and start another in its place. The new worker has
+    nothing cached, so it needs none of the changes queued for the old
+    one.'''
+    worker.kill()
+    new = self.start_worker()
+    with self.lock:
+      self.workers[self.workers.index(worker)] = new
+    return new
+
+  def execute(self, command, user, server, max_steps=None):
+    return self.call('execute', command, user, server, max_steps)
+
+  def get_print_queue_on_error(self, error):
+    return getattr(error, 'printout', '')
+
+  def keys(self, mode, owner_id=Interpreter.GLOBAL_ID):
+    return self.call('keys', mode, owner_id)
+
+  def builtin_keys(self):
+    return self.call('builtin_keys')
+
+  async def call_async(self, function, *args):
+    '''Call `function(*args)` on one of the pool's threads, which wait on
+    the workers, and await the result.'''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.threads, function, *args)
+
+  async def execute_async(self, command, user, server, max_steps=None):
+    return await self.call_async(
+      self.execute, command, user, server, max_steps)
+
+  def close(self, timeout=5):
+    '''Stop every worker once it is idle, writing out the `_` values it
+    has not saved yet.'''
+    for _ in range(self.size):
+      self.idle.get().close(timeout)
+    self.threads.shutdown()
@@ -0,0 +1,136 @@
+import math
+from collections.abc import Sequence
+from numbers import Real
+from dicelang.exceptions import OperationError
+
+class Range(Sequence):
+  '''The list that `[a to b by c]` or `[a through b by c]` stands for,
+  without making it. The numbers are worked out when they are needed, so a
+  range of any length takes no more room than a short one. A range is
+  read like any other list, and compares equal to the list of its numbers,
+  but it cannot be changed. Wherever a list would be changed in place, the
+  range is replaced with a list first; see `mutable`.
+
+  The number at position `k` is `start + k * step`, rather than a sum of
+  `k` steps, so that float steps do not add up rounding errors.'''
+  def __init__(self, start, step, size):
+    self.start = start
+    self.step = step
+    self.size = size
+
+  @classmethod
+  def between(cls, closed, start, stop, step=1):
+    '''The numbers from start to stop by step. Step is always corrected to
+    the correct sign depending on whether start>stop or not. As such, the
+    sign of step does not matter. Closed is a boolean variable that
+    determines whether stop should be included in the range.'''
+    if not all(isinstance(x, Real) for x in (start, stop, step)):
+      raise OperationError('The ends and step of a range must be numbers.')
+    if start == stop:
+      return cls(start, 1, 1 if closed else 0)
+    if not step:
+      raise OperationError('The step of a range cannot be 0.')
+    step = abs(step) if start < stop else -abs(step)
+    if closed:
+      stop += step
+    size = max(math.ceil((stop - start) / step), 0)
+    # Division may round the size either way; the last number must be
+    # short of the stop and the next one must not be.
+    while size and not cls.before(start + (size - 1) * step, stop, step):
+      size -= 1
+    while cls.before(start + size * step, stop, step):
+      size += 1
+    return cls(start, step, size)
+
+  @staticmethod
+  def before(x, stop, step):
+    return x < stop if step > 0 else x > stop
+
+  def is_integral(self):
+    return isinstance(self.start, int) and isinstance(self.step, int)
+
+  def __len__(self):
+    return self.size
+
+  def at(self, k):
+    # The first number is the start itself, as when ranges were lists.
+    return self.start + k * self.step if k else self.start
+
+  def __getitem__(self, key):
+    # Indexes and slices of a range of positions mean the same as they do
+    # for a list.
+    try:
+      positions = range(self.size)[key]
+    except IndexError:
+      raise IndexError('list index out of range')
+    if isinstance(key, slice):
+      start = self.at(positions.start)
+      return Range(start, self.step * positions.step, len(positions))
+    return self.at(positions)
+
+  def __iter__(self):
+    if self.is_integral():
+      end = self.start + self.size * self.step
+      return iter(range(self.start, end, self.step))
+    return map(self.at, range(self.size))
+
+  def __reversed__(self):
+    return iter(self[::-1])
+
+  def __contains__(self, x):
+    if not isinstance(x, Real) or not self.size:
+      return False
+    if self.is_integral() and isinstance(x, int):
+      k, remainder = divmod(x - self.start, self.step)
+      return not remainder and 0 <= k < self.size
+    k = round((x - self.start) / self.step)
+    return 0 <= k < self.size and self.start + k * self.step == x
+
+  def __eq__(self, other):
+    if isinstance(other, Range):
+      # Ranges of more than one number are equal only if they start and
+      # step alike, which saves making either of them.
+      if self.size != other.size or self.size and self.start != other.start:
+        return False
+      return self.size < 2 or self.step == other.step
+    if isinstance(other, list):
+      return len(self) == len(other) and list(self) == list(other)
+    return NotImplemented
+
+  def __lt__(self, other):
+    return list(self) < mutable(other)
+
+  def __le__(self, other):
+    return list(self) <= mutable(other)
+
+  def __gt__(self, other):
+    return list(self) > mutable(other)
+
+  def __ge__(self, other):
+    return list(self) >= mutable(other)
+
+  __hash__ = None
+
+  def __add__(self, other):
+    return list(self) + mutable(other)
+
+  def __radd__(self, other):
+    return other + list(self)
+
+  def __mul__(self, times):
+    return list(self) * times
+
+  __rmul__ = __mul__
+
+  def __copy__(self):
+    return self
+
+  def __deepcopy__(self, memo):
+    return self
+
+  def __repr__(self):
+    return repr(list(self))
+
+def mutable(value):
+  '''A list of the numbers in a range, or any other value as it is.'''
+  return list(value) if isinstance(value, Range) else value
@@ -0,0 +1,145 @@
+import math
+import bisect
+import itertools
+from collections import Counter
+from numbers import Real
+from dicelang.exceptions import OperationError
+
+class RunningStats(object):
+  '''Count, sum, extremes, average and variance of a stream of numbers,
+  kept up to date one number at a time without holding on to any of them.
+  The variance is kept by Welford's method, which stays accurate when the
+  numbers are large and close together.'''
+  def __init__(self):
+    self.size = 0
+    self.sum = 0
+    self.average = 0.0
+    self.squares = 0.0
+    self.minimum = None
+    self.maximum = None
+
+  def add(self, x, count=1):
+    '''Count `x` as having come up `count` times.'''
+    if not isinstance(x, Real):
+      cls_name = x.__class__.__name__
+      raise OperationError(f'Cannot take statistics on {cls_name}.')
+    self.size += count
+    self.sum += x * count
+    delta = x - self.average
+    self.average += delta * count / self.size
+    self.squares += delta * (x - self.average) * count
+    if self.size == count:
+      self.minimum = self.maximum = x
+    elif x < self.minimum:
+      self.minimum = x
+    elif x > self.maximum:
+      self.maximum = x
+
+  def extend(self, counts):
+    '''Count each number in a dict as having come up as many times as it
+    maps to. This does what `add` does for each of them, without looking up
+    attributes or checking types one number at a time.'''
+    if not counts:
+      return
+    try:
+      math.fsum(counts)
+    except TypeError:
+      raise OperationError('Cannot take statistics on non-numbers.')
+    size, total = self.size, self.sum
+    average, squares = self.average, self.squares
+    for x, n in counts.items():
+      size += n
+      total += x * n
+      delta = x - average
+      average += delta * n / size
+      squares += delta * (x - average) * n
+    if self.size:
+      counts = [self.minimum, self.maximum, *counts]
+    self.minimum, self.maximum = min(counts), max(counts)
+    self.size, self.sum = size, total
+    self.average, self.squares = average, squares
+
+  def stddev(self):
+    return math.sqrt(self.squares / self.size) if self.size else 0.0
+
+  def error(self, z=1.96):
+    '''Half the width of the confidence interval of the average, by default
+    the 95% interval.'''
+    return z * self.stddev() / math.sqrt(self.size) if self.size else math.inf
+
+  def summary(self):
+    out = { }
+    # The sum is exact for whole numbers, where the running average is not.
+    out['average'] = self.sum / self.size if self.size else self.average
+    out['minimum'] = self.minimum
+    out['maximum'] = self.maximum
+    out['size'   ] = self.size
+    out['sum'    ] = self.sum
+    out['stddev' ] = self.stddev()
+    out['error'  ] = self.error()
+    return out
+
+def summarize(values):
+  '''The statistics `?` gives for some numbers, which may come from any
+  iterable, including one that makes them as it goes. They are counted in a
+  single pass, holding only each distinct number and how many times it came
+  up, and those are sorted once to find the median and quartiles.'''
+  try:
+    counts = Counter(values)
+  except TypeError:
+    raise OperationError('Cannot take statistics on non-numbers.')
+  if not counts:
+    raise OperationError('Cannot take statistics on nothing.')
+  stats = RunningStats()
+  stats.extend(counts)
+  q1, median, q3 = quartiles(Ranked(counts))
+  
+  out = { }
+  out['average'] = stats.sum / stats.size
+  out['minimum'] = stats.minimum
+  out['median' ] = median
+  out['maximum'] = stats.maximum
+  out['size'   ] = stats.size
+  out['sum'    ] = stats.sum
+  out['stddev' ] = stats.stddev()
+  out['q1'] = q1
+  out['q3'] = q3
+  return out
+
+def quartiles(ranked):
+  '''The first quartile, median and third quartile of some Ranked numbers.
+  The median of an even count of numbers is the average of the two in the
+  middle, and the quartiles are the medians of the numbers below and above
+  the median, or the median itself if there are none.'''
+  size = ranked.ends[-1]
+  median = ranked.median(0, size)
+  below = ranked.count_below(median)
+  above = size - ranked.count_below(median, inclusive=True)
+  q1 = ranked.median(0, below) if below else median
+  q3 = ranked.median(size - above) if above else median
+  return q1, median, q3
+
+class Ranked(object):
+  '''Numbers in sorted order, given by how many times each one came up.'''
+  def __init__(self, counts):
+    self.outcomes = sorted(counts)
+    self.ends = list(itertools.accumulate(counts[x] for x in self.outcomes))
+
+  def at(self, position):
+    '''The number at a position, counting from 0.'''
+    return self.outcomes[bisect.bisect_right(self.ends, position)]
+
+  def median(self, first, last=None):
+    '''Median of the numbers from position `first` up to before `last`,
+    or up to the end.'''
+    last = self.ends[-1] if last is None else last
+    middle = (first + last) // 2
+    if (last - first) % 2:
+      return self.at(middle)
+    return (self.at(middle - 1) + self.at(middle)) / 2
+
+  def count_below(self, x, inclusive=False):
+    '''How many numbers are less than `x`, or at most `x`.'''
+    find = bisect.bisect_right if inclusive else bisect.bisect_left
+    i = find(self.outcomes, x)
+    return self.ends[i - 1] if i else 0
@@ -0,0 +1,114 @@
+import itertools
+import contextlib
+from lark import Tree
+from dicelang import util
+from dicelang.alias import Alias
+from dicelang.function import Function
+from dicelang.undefined import Undefined
+from dicelang.compiler import is_constant
+from dicelang.running_stats import RunningStats
+from dicelang.exceptions import BreakError
+from dicelang.exceptions import SkipError
+from dicelang.exceptions import BreakSignal
+from dicelang.exceptions import SkipSignal
+from dicelang.exceptions import ReturnSignal
+from dicelang.exceptions import OperationError
+
+# With a margin given, the simulation may stop after any multiple of
+# `check_every` runs, once the 95% confidence interval of the average is
+# narrower than the margin on either side.
+check_every = 100
+
+def simulate(node, times, margin, visitor):
+  '''Evaluate a compiled syntax tree up to `times` times and summarize the
+  results as they come in, without keeping them. Small dice are drawn
+  ahead in batches while the simulation runs.'''
+  if not isinstance(times, int) or times < 1:
+    raise OperationError('A simulation must run a whole number of times.')
+  execution = visitor.execution.get()
+  previous, execution.dice = execution.dice, util.DiceBuffer()
+  stats = RunningStats()
+  try:
+    with contextlib.closing(samples(node, visitor)) as values:
+      for value in itertools.islice(values, times):
+        stats.add(value)
+        if margin is not None and stats.size % check_every == 0 \
+            and stats.error() <= margin:
+          break
+  finally:
+    execution.dice = previous
+  return stats.summary()
+
+def samples(node, visitor):
+  '''Endless values of a compiled syntax tree.'''
+  while isinstance(node, Tree) and node.data == 'priority':
+    node = node.children[0]
+  if is_constant_roll(node):
+    dice, sides, *count = [c.handler.value for c in node.operands[::2]]
+    mode = node.data.split('_')[-1]
+    count = count[0] if count else None
+    execution = visitor.execution.get()
+    return util.repeated_rolls(dice, sides, count, mode, execution)
+  function, arguments = callee(node, visitor)
+  if function is None:
+    return evaluations(node, visitor)
+  return calls(function, arguments, visitor)
+
+def is_constant_roll(node):
+  '''Whether a node sums a number of dice that never changes.'''
+  return isinstance(node, Tree) and node.data.startswith('scalar_die_') \
+    and all(map(is_constant, node.operands[::2])) \
+    and isinstance(node.operands[0].handler.value, int)
+
+def evaluations(node, visitor):
+  while True:
+    yield visitor.handle_instruction(node)
+
+def calls(function, arguments, visitor):
+  '''Endless results of calling a function, running its body in a single
+  stack frame, which gets new local variables before each run, instead of
+  pushing and popping a frame every time. The argument nodes are evaluated
+  for each run, so that a run which changes an argument in place does not
+  change it for the next one.'''
+  function.check_arguments(arguments)
+  if not function.compiled:
+    function.code = visitor.compile(function.code)
+    function.compiled = True
+  evaluate = lambda: [visitor.handle_instruction(a) for a in arguments]
+  scoping_data = visitor.scoping_data
+  scoping_data.push_function_call(function.marshal(evaluate()), function.closed)
+  frame = scoping_data.get_frame()
+  try:
+    while True:
+      try:
+        value = visitor.handle_instruction(function.code)
+      except ReturnSignal as rs:
+        value = rs.data
+      except BreakSignal:
+        raise BreakError()
+      except SkipSignal as ss:
+        raise SkipError(ss.msg)
+      frame[:] = [function.marshal(evaluate())]
+      yield value
+  finally:
+    scoping_data.pop_function_call()
+    function.this = Undefined
+
+def callee(node, visitor):
+  '''The function and argument nodes of an alias, or of a call of a
+  variable holding a function with constant arguments, or (None, None) for
+  any other node.'''
+  if not isinstance(node, Tree):
+    return None, None
+  if node.data == 'identifier_get':
+    value = node.handler(visitor, node.operands)
+    if isinstance(value, Alias):
+      return value.aliased, [ ]
+  elif node.data == 'function_call':
+    function, *arguments = node.operands
+    if isinstance(function, Tree) and function.data == 'identifier_get' \
+        and all(map(is_constant, arguments)):
+      value = function.handler(visitor, function.operands)
+      if isinstance(value, Function):
+        return value, arguments
+  return None, None
@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+'''Timing harness for the dicelang interpreter. Run it from this directory,
+like the tests, as `python benchmark.py [name ...]`. With no names given,
+every benchmark runs.'''
+import os
+import sys
+import time
+
+def load_commands(filename='data/lines.txt'):
+  '''Get the source of every test case, ignoring the expected results.'''
+  commands = [ ]
+  with open(filename, 'r') as f:
+    for line in f:
+      if line.strip():
+        commands.append(line.split('===>')[0].strip())
+  return commands
+
+def timed(operation, repeat=1):
+  '''Average wall-clock seconds taken by `operation()`.'''
+  start = time.perf_counter()
+  for _ in range(repeat):
+    operation()
+  return (time.perf_counter() - start) / repeat
+
+def bench_parse():
+  '''Parse time per command for each parsing engine, over the test corpus
+  and over one long script built from the whole corpus.'''
+  commands = load_commands()
+  script = ';\n'.join(c.rstrip(';') for c in commands)
+  for engine in parsing.ENGINES:
+    build = timed(lambda: parsing.build('start', engine))
+    parser = parsing.build('start', engine)
+    each = timed(lambda: [parser.parse(c) for c in commands]) / len(commands)
+    whole = timed(lambda: parser.parse(script))
+    print(f'{engine:>8}: build {build * 1000:9.3f} ms  '
+          f'per command {each * 1000:9.3f} ms  '
+          f'{len(commands)}-statement script {whole * 1000:9.3f} ms')
+
+def bench_tree_cache():
+  '''Parse time per command when the same macros are sent over and over,
+  with and without the tree cache in front of each engine.'''
+  from dicelang import parsing
+  macros = ['4d6h3 ^ 6', 'our stats = 4d6h3 ^ 6', '1d20 + 5', '?(3d6 ^ 100)']
+  commands = macros * 50
+  for engine in parsing.ENGINES:
+    parser = parsing.build('start', engine)
+    cache = parsing.TreeCache(parser)
+    bare = timed(lambda: [parser.parse(c) for c in commands]) / len(commands)
+    cached = timed(lambda: [cache.parse(c) for c in commands]) / len(commands)
+    print(f'{engine:>8}: uncached {bare * 1000:9.3f} ms  '
+          f'cached {cached * 1000:9.3f} ms  {cache.stats()}')
+
+loop_scripts = {
+  'for'     : 'x = 0; for i in [0 to 10000] do x = x + i * 2; x',
+  'while'   : 'begin i = 0; while i < 10000 do i = i + 1; i end',
+  'apply'   : '((n) -> n * n + 1) -: [0 to 10000]',
+  'repeat'  : '#(((x) -> if x > 3 then x else 0)(2d6) ^ 10000)',
+  'nested'  : 'for i in [0 to 100] do for j in [0 to 100] do i * j',
+  'constant': 'for i in [0 to 10000] do i + 2 ** 10 * [1 through 20][3]',
+  'storage' : 'our t = 0; for i in [0 to 1000] do our t = our t + i; our t',
+  'missing' : 'for i in [0 to 1000] do not_defined_anywhere',
+}
+
+def make_interpreter(parser='lalr'):
+  '''Interpreter using the fastest parser available, so that loop timings
+  are dominated by evaluation.'''
+  from dicelang.interpreter import Interpreter
+  return Interpreter(parser=parser)
+
+def bench_loops():
+  '''Execution time of loop-heavy scripts, excluding parse time.'''
+  interpreter = make_interpreter()
+  for name, script in loop_scripts.items():
+    interpreter.execute(script, 0, 0) # warm up the caches
+    elapsed = timed(lambda: interpreter.execute(script, 0, 0), repeat=3)
+    print(f'{name:>8}: {elapsed * 1000:9.3f} ms  {script}')
+
+step_scripts = {
+  'nodes'   : loop_scripts['for'],
+  'dice'    : '100000d6',
+  'power'   : 'begin x = 1.0001; x ** 100000 end',
+}
+
+def bench_steps():
+  '''Execution time and steps counted for scripts that visit many nodes,
+  roll many dice and multiply many times.'''
+  interpreter = make_interpreter()
+  for server, (name, script) in enumerate(step_scripts.items(), 1):
+    interpreter.execute(script, 0, server)
+    elapsed = timed(lambda: interpreter.execute(script, 0, server), repeat=3)
+    steps = interpreter.step_stats(server)['most']
+    rate = steps / elapsed / 1e6
+    print(f'{name:>6}: {elapsed * 1000:9.3f} ms {steps:>8} steps '
+      f'{rate:6.2f} M steps/s  {script}')
+
+def bench_dice(most=10**7):
+  '''Time to roll from one die up to `most` dice, summing all of them,
+  keeping the highest ten, and listing all of them.'''
+  from dicelang import util
+  from dicelang.execution import Execution
+  kinds = [
+    ('d6',    lambda n, e: util.roll(n, 6, None, 'all', True, e)),
+    ('d6h10', lambda n, e: util.roll(n, 6, 10, 'highest', True, e)),
+    ('r6',    lambda n, e: util.roll(n, 6, None, 'all', False, e)),
+  ]
+  print(f'{"dice":>9}' + ''.join(f'{name:>12}' for name, _ in kinds))
+  dice = 1
+  while dice <= most:
+    row = f'{dice:>9}'
+    for name, roll in kinds:
+      execution = Execution(None, float('inf'))
+      repeat = max(1, 10**4 // dice)
+      elapsed = timed(lambda: roll(dice, execution), repeat=repeat)
+      row += f'{elapsed * 1000:9.3f} ms'
+    print(row)
+    dice *= 10
+
+odds_expressions = ['4d6h3', '2d20h1 + 5', '10d6', '20d6h10', '(1d4)d8']
+
+def bench_odds(rolls=10**5):
+  '''Time to estimate a distribution with `?` over `rolls` rolls and to
+  work it out exactly with `??`.'''
+  interpreter = make_interpreter()
+  for expression in odds_expressions:
+    sampled = timed(lambda: interpreter.execute(
+      f'?(({expression}) ^ {rolls})', 0, 0))
+    exact = timed(lambda: interpreter.execute(f'??({expression})', 0, 0))
+    print(f'{expression:>16}: ? {sampled * 1000:9.3f} ms  '
+      f'?? {exact * 1000:9.3f} ms')
+
+stats_operands = ['1000000r6', '100000r1000000000', '[0 to 100000]',
+  '3d6 ^ 100000']
+
+def bench_stats():
+  '''Time taken by `?` on lists of rolls with few and with many distinct
+  values, on a range, and on the results of a repetition.'''
+  interpreter = make_interpreter()
+  for operand in stats_operands:
+    elapsed = timed(lambda: interpreter.execute(f'?({operand})', 0, 0))
+    print(f'{operand:>18}: {elapsed * 1000:9.3f} ms')
+
+range_scripts = {
+  'length'   : '#[0 to 1000000]',
+  'contains' : '999999 in [0 to 1000000]',
+  'index'    : '[0 to 1000000][500000]',
+  'break'    : 'for i in [0 to 1000000] do begin if i == 10 then break; i end',
+  'sum'      : '&[0 to 1000000]',
+}
+
+def bench_ranges():
+  '''Time taken by scripts that use part of a range of a million numbers,
+  and by one that uses all of it.'''
+  interpreter = make_interpreter()
+  for name, script in range_scripts.items():
+    elapsed = timed(lambda: interpreter.execute(script, 0, 0))
+    print(f'{name:>8}: {elapsed * 1000:9.3f} ms')
+
+scope_loop = ('begin t = 0; for i in [0 to 200] do begin '
+  + 'for j in [0 to 50] do {} end; t end')
+block_body = 'begin k = i * j; t = t + k end'
+scope_scripts = {
+  'block'    : scope_loop.format(block_body),
+  'function' : '(() -> ' + scope_loop.format(block_body) + ')()',
+  'closure'  : '(() -> begin n = 2; (() -> '
+    + scope_loop.format('t = t + n') + ')() end)()',
+  'server'   : 'our_n = 2; ' + scope_loop.format('t = t + our_n'),
+  'builtin'  : scope_loop.format('begin f = abs; t = t + 1 end'),
+}
+
+def bench_scopes():
+  '''Time taken by nested loops and blocks reading and assigning variables
+  of outer blocks, of a function, of its closure, of the server and
+  builtins.'''
+  interpreter = make_interpreter()
+  for name, script in scope_scripts.items():
+    elapsed = timed(lambda: interpreter.execute(script, 0, 0))
+    print(f'{name:>8}: {elapsed * 1000:9.3f} ms')
+
+# Outside of functions, only the innermost block is closed over, so each
+# loop runs in a function to close over `x`.
+closure_loop = '(() -> begin x = 10000r6; for i in [0 to 1000] do {} end)()'
+closure_scripts = {
+  'made'   : closure_loop.format('(() -> x)'),
+  'called' : closure_loop.format('(() -> i)()'),
+  'read'   : closure_loop.format('(() -> x)()'),
+  'changed': closure_loop.format('begin f = () -> x; x[0] = i end'),
+}
+
+def bench_closures():
+  '''Time taken by loops that make a function each time around which
+  closes over a large list, and call it, read the list through it, or
+  change the list after making it.'''
+  interpreter = make_interpreter()
+  for name, script in closure_scripts.items():
+    elapsed = timed(lambda: interpreter.execute(script, 0, 0))
+    print(f'{name:>8}: {elapsed * 1000:9.3f} ms')
+
+simulated_scripts = {
+  'dice'     : ('', '4d6h3'),
+  'sum'      : ('', '&3r6 + 1d20'),
+  'function' : ('f = (x) -> begin y = x * 1d6; y + 1d4 end; ', 'f(3)'),
+  'alias'    : ('a aliases () -> 2d20h1 + 5; ', 'a'),
+}
+
+def bench_simulation(runs=10**5):
+  '''Time to estimate the average of a roll from `runs` rolls with `?` on
+  a list of them and with `^?`, and with `^?` stopping once the average is
+  known to within 0.05.'''
+  interpreter = make_interpreter()
+  for name, (setup, roll) in simulated_scripts.items():
+    interpreter.execute(setup + '1', 0, 0)
+    listed = timed(lambda: interpreter.execute(f'?({roll} ^ {runs})', 0, 0))
+    streamed = timed(lambda: interpreter.execute(f'{roll} ^? {runs}', 0, 0))
+    stopped = timed(lambda: interpreter.execute(
+      f'{roll} ^? {runs} within 0.05', 0, 0))
+    print(f'{name:>8}: ? {listed * 1000:9.3f} ms  ^? {streamed * 1000:9.3f} ms'
+      f'  within {stopped * 1000:9.3f} ms')
+
+node_snippets = {
+  'number_literal'  : '3',
+  'string_literal'  : '"text"',
+  'boolean_literal' : 'True',
+  'identifier_get'  : 'begin x = 1; x; x; x; x end',
+  'addition'        : '1 + 2',
+  'multiplication'  : '2 * 3',
+  'comp_math'       : '1 < 2 <= 3',
+  'logical_and'     : 'True and False',
+  'inline_if'       : '1 if True else 2',
+  'scalar_die'      : '3d6',
+  'populated_list'  : '[1, 2, 3, 4]',
+  'sliced'          : '[1, 2, 3, 4][1]',
+  'populated_dict'  : '{"a": 1, "b": 2}',
+  'function_call'   : '((x) -> x)(1)',
+}
+
+def bench_nodes():
+  '''Time to evaluate small expressions, each dominated by one kind of node,
+  from a tree that has already been parsed and compiled.'''
+  from dicelang.ownership import ScopingData
+  interpreter = make_interpreter()
+  visitor = interpreter.visitor
+  for name, snippet in node_snippets.items():
+    tree = visitor.compile(interpreter.parser.parse(snippet))
+    evaluate = lambda: visitor.walk(tree, ScopingData(0, 0), True)
+    elapsed = timed(evaluate, repeat=2000)
+    print(f'{name:>16}: {elapsed * 1e6:9.2f} us  {snippet}')
+
+def count_nodes(tree):
+  '''Number of rule nodes in a syntax tree.'''
+  children = getattr(tree, 'children', None)
+  if children is None:
+    return 0
+  return 1 + sum(count_nodes(child) for child in children)
+
+def bench_visited():
+  '''Nodes in the syntax trees of the test corpus before and after removing
+  pass-through nodes, and how many of them are visited when executed.'''
+  from dicelang import parsing
+  interpreter = make_interpreter()
+  visitor = interpreter.visitor
+  handle_instruction = visitor.handle_instruction
+  visited = 0
+  def counting(tree):
+    nonlocal visited
+    visited += 1
+    return handle_instruction(tree)
+  visitor.handle_instruction = counting
+  
+  raw = compact = 0
+  for command in load_commands():
+    tree = interpreter.parser.parser.parse(command)
+    raw += count_nodes(tree)
+    compact += count_nodes(parsing.compact(tree))
+    try:
+      interpreter.execute(command, 0, 0)
+    except Exception:
+      pass
+  print(f'nodes parsed {raw}  after compaction {compact}  visited {visited}')
+
+def codec_values():
+  from dicelang.function import Function
+  from dicelang.alias import Alias
+  roll = Function('(n) -> begin r = 4d6h3 ^ n; if #r then r else [0] end')
+  return {
+    'int'      : 12345,
+    'string'   : 'a fairly ordinary string value ' * 4,
+    'list'     : list(range(1000)),
+    'nested'   : [
+      {'name': f'npc{i}', 'hp': (i, i * 2, [i])} for i in range(100)],
+    'function' : roll,
+    'alias'    : Alias(Function('() -> 1d20 + 5')),
+    'library'  : {f'f{i}': roll for i in range(20)},
+  }
+
+def bench_codec():
+  '''Round trips of stored values through the old repr/eval format and the
+  binary codec. Function sources are parsed again on every legacy load, so
+  the function parse cache is cleared to match a fresh database read.'''
+  from dicelang import codec
+  from dicelang.function import Function
+  def legacy(value):
+    Function.parser.clear()
+    return codec.legacy_loads(codec.legacy_dumps(value))
+  for name, value in codec_values().items():
+    old = timed(lambda: legacy(value), repeat=5)
+    new = timed(lambda: codec.loads(codec.dumps(value)), repeat=5)
+    old_size = len(codec.legacy_dumps(value))
+    new_size = len(codec.dumps(value))
+    print(f'{name:>9}: repr/eval {old * 1000:9.3f} ms {old_size:7} chars  '
+          f'codec {new * 1000:9.3f} ms {new_size:7} chars')
+
+def bench_writes():
+  '''Time for commands that change many variables at once, including
+  writing them to the database.'''
+  interpreter = make_interpreter()
+  for count in (1, 10, 100):
+    names = [f'our bench_{i}' for i in range(count)]
+    assign = '; '.join(f'{name} = {i}' for i, name in enumerate(names))
+    delete = 'del ' + ', '.join(names)
+    def operation():
+      interpreter.execute(assign, 0, 0)
+      interpreter.execute(delete, 0, 0)
+    elapsed = timed(operation, repeat=3)
+    print(f'{count:>5} variables: {elapsed * 1000:9.3f} ms to set and delete')
+
+def bench_last():
+  '''Database writes made by read-only rolls from many users, which only
+  change `_`.'''
+  from django.db import connection
+  interpreter = make_interpreter()
+  writes = [0]
+  def count_writes(execute, sql, params, many, context):
+    if sql.split(None, 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+      writes[0] += 1
+    return execute(sql, params, many, context)
+  
+  commands = 600
+  def operation():
+    for i in range(commands):
+      interpreter.execute('3d6 + 2', 1000 + i % 20, 2000 + i % 3)
+  with connection.execute_wrapper(count_writes):
+    elapsed = timed(operation)
+  print(f'{commands} rolls: {elapsed / commands * 1000:9.3f} ms per roll, '
+        f'{writes[0]} write queries')
+  print(f'`_` in memory: {interpreter.datastore.last_stats()}')
+
+def bench_cache():
+  '''Throughput of the variable cache when shared by several threads, with
+  more variables in use than it can hold, some far more often than others.'''
+  import random
+  import threading
+  from dicelang.cache import LruCache
+  cache = LruCache(max_entries=1000)
+  operations = 20000
+  def worker(seed):
+    rng = random.Random(seed)
+    for i in range(operations):
+      key = int(rng.paretovariate(0.5)) % 5000
+      if cache.get(seed, key, 'server') is None:
+        cache.put(seed, key, [key], 'server')
+  for count in (1, 4):
+    threads = [
+      threading.Thread(target=worker, args=(n,)) for n in range(count)]
+    def operation():
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    elapsed = timed(operation)
+    rate = count * operations / elapsed
+    print(f'{count} threads: {rate:12.0f} lookups/s  {cache.stats()}')
+
+def bench_preload():
+  '''Latency of a script reading many shared variables, the first time
+  they are used (cold) and afterwards (warm), with and without preloading
+  the server's variables.'''
+  interpreter = make_interpreter()
+  datastore = interpreter.datastore
+  count = 50
+  interpreter.execute(
+    '; '.join(f'our bench_{i} = [{i}]' for i in range(count)), 0, 0)
+  script = ' + '.join(f'our bench_{i}' for i in range(count))
+  for limit in (0, 256):
+    datastore.preload_limit = limit
+    datastore.cache.clear()
+    datastore.preloaded.clear()
+    cold = timed(lambda: interpreter.execute(script, 0, 0))
+    warm = timed(lambda: interpreter.execute(script, 0, 0), repeat=5)
+    print(f'preload limit {limit:>3}: cold {cold * 1000:9.3f} ms  '
+          f'warm {warm * 1000:9.3f} ms  ({count} variables)')
+  interpreter.execute(
+    'del ' + ', '.join(f'our bench_{i}' for i in range(count)), 0, 0)
+
+def bench_rows(count=10**6, per_owner=1000):
+  '''Listing and reading one owner's variables from a table of `count`
+  rows. The rows are added under unused owner ids and removed again.'''
+  from django.db import connection
+  from django.db import transaction
+  from dicelang import codec
+  from dicelang.datastore import DataStore
+  from atropos_db.models import Variable
+  def row(owner, name, value):
+    encoded = codec.encode(value)
+    return Variable(owner_id=owner, var_type='server', name=name,
+      value=encoded, size=len(encoded))
+  
+  first = 10**12
+  owners = range(first, first + count // per_owner)
+  rows = Variable.objects.filter(owner_id__gte=first)
+  start = time.perf_counter()
+  with transaction.atomic():
+    batch = [ ]
+    for owner in owners:
+      for i in range(per_owner):
+        batch.append(row(owner, f'v{i}', [i, f'name {i}']))
+      if len(batch) >= 50000:
+        Variable.objects.bulk_create(batch)
+        batch = [ ]
+    Variable.objects.bulk_create(batch)
+  print(f'inserted {count} rows in {time.perf_counter() - start:.1f} s')
+  
+  try:
+    datastore = DataStore()
+    owner = owners[len(owners) // 2]
+    listing = timed(lambda: datastore.view('server', owner), repeat=5)
+    print(f'view {per_owner} names: {listing * 1000:9.3f} ms')
+    def read():
+      datastore.cache.drop(owner, 'v500', 'server')
+      datastore.get(owner, 'v500', 'server')
+    print(f'read one value: {timed(read, repeat=20) * 1000:9.3f} ms')
+    with connection.cursor() as cursor:
+      cursor.execute(
+        'EXPLAIN QUERY PLAN SELECT name FROM atropos_db_variable '
+        'WHERE var_type = %s AND owner_id = %s', ['server', owner])
+      print('plan:', '; '.join(str(r[-1]) for r in cursor.fetchall()))
+  finally:
+    with transaction.atomic():
+      rows.delete()
+
+def bench_messages(count=200):
+  '''Simulated message load: `count` concurrent commands from different
+  users, one in ten of them a heavy roll. Reports how long the event loop
+  went without being able to run anything else, with commands evaluated
+  on the loop itself and, where available, on the interpreter's worker.'''
+  import asyncio
+  interpreter = make_interpreter()
+  commands = [
+    '#(3d6 ^ 5000)' if i % 10 == 0 else f'1d20 + {i}' for i in range(count)]
+  
+  async def blocking(command, user):
+    # Django refuses to query from an event loop unless told not to.
+    os.environ['DJANGO_ALLOW_ASYNC_UNSAFE'] = 'true'
+    try:
+      return interpreter.execute(command, user, 0)
+    finally:
+      del os.environ['DJANGO_ALLOW_ASYNC_UNSAFE']
+  
+  async def heartbeat(done, gaps):
+    last = time.perf_counter()
+    while not done.is_set():
+      await asyncio.sleep(0.001)
+      now = time.perf_counter()
+      gaps.append(now - last)
+      last = now
+  
+  async def load(handler):
+    done, gaps = asyncio.Event(), [ ]
+    beat = asyncio.ensure_future(heartbeat(done, gaps))
+    start = time.perf_counter()
+    await asyncio.gather(*[
+      handler(command, 5000 + i) for i, command in enumerate(commands)])
+    elapsed = time.perf_counter() - start
+    done.set()
+    await beat
+    gaps.sort()
+    return elapsed, gaps[len(gaps) // 2], gaps[-1]
+  
+  handlers = {
+    'blocking' : blocking,
+    'worker'   : lambda command, user: interpreter.execute_async(
+      command, user, 0),
+  }
+  for i, command in enumerate(commands): # warm up the caches
+    interpreter.execute(command, 5000 + i, 0)
+  for name, handler in handlers.items():
+    elapsed, median, longest = asyncio.run(load(handler))
+    print(f'{name:>8}: {count / elapsed:7.1f} commands/s  loop stalls: '
+          f'median {median * 1000:7.3f} ms  max {longest * 1000:9.3f} ms')
+
+def bench_pool(count=64):
+  '''Throughput of CPU-bound commands on one interpreter and on process
+  pools of increasing size, with as many commands in flight as there are
+  workers. Worker startup is not timed.'''
+  from concurrent.futures import ThreadPoolExecutor
+  from dicelang.pool import ProcessPool
+  command = '#(3d6 ^ 20000)'
+  cores = os.cpu_count() or 1
+  interpreter = make_interpreter()
+  elapsed = timed(lambda: [
+    interpreter.execute(command, 0, 0) for _ in range(count)])
+  print(f'{cores} cores')
+  print(f'interpreter: {count / elapsed:7.1f} commands/s')
+  for size in sorted({1, 2, 4, cores}):
+    pool = ProcessPool(size=size)
+    try:
+      with ThreadPoolExecutor(max_workers=size) as threads:
+        # Make sure every worker has started before timing.
+        list(threads.map(pool.execute, ['1'] * size, [0] * size, [0] * size))
+        def operation():
+          list(threads.map(
+            pool.execute, [command] * count, [0] * count, [0] * count))
+        elapsed = timed(operation)
+    finally:
+      pool.close()
+    print(f'{size:>3} workers: {count / elapsed:7.1f} commands/s')
+
+benchmarks = {
+  'parse': bench_parse,
+  'tree_cache': bench_tree_cache,
+  'loops': bench_loops,
+  'steps': bench_steps,
+  'dice': bench_dice,
+  'odds': bench_odds,
+  'simulation': bench_simulation,
+  'stats': bench_stats,
+  'ranges': bench_ranges,
+  'closures': bench_closures,
+  'scopes': bench_scopes,
+  'nodes': bench_nodes,
+  'visited': bench_visited,
+  'codec': bench_codec,
+  'writes': bench_writes,
+  'last': bench_last,
+  'cache': bench_cache,
+  'preload': bench_preload,
+  'messages': bench_messages,
+}
+
+# Takes minutes, so it only runs when named.
+slow_benchmarks = {
+  'rows': bench_rows,
+  'pool': bench_pool,
+}
+
+if __name__ == '__main__':
+  for name in sys.argv[1:] or list(benchmarks):
+    print(f'== {name} ==')
+    benchmarks.get(name, slow_benchmarks.get(name))()
@@ -1,7 +1,33 @@
+import math
+import marshal
+import asyncio
+import itertools
+import statistics
+import threading
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from lark import Tree
+from dicelang import codec
+from dicelang import parsing
+from dicelang.cache import LruCache
+from dicelang.datastore import Encoded
+from dicelang.pool import ProcessPool
+from dicelang import visitor
+from dicelang.ownership import ScopingData
+from dicelang.compiler import is_constant
 from dicelang.interpreter import Interpreter
 from dicelang.function    import Function
+from dicelang.alias       import Alias
 from dicelang.undefined   import Undefined
+from dicelang.ranges      import Range
+from dicelang.exceptions  import BreakError
+from dicelang.exceptions  import DicelangError
+from dicelang.exceptions  import ExecutionTimeout
+from dicelang.exceptions  import StepLimitExceeded
+from dicelang.exceptions  import StorageError
+from dicelang.exceptions  import WhileLoopTimeout
+from dicelang.exceptions  import DoWhileLoopTimeout
 Skip = object
 files_to_test = ['block_comment.txt', 'comment_lines.txt']
 user = 10 
@@ -31,3 +57,553 @@ class TestInterpreter:
     print(actual)
     assert predicate
 
+  def test_deferred_writes(self):
+    datastore = TestInterpreter.interpreter.datastore
+    value = [1, [2]]
+    returned = datastore.put(server, 'deferred', value, 'server')
+    assert returned == value and returned[1] is not value[1]
+    assert datastore.get(server, 'deferred', 'server') is value
+    assert datastore.commit() == 1
+    datastore.cache.drop(server, 'deferred', 'server')
+    assert datastore.get(server, 'deferred', 'server') == value
+    assert datastore.drop(server, 'deferred', 'server') == value
+    assert datastore.get(server, 'deferred', 'server') is None
+    datastore.commit()
+
+  def test_failed_command_rolls_back(self):
+    interpreter = TestInterpreter.interpreter
+    interpreter.execute('our kept = [1]; our gone = 1; del our gone', user,
+      server)
+    failing = 'our kept[0] = 2; our gone = 2; our new = 3; break'
+    with pytest.raises(BreakError):
+      interpreter.execute(failing, user, server)
+    expected = {'kept': [1], 'gone': Undefined, 'new': Undefined}
+    for name, value in expected.items():
+      assert interpreter.execute(f'our {name}', user, server)[0] == value
+    interpreter.execute('del our kept', user, server)
+
+  def test_missing_variables_cached(self):
+    datastore = TestInterpreter.interpreter.datastore
+    with CaptureQueriesContext(connection) as queries:
+      assert datastore.get(server, 'never_set', 'server') is None
+      assert datastore.get(server, 'never_set', 'server') is None
+      assert len(queries) == 1
+      datastore.put(server, 'never_set', None, 'server')
+      assert datastore.get(server, 'never_set', 'server') is None
+      datastore.put(server, 'never_set', 5, 'server')
+      assert datastore.get(server, 'never_set', 'server') == 5
+      datastore.drop(server, 'never_set', 'server')
+      assert datastore.get(server, 'never_set', 'server') is None
+      assert len(queries) == 1
+    datastore.commit()
+
+  def test_preload(self):
+    datastore = TestInterpreter.interpreter.datastore
+    owner = 12
+    for i in range(3):
+      datastore.put(owner, f'preloaded_{i}', [i], 'server')
+    datastore.commit()
+    datastore.cache.clear()
+    datastore.preload_limit = 2
+    try:
+      assert datastore.preload((owner, 'server')) == 2
+      assert datastore.preload((owner, 'server')) == 0
+      datastore.preloaded.clear()
+      datastore.preload_limit = 256
+      assert datastore.preload((owner, 'server'), (owner, 'private')) == 1
+      encoded = datastore.cache.get(owner, 'preloaded_0', 'server')
+      assert isinstance(encoded, Encoded)
+      with CaptureQueriesContext(connection) as queries:
+        for i in range(3):
+          assert datastore.get(owner, f'preloaded_{i}', 'server') == [i]
+        assert len(queries) == 0
+    finally:
+      for i in range(3):
+        datastore.drop(owner, f'preloaded_{i}', 'server')
+      datastore.commit()
+
+  def test_view_sizes(self):
+    datastore = TestInterpreter.interpreter.datastore
+    owner = 13
+    datastore.put(owner, 'stored', [1, 2], 'server')
+    datastore.commit()
+    datastore.put(owner, 'pending', 'text', 'server')
+    listing = dict(datastore.view('server', owner, sizes=True))
+    assert listing == {
+      'stored': len(codec.encode([1, 2])),
+      'pending': len(codec.encode('text'))}
+    assert datastore.view('server', owner) == ['stored', 'pending']
+    datastore.drop(owner, 'stored', 'server')
+    datastore.drop(owner, 'pending', 'server')
+    datastore.commit()
+    assert datastore.view('server', owner) == [ ]
+
+  def test_concurrent_messages(self):
+    '''Short commands are answered while a long one is still running.'''
+    interpreter = TestInterpreter.interpreter
+    release = threading.Event()
+    def long_command():
+      # Runs until every short command has been answered.
+      if not release.wait(30):
+        raise TimeoutError('Short commands were held up.')
+      return interpreter.execute('#(3d6 ^ 30000)', user, server)
+    
+    async def messages():
+      heavy = asyncio.ensure_future(interpreter.call_async(long_command))
+      light = await asyncio.gather(*[
+        interpreter.execute_async(f'{i} + 1', user + i, server)
+        for i in range(50)])
+      overlapped = not heavy.done()
+      release.set()
+      return await heavy, light, overlapped
+    
+    heavy, light, overlapped = asyncio.run(messages())
+    assert overlapped
+    assert heavy == (30000, '')
+    assert [value for value, _ in light] == list(range(1, 51))
+
+  def test_repr_threads(self):
+    f = Function('(x) -> x + 1')
+    with Function.SerializableRepr():
+      serialized = repr([f, f])
+    shown = repr([f, f])
+    bad = [ ]
+    def show(serializing):
+      for _ in range(20000):
+        if serializing:
+          with Function.SerializableRepr():
+            out, expected = repr([f, f]), serialized
+        else:
+          out, expected = repr([f, f]), shown
+        if out != expected:
+          bad.append(out)
+    threads = [threading.Thread(target=show, args=(s,)) for s in (True, False)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    assert not bad
+    
+    # Showing an alias does not end serialization of the rest of a value.
+    alias = Alias(Function('() -> 1'))
+    assert codec.legacy_dumps([alias, f]).count('Function(') == 2
+  
+  def test_process_pool(self):
+    pool = ProcessPool(size=2, timeout=2)
+    try:
+      # Workers take turns, so each command runs on the other worker.
+      assert pool.execute('our pooled = [1]; 3', user, server) == (3, '')
+      assert pool.execute('our pooled', user, server) == ([1], '')
+      pool.execute('our pooled[0] = 5', user, server)
+      assert pool.execute('our pooled', user, server) == ([5], '')
+      assert pool.execute('_ + my _', user, server) == ([5, 5], '')
+      with pytest.raises(BreakError) as failed:
+        pool.execute('print("out"); break', user, server)
+      assert pool.get_print_queue_on_error(failed.value) == 'out '
+      with pytest.raises(ExecutionTimeout):
+        pool.execute('begin i = 0; while True do i = i + 1 end', user, server)
+      assert pool.execute('del our pooled', user, server) == ([5], '')
+      assert pool.execute('our pooled', user, server) == (Undefined, '')
+      assert pool.execute('6 * 9', user, server) == (54, '')
+    finally:
+      pool.close()
+    # Workers write out `_` when the pool is closed.
+    assert Interpreter().execute('my _', user, server)[0] == 54
+  
+  def test_workers_commit_at_once(self):
+    '''Workers writing to the database at the same time wait their turn.'''
+    pool = ProcessPool(size=2, timeout=30)
+    errors = [ ]
+    def run(k):
+      for i in range(20):
+        try:
+          pool.execute(f'our racing_{k}_{i % 4} = [0 to 200]; 0', user, server)
+        except Exception as e:
+          errors.append(e)
+    try:
+      threads = [threading.Thread(target=run, args=(k,)) for k in range(2)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      assert errors == [ ]
+      for k, i in itertools.product(range(2), range(4)):
+        assert pool.execute(f'del our racing_{k}_{i}', user, server)[0]
+    finally:
+      pool.close()
+  
+  def test_close_writes_last(self):
+    closing = Interpreter()
+    closing.execute('6 * 8', user, server)
+    closing.close()
+    assert closing.datastore.last_stats()['dirty'] == 0
+    assert Interpreter().execute('my _', user, server)[0] == 48
+
+  def test_dice(self):
+    interpreter = TestInterpreter.interpreter
+    def run(command):
+      return interpreter.execute(command, user, server)[0]
+    assert run('1000d6h10') == 60
+    assert run('1000r6l10') == [1] * 10
+    assert len(run('100r6l200')) == 100
+    assert 100000 <= run('100000d6') <= 600000
+    assert run('100000d1') == 100000
+    rolls = run('100000r20')
+    assert len(rolls) == 100000 and set(rolls) == set(range(1, 21))
+    rolls = run('5r(10 ** 30)')
+    assert len(rolls) == 5 and all(1 <= x <= 10**30 for x in rolls)
+    kept = run('1000r300h600')
+    assert len(kept) == 600 and kept == sorted(kept, reverse=True)
+    
+  def test_stats(self):
+    '''`?` gives what the statistics module gives for lists of numbers.'''
+    interpreter = TestInterpreter.interpreter
+    for size in [1, 2, 3, 10, 25]:
+      for rolls in ['2', '100', '1000000']:
+        values = interpreter.execute(f'{size}r{rolls}', user, server)[0]
+        stats = interpreter.execute(f'?{values}', user, server)[0]
+        median = statistics.median(values)
+        lower = [x for x in values if x < median] or [median]
+        upper = [x for x in values if x > median] or [median]
+        assert stats == pytest.approx({
+          'average' : statistics.mean(values),
+          'minimum' : min(values),
+          'median'  : median,
+          'maximum' : max(values),
+          'size'    : len(values),
+          'sum'     : sum(values),
+          'stddev'  : statistics.pstdev(values),
+          'q1'      : statistics.median(lower),
+          'q3'      : statistics.median(upper),
+        })
+    for command in ['?[]', '?["a"]', '?[[1]]']:
+      with pytest.raises(DicelangError):
+        interpreter.execute(command, user, server)
+  
+  def test_closures(self):
+    interpreter = TestInterpreter.interpreter
+    run = lambda command: interpreter.execute(command, user, server)[0]
+    run('closure_f = begin a = [1, 2]; f = () -> a; a[0] = 3; f end')
+    assert run('closure_f()') == [1, 2]
+    assert run('begin a = [1]; x = (() -> a)(); x[0] = 5; a end') == [1]
+    run('closure_g = begin a = [1]; () -> begin a[0] = a[0] + 1; a[0] end end')
+    assert run('[closure_g(), closure_g()]') == [2, 3]
+    run('del closure_f; del closure_g')
+    # A stored function keeps its values once its command is over.
+    run('our closure_l = [1, 2]')
+    run('begin a = our closure_l; f = () -> a; our closure_h = f; 0 end')
+    run('our closure_l[0] = 99')
+    assert run('our closure_h()') == [1, 2]
+    interpreter.datastore.cache.clear()
+    assert run('our closure_h()') == [1, 2]
+    run('del our closure_l; del our closure_h')
+  
+  def test_ranges(self):
+    interpreter = TestInterpreter.interpreter
+    run = lambda command: interpreter.execute(command, user, server)[0]
+    command = 'for i in [0 to 10**12] do begin if i == 3 then break; i end'
+    assert run(command) == [0, 1, 2]
+    assert run('[10**12 through 0 by 4][::-1][:3]') == [0, 4, 8]
+    assert run('5 in [1 to 10 by 2] and not 4 in [1 to 10 by 2]')
+    assert run('0.5 in [0 thru 1 by 0.25] and not 0.6 in [0 thru 1 by 0.25]')
+    assert run('range_var = [0 to 5]; del range_var[0]; range_var') == [1, 2, 3, 4]
+    assert run('range_var') == [1, 2, 3, 4]
+    with pytest.raises(DicelangError):
+      run('[0 to 5 by 0]')
+  
+  def test_odds(self):
+    '''Exact odds agree with counting every way the dice can fall.'''
+    interpreter = TestInterpreter.interpreter
+    def brute(dice, sides, keep, highest):
+      outcomes = { }
+      for faces in itertools.product(range(1, sides + 1), repeat=dice):
+        kept = sorted(faces, reverse=highest)[:keep]
+        outcomes[sum(kept)] = outcomes.get(sum(kept), 0) + 1
+      return {k: v / sides ** dice for k, v in outcomes.items()}
+    for dice, sides, keep, highest in [(4, 6, 3, True), (3, 6, 2, False),
+        (5, 4, 2, True), (3, 5, 0, True), (3, 4, 3, False)]:
+      mode = 'h' if highest else 'l'
+      command = f'??({dice}d{sides}{mode}{keep})'
+      odds = interpreter.execute(command, user, server)[0]
+      expected = brute(dice, sides, keep, highest)
+      assert odds['histogram'].keys() == expected.keys()
+      for total, chance in expected.items():
+        assert odds['histogram'][total] == pytest.approx(chance)
+    
+    odds = interpreter.execute('??((1d3)d4 * 2 - 1)', user, server)[0]
+    assert odds['average'] == pytest.approx(2 * 2 * 2.5 - 1)
+    assert odds['minimum'] == 1 and odds['maximum'] == 23
+    with pytest.raises(DicelangError):
+      interpreter.execute('??(1d6 + @[1, 2])', user, server)
+    
+    # The median and quartiles are those `?` gives for every way to roll.
+    for roll, rolls in [('-1d6', '[-6 through -1]'),
+        ('2d4', '[2, 3, 3, 4, 4, 4, 5, 5, 5, 5, 6, 6, 6, 7, 7, 8]'),
+        ('1d2 * 1d3', '[1, 2, 3, 2, 4, 6]')]:
+      odds = interpreter.execute(f'??({roll})', user, server)[0]
+      stats = interpreter.execute(f'?{rolls}', user, server)[0]
+      for key in ('median', 'q1', 'q3'):
+        assert odds[key] == stats[key]
+    # Dividing by zero gives what it does outside of `??`.
+    for operator in ['/', '//']:
+      command = f'??(1d6 {operator} (1d2 - 1))'
+      odds = interpreter.execute(command, user, server)[0]
+      assert odds['histogram'][float('inf')] == 0.5
+    odds = interpreter.execute('??(1d6 % (1d2 - 1))', user, server)[0]
+    assert sorted(map(math.isnan, odds['histogram'])) == [False, True]
+    odds = interpreter.execute('??(1d1000000)', user, server)[0]
+    assert len(odds['histogram']) == 1000
+    assert odds['histogram'][1001] == pytest.approx(0.001)
+    
+  def test_simulation(self):
+    interpreter = TestInterpreter.interpreter
+    run = lambda command: interpreter.execute(command, user, server)[0]
+    stats = run('4d6h3 ^? 20000')
+    assert stats['size'] == 20000 and 3 <= stats['minimum'] <= 18
+    assert stats['average'] == pytest.approx(12.2446, abs=0.15)
+    assert stats['error'] == pytest.approx(0.04, abs=0.01)
+    stats = run('(1d20 + 5 >= 15) ^? 100000 within 0.01')
+    assert stats['size'] < 100000 and stats['error'] <= 0.01
+    assert stats['average'] == pytest.approx(0.55, abs=0.03)
+    
+    # Calls share one stack frame, but each gets its own local variables.
+    run('sim_add = (x) -> begin x = x + 1d1; y = y + 1 if y else 1; x + y end')
+    assert run('sim_add(1) ^? 50') == run('sim_add(1) ^? 50')
+    assert run('(sim_add(1) ^? 50)["maximum"]') == 3
+    run('sim_inc = (x) -> begin x[0] = x[0] + 1; x[0] end')
+    assert run('(sim_inc([0]) ^? 20)["maximum"]') == 1
+    run('sim_alias aliases () -> begin z = 1d6; return z * 2; 0 end')
+    assert run('(sim_alias ^? 1000)["maximum"]') == 12
+    run('(sim_add(1) ^? 1000 within 10)["size"]; sim_after = 7')
+    assert run('sim_after') == 7
+    run('del sim_add; del sim_inc; del sim_alias; del sim_after')
+    for command in ['3 ^? 0', '3 ^? 1.5', '"a" ^? 3', '[1] ^? 3']:
+      with pytest.raises(DicelangError):
+        run(command)
+    
+  def test_step_limit(self):
+    interpreter = TestInterpreter.interpreter
+    before = interpreter.step_stats(server)
+    assert interpreter.execute('1 + 2', user, server, 10) == (3, '')
+    for command in ['for i in [0 to 1000] do i', '1000d6',
+        'begin x = 2; x ** 1000 end']:
+      with pytest.raises(StepLimitExceeded):
+        interpreter.execute(command, user, server, 500)
+      assert interpreter.execute(command, user, server, 5000)
+    after = interpreter.step_stats(server)
+    assert after['commands'] == before['commands'] + 7
+    assert after['most'] >= 1000
+    assert interpreter.step_stats(-12345)['commands'] == 0
+    
+  def test_loop_timeouts(self):
+    interpreter = TestInterpreter.interpreter
+    loop_timeout = interpreter.visitor.loop_timeout
+    interpreter.visitor.loop_timeout = 0.05
+    try:
+      for command, error in [
+          ('while True do 1', WhileLoopTimeout),
+          ('do 1 while True', DoWhileLoopTimeout),
+          ('do (while True do 1) while True', WhileLoopTimeout),
+          ('while True do 1000r6', WhileLoopTimeout)]:
+        with pytest.raises(error):
+          interpreter.execute(command, user, server)
+      with pytest.raises(StepLimitExceeded):
+        interpreter.execute('while True do 1', user, server, 5000)
+    finally:
+      interpreter.visitor.loop_timeout = loop_timeout
+    
+  def stress_command(self, k, i):
+    '''A command for stress tests, with the result and printout it should
+    give, that fails every fifth time.'''
+    n = 50 + k * 10
+    command = (f'print({k}); our stress_f({k}) + '
+      f'(begin s = 0; for j in [0 to {n}] do s = s + j; s end)')
+    if i % 5 == 4:
+      return command + '; break', None, f'{k} '
+    return command, (2 * k + n * (n - 1) // 2, f'{k} '), None
+
+  def check_stress(self, k, i, run):
+    interpreter = TestInterpreter.interpreter
+    command, expected, printout = self.stress_command(k, i)
+    if expected is not None:
+      assert run(command, 100 + k) == expected
+      assert interpreter.execute(f'my stress_{i}', 100 + k, server)[0] == i
+      return
+    with pytest.raises(BreakError) as failed:
+      run(command, 100 + k)
+    assert interpreter.get_print_queue_on_error(failed.value) == printout
+
+  def test_threads_share_interpreter(self):
+    interpreter = TestInterpreter.interpreter
+    interpreter.execute('our stress_f = (x) -> x * 2', user, server)
+    def run(command, who):
+      return interpreter.execute(command, who, server)
+    errors = [ ]
+    def thread(k):
+      try:
+        for i in range(10):
+          interpreter.execute(f'my stress_{i} = {i}', 100 + k, server)
+          self.check_stress(k, i, run)
+      except Exception as e:
+        errors.append(e)
+    threads = [threading.Thread(target=thread, args=(k,)) for k in range(8)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    assert errors == [ ]
+
+  def test_tasks_share_interpreter(self):
+    interpreter = TestInterpreter.interpreter
+    interpreter.execute('our stress_f = (x) -> x * 2', user, server)
+    async def task(k):
+      for i in range(10):
+        await interpreter.execute_async(f'my stress_{i} = {i}', 100 + k, server)
+        command, expected, printout = self.stress_command(k, i)
+        if expected is not None:
+          result = await interpreter.execute_async(command, 100 + k, server)
+          assert result == expected
+        else:
+          with pytest.raises(BreakError) as failed:
+            await interpreter.execute_async(command, 100 + k, server)
+          assert interpreter.get_print_queue_on_error(failed.value) == printout
+    async def tasks():
+      await asyncio.gather(*[task(k) for k in range(8)])
+    asyncio.run(tasks())
+
+  def test_last_value_in_memory(self):
+    interpreter = TestInterpreter.interpreter
+    datastore = interpreter.datastore
+    writes = datastore.last_stats()['writes']
+    interpreter.execute('6 * 7', user, server)
+    assert interpreter.execute('_ + my _ + global _', user, server)[0] == 126
+    assert datastore.last_stats()['writes'] == writes
+    with pytest.raises(BreakError):
+      interpreter.execute('our _ = 1; break', user, server)
+    assert interpreter.execute('our _', user, server)[0] == 126
+    datastore.persist_last()
+    datastore.commit()
+    datastore.last.clear()
+    assert interpreter.execute('global _', user, server)[0] == 126
+
+  def test_variable_cache(self):
+    cache = LruCache(max_entries=2)
+    cache.put(1, 'a', [1], 'private')
+    cache.put(1, 'b', 2, 'server')
+    cache.put(0, 'lib', {'x': 3}, 'core')
+    assert cache.get(1, 'a', 'private') == [1]
+    cache.put(1, 'c', 3, 'server')
+    assert cache.get(1, 'b', 'server') is None
+    assert cache.get(0, 'lib', 'core') == {'x': 3}
+    stats = cache.stats()
+    assert (stats['evictions'], stats['entries'], stats['pinned']) == (1, 2, 1)
+    assert cache.drop(1, 'a', 'private') == [1]
+    small = LruCache(max_bytes=1000)
+    small.put(1, 'big', list(range(1000)), 'private')
+    assert small.stats()['bytes'] == 0 and len(small) == 0
+
+
+class TestParser:
+  earley = parsing.build('start', 'earley')
+  lalr = parsing.build('start', 'lalr')
+
+  @pytest.mark.parametrize("command, expected", get_lines('data/lines.txt'))
+  def test_lalr_matches_earley(self, command, expected):
+    assert TestParser.lalr.parse(command) == TestParser.earley.parse(command)
+
+  def test_tree_cache(self):
+    cache = parsing.TreeCache(TestParser.lalr, size=2)
+    tree = cache.parse('4d6h3 ^ 6')
+    assert cache.parse('  4d6h3 ^ 6\n') is tree
+    cache.parse('1')
+    cache.parse('2')
+    assert cache.stats() == {'hits': 1, 'misses': 3, 'size': 2, 'limit': 2}
+    assert cache.parse('4d6h3 ^ 6') is not tree
+  
+  def test_function_parser(self):
+    '''Interpreters using other engines leave the functions' parser alone.'''
+    parser = Function.parser
+    Interpreter(parser='lalr')
+    assert Function.parser is parser
+    lalr = parsing.TreeCache(
+      parsing.build('function', 'lalr'), compiler=parsing.compact)
+    source = '(x, y) -> begin z = x; z + y end'
+    assert Function(source, parser=lalr) == Function(source)
+    assert lalr.stats()['misses'] == 1
+
+  def test_compiled_tree(self):
+    visitor = TestInterpreter.interpreter.visitor
+    decompile = Function.deparser.decompile
+    tree = TestParser.lalr.parse('f = (x, y) -> begin x + y; [x, y] end')
+    compiled = visitor.compile(tree)
+    assert compiled == tree
+    assert visitor.compile(compiled) is compiled
+    assert decompile(compiled) == decompile(tree)
+
+  def test_compact_tree(self):
+    decompile = Function.deparser.decompile
+    for command, expected in get_lines('data/lines.txt'):
+      tree = TestParser.lalr.parse(command)
+      compact = parsing.compact(tree)
+      assert decompile(compact) == decompile(tree)
+    compact = parsing.compact(TestParser.lalr.parse('(3)'))
+    assert compact.children[0].data == 'priority'
+    assert compact.children[0].children[0].data == 'number_literal'
+
+  def test_constant_folding(self):
+    interpreter = TestInterpreter.interpreter
+    tree = interpreter.compile(TestParser.lalr.parse(
+      '2 ** 10 + [1 through 20][3]; 3d6 + 1; @[1, 2]; ><[1, 2]; [1 to 10**9]'))
+    folded = [is_constant(c) and c.handler.value for c in tree.children]
+    assert folded == [1028, False, False, False, False]
+    
+    command = 'for k in [0 to 3] do begin x = [[0]]; x[0][0] = k; x end'
+    result, _ = interpreter.execute(command, user, server)
+    assert result == [[[0]], [[1]], [[2]]]
+
+  def test_resolved_names(self):
+    interpreter = TestInterpreter.interpreter
+    tree = interpreter.compile(TestParser.lalr.parse('x = 1; x; our x'))
+    handlers = [type(c.handler).__name__ for c in tree.children]
+    assert handlers[:2] == ['ScopedSet', 'ScopedGet']
+    assert tree.children[2].handler is visitor.Visitor.handle_identifier_get
+    
+    scoping_data = ScopingData(user, server)
+    scoping_data.push_scope({'x': None})
+    assert scoping_data.get('x') is None
+  
+  def test_codec_round_trip(self):
+    interpreter = TestInterpreter.interpreter
+    source = 'begin n = 2; (x) -> x * n + 1 end'
+    f, _ = interpreter.execute(source, user, server)
+    values = [
+      0, -3.5, 2j, 'text', True, Undefined, float('inf'),
+      [1, [2, (3, 4)], {'a': (5,), (6, 7): []}],
+      Range.between(True, 0, 10**4), Range.between(False, 1, 0, 0.25),
+      f, Function('(x, y) -> begin z = x; z + y end'),
+    ]
+    for value in values:
+      assert codec.loads(codec.dumps(value)) == value
+      assert codec.loads(codec.legacy_dumps(value)) == value
+    assert codec.loads(codec.dumps(f)).closed == f.closed == [{'n': 2}]
+    assert isinstance(codec.loads(codec.dumps(values[-3])), Range)
+    # Values written before the version of marshal was recorded.
+    old = codec.MAGIC + bytes([2]) + codec.PLAIN + marshal.dumps([1, 'a'], 4)
+    assert codec.decode(old) == [1, 'a']
+    newer = bytearray(codec.encode([1]))
+    newer[len(codec.MAGIC) + 1] = marshal.version + 1
+    with pytest.raises(StorageError):
+      codec.decode(bytes(newer))
+    for text in ["__import__('os').getcwd()", '().__class__', 'open("x")',
+        'Function(**{})', '[1] * 3', '-"a"']:
+      with pytest.raises(StorageError):
+        codec.loads(text)
+
+  def test_register_handler(self):
+    visitor.register('answer', lambda v, children: 42)
+    try:
+      tree = Tree('start', [Tree('expression', [Tree('answer', [])])])
+      v = TestInterpreter.interpreter.visitor
+      assert v.walk(tree, ScopingData(user, server), True) == (42, '')
+    finally:
+      del visitor.handlers['answer']
@@ -1,10 +1,33 @@
-import time
+import heapq
+import functools
 import random
 import numbers
 
+from dicelang.float_special import inf
+from dicelang.float_special import nan
 from dicelang.function import Function
+from dicelang.ranges import Range
+from dicelang.ranges import mutable
 from dicelang.exceptions import DiceRollTimeout
 
+try:
+  import numpy
+  numpy_generator = numpy.random.default_rng()
+except ImportError:
+  numpy_generator = None
+
+# Fewer than `bulk_min_dice` dice are rolled one at a time by
+# `random.randint`. More are rolled in batches of up to `dice_batch`: from
+# random bytes for dice with at most 255 sides, and for dice with fewer than
+# `bulk_max_sides` sides by NumPy, when it is installed, or otherwise by
+# `random.choices`. Dice with more sides are always rolled by `randint`,
+# which unlike the others is exact for any number of sides. From
+# `count_min_dice` dice on, the highest or lowest are kept without sorting.
+dice_batch = 2**16
+bulk_min_dice = 8
+count_min_dice = 64
+bulk_max_sides = 2**31
+
 def is_noninteger(x):
   '''Used to detect float and complex numbers as numbers.Real will also
   include integers.'''
@@ -16,12 +39,13 @@ def is_nonkey(x):
   '''We don't allow dicts to be keyed by these non-hashable objects.
   This function is used instead to allow the Visitor to raise a more
   useful error for users than Python would raise itself.'''
-  return isinstance(x, (dict, list, Function))
+  return isinstance(x, (dict, list, Range, Function))
 
 def addition(left, right):
   '''Adds special rules to auto-box scalar items when they are added to
   a list, as well as for merging two dicts via '+'. Otherwise, behaves as
   you would expect from python.'''
+  left, right = mutable(left), mutable(right)
   if isinstance(left, list) and not isinstance(right, list):
     out = left + [right]
   elif isinstance(right, list) and not isinstance(left, list):
@@ -32,6 +56,27 @@ def addition(left, right):
     out = left + right
   return out
 
+def division(dividend, divisor):
+  '''Ordinary floating point division, giving a signed infinity for
+  division by zero.'''
+  if divisor == 0:
+    sign = 1 if dividend >= 0 else -1
+    sign *= 1 if divisor >= 0 else -1
+    return sign * inf
+  return dividend / divisor
+
+def floor_division(dividend, divisor):
+  '''Division rounded down, with the same rule as `division` for zero.'''
+  if divisor == 0:
+    return division(dividend, divisor)
+  return dividend // divisor
+
+def remainder(dividend, divisor):
+  '''Remainder for float or int, which is nan for division by zero.'''
+  if divisor == 0 and isinstance(dividend, numbers.Number):
+    return nan
+  return dividend % divisor
+
 def shift(left, right, left_shift=True):
   '''Adds special rules for 'bitwise shift' operators. When the left operand is
   a list and the right is an int, this "rotates" the list. Left shifts pop from
@@ -44,6 +89,7 @@ def shift(left, right, left_shift=True):
   
   Otherwise, shift normally, possibly raising an exception.'''
   out = None
+  left = mutable(left)
   if isinstance(left, list) and isinstance(right, int):
     copy = left[:]
     if left_shift:
@@ -73,36 +119,186 @@ def iterable_repetition(iterable, repetitions):
     out = (iterable[::-1]) * times
   return out
 
-def roll(dice, sides, count, mode, return_sum, must_finish_by):
+def dice_batches(dice, execution):
+  '''Sizes of the batches in which `dice` dice are rolled. Each die is a
+  step of `execution`, counted before its batch is rolled.'''
+  for start in range(0, dice, dice_batch):
+    size = min(dice_batch, dice - start)
+    execution.spend(size, DiceRollTimeout, 'Took too long rolling dice!')
+    yield size
+
+@functools.lru_cache(maxsize=None)
+def byte_table(sides):
+  '''Table for `bytes.translate` that turns random bytes into rolls of a
+  die with `sides` sides, and the bytes to delete so that every side is
+  equally likely.'''
+  limit = 256 - 256 % sides
+  return bytes(b % sides + 1 for b in range(256)), bytes(range(limit, 256))
+
+def byte_rolls(sides, size):
+  '''`size` rolls of a die with at most 255 sides, as bytes.'''
+  table, rejected = byte_table(sides)
+  kept = 256 - len(rejected)
+  out = b''
+  while len(out) < size:
+    more = (size - len(out)) * 256 // kept + 8
+    data = random.getrandbits(8 * more).to_bytes(more, 'little')
+    out += data.translate(table, rejected)
+  return out[:size]
+
+def use_bytes(sides):
+  return isinstance(sides, int) and 0 < sides < 256
+
+def use_numpy(sides):
+  return (numpy_generator is not None
+    and isinstance(sides, int) and sides < bulk_max_sides)
+
+def roll_batch(sides, size):
+  '''`size` rolls of a die with `sides` sides, as a list.'''
+  if use_bytes(sides):
+    return list(byte_rolls(sides, size))
+  if use_numpy(sides):
+    return numpy_generator.integers(1, sides + 1, size=size).tolist()
+  if sides < bulk_max_sides:
+    return random.choices(range(1, sides + 1), k=size)
+  return [random.randint(1, sides) for die in range(size)]
+
+def sum_batch(sides, size):
+  '''The sum of `size` rolls of a die with `sides` sides.'''
+  if use_bytes(sides):
+    return sum(byte_rolls(sides, size))
+  if use_numpy(sides):
+    return int(numpy_generator.integers(1, sides + 1, size=size).sum())
+  return sum(roll_batch(sides, size))
+
+class DiceBuffer(object):
+  '''Rolls of dice with at most 255 sides, drawn ahead in batches of
+  `size` for each number of sides, for code that rolls a few dice at a time
+  over and over again. Rolls left in a batch too short for the next roll
+  are thrown away, which leaves the rest just as random.'''
+  def __init__(self, size=4096):
+    self.size = size
+    self.batches = { }
+  
+  def take(self, sides, dice):
+    batch, start = self.batches.get(sides, (b'', 0))
+    end = start + dice
+    if end > len(batch):
+      batch, start, end = byte_rolls(sides, max(self.size, dice)), 0, dice
+    self.batches[sides] = (batch, end)
+    return list(batch[start:end])
+
+def repeated_rolls(dice, sides, count, mode, execution, size=4096):
+  '''Endless sums of the kept dice of separate rolls of `dice` dice with
+  `sides` sides. When there are too few dice for `roll` to roll them in
+  bulk, the dice of many rolls are drawn at once instead, `size` dice at a
+  time, and counted as steps of `execution` along with a step for each
+  roll.'''
+  if not 0 < dice < bulk_min_dice or not use_bytes(sides):
+    while True:
+      yield roll(dice, sides, count, mode, True, execution)
+  per_batch = max(size // dice, 1)
+  keeping = mode in ('highest', 'lowest')
+  while True:
+    execution.spend(
+      per_batch * (dice + 1), DiceRollTimeout, 'Took too long rolling dice!')
+    rolls = byte_rolls(sides, per_batch * dice)
+    groups = zip(*[iter(rolls)] * dice)
+    if keeping:
+      yield from (sum(keep_sorted(group, count, mode)) for group in groups)
+    else:
+      yield from map(sum, groups)
+
+def roll_all(dice, sides, execution):
+  out = [ ]
+  for size in dice_batches(dice, execution):
+    out.extend(roll_batch(sides, size))
+  return out
+
+def keep_sorted(rolls, count, mode):
+  if mode == 'lowest':
+    out = sorted(rolls)[:count]
+  elif mode == 'highest':
+    out = sorted(rolls, reverse=True)[:count]
+  else:
+    out = rolls
+  return out
+
+def keep_counted(dice, sides, count, mode, execution):
+  '''Roll dice with at most 255 sides and keep the highest or lowest of
+  them by counting how many times each side came up, starting from the side
+  to keep first. Once a batch has `count` dice on the sides counted so far,
+  none of its other dice can be kept, so they are not counted.'''
+  if mode == 'highest':
+    order = range(sides, 0, -1)
+  else:
+    order = range(1, sides + 1)
+  counts = [0] * (sides + 1)
+  for size in dice_batches(dice, execution):
+    rolls = byte_rolls(sides, size)
+    found = 0
+    for side in order:
+      rolled = rolls.count(side)
+      counts[side] += rolled
+      found += rolled
+      if found >= count:
+        break
+  
+  out = [ ]
+  for side in order:
+    out.extend([side] * min(counts[side], count - len(out)))
+  return out
+
+def keep_streamed(dice, sides, count, mode, execution):
+  '''Roll dice and keep the highest or lowest `count` of them, carrying
+  only those from one batch to the next.'''
+  keep = heapq.nlargest if mode == 'highest' else heapq.nsmallest
+  out = [ ]
+  for size in dice_batches(dice, execution):
+    out = keep(count, out + roll_batch(sides, size))
+  return out
+
+def roll(dice, sides, count, mode, return_sum, execution):
   '''Rolls `dice` dice each with `sides` sides numbered `1` through `sides`.
   When `mode` is "highest", the highest `count` dice are kept; when `mode`
   is "lowest", the lowest `count` dice are kept; oetherwise, all dice are
   kept. `return_sum` is a boolean which causes the dice to be summed if True
-  and returned as a list of individual rolls otherwise. `must_finish_by` is
-  a time in seconds since the epoch by which the die rolling loop must finish
-  executing or else time out.'''
-  results = []
-  for die in range(dice):
-    if time.time() > must_finish_by:
-      raise DiceRollTimeout('Took too long rolling dice!')
-    results.append(random.randint(1, sides))
+  and returned as a list of individual rolls otherwise. Each die is a step
+  of `execution`, and the dice are rolled a batch at a time between checks
+  of its time and step limits.
   
-  if mode == 'lowest':
-    out = sorted(results)[:count]
-  elif mode == 'highest':
-    out = sorted(results, reverse=True)[:count]
+  Only as many rolls are held at once as need to be: a sum of all the dice
+  is added up a batch at a time, and when no more than a batch of dice are
+  kept, only those are carried from one batch to the next.'''
+  keeping = mode in ('highest', 'lowest')
+  if dice < bulk_min_dice:
+    execution.spend(
+      max(dice, 0), DiceRollTimeout, 'Took too long rolling dice!')
+    if execution.dice is not None and use_bytes(sides):
+      rolls = execution.dice.take(sides, max(dice, 0))
+    else:
+      rolls = [random.randint(1, sides) for die in range(dice)]
+    out = keep_sorted(rolls, count, mode)
+  elif not keeping and return_sum:
+    return sum(sum_batch(sides, size)
+      for size in dice_batches(dice, execution))
+  elif not keeping:
+    out = roll_all(dice, sides, execution)
+  elif dice < count_min_dice or not 0 <= count <= dice:
+    out = keep_sorted(roll_all(dice, sides, execution), count, mode)
+  elif use_bytes(sides):
+    out = keep_counted(dice, sides, count, mode, execution)
+  elif count <= dice_batch:
+    out = keep_streamed(dice, sides, count, mode, execution)
   else:
-    out = results
+    out = keep_sorted(roll_all(dice, sides, execution), count, mode)
   return sum(out) if return_sum else out
 
-def flatten(items, seqtypes=(list, tuple)):
+def flatten(items, seqtypes=(list, tuple, Range)):
   '''Flattens an arbitrarily nested list or tuple down into a single-depth
-  vector (tuple or list, depending on input).'''
-  if isinstance(items, tuple):
-    revert_to_tuple = True
-    items = list(items)
-  else:
-    revert_to_tuple = False
+  vector (tuple or list, depending on input). The input is not changed.'''
+  revert_to_tuple = isinstance(items, tuple)
+  items = list(items)
   
   for i, x in enumerate(items):
     while i < len(items) and isinstance(items[i], seqtypes):
@@ -113,35 +309,8 @@ def string_format(format_string, fields):
   '''Handles string formatting for %% operator.'''
   if isinstance(fields, dict):
     out = format_string.format(**fields)
-  elif isinstance(fields, (list, tuple)):
+  elif isinstance(fields, (list, tuple, Range)):
     out = format_string.format(*fields)
   else:
     out = format_string.format(fields)
   return out
-
-def range_list(closed, start, stop, step=1):
-  '''Generates a list of integers from start to stop by step. Step is always
-  corrected to the correct sign depending on whether start>stop or not. As
-  such, the sign of step does not matter. Closed is a boolean variable that
-  determines whether stop should be included in the list.'''
-  if start > stop:
-    upward = False
-    step = -abs(step)
-  elif start < stop:
-    upward = True
-    step = abs(step)
-  else:
-    return [start] if closed else []
-  
-  if closed:
-    stop += step
-  
-  out = []
-  i = start
-  while (upward and i < stop) or (not upward and i > stop):
-    out.append(i)
-    i += step
-   
-  return out
-
-
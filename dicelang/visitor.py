@@ -2,20 +2,26 @@ import copy
 import math
 import random
 import re
-import statistics
+import threading
 import time
+import contextlib
+import contextvars
 
 from collections.abc import Iterable
 from collections.abc import Sequence
+from lark import Tree
 from numbers import Number
 from numbers import Real
 from numbers import Complex
 from numbers import Integral
 
+from dicelang import parsing
 from dicelang import plugins
+from dicelang import odds
+from dicelang import simulation
+from dicelang import running_stats
 from dicelang import util
 
-from dicelang.float_special import inf
 from dicelang.float_special import nan
 
 from dicelang.exceptions import BreakSignal
@@ -28,9 +34,11 @@ from dicelang.exceptions import DiceRollTimeout
 from dicelang.exceptions import DoWhileLoopTimeout
 from dicelang.exceptions import ExecutionTimeout
 from dicelang.exceptions import ExponentiationTimeout
+from dicelang.exceptions import LoopTimeout
 from dicelang.exceptions import OperationError
 from dicelang.exceptions import ReturnError
 from dicelang.exceptions import SkipError
+from dicelang.exceptions import StepLimitExceeded
 from dicelang.exceptions import WhileLoopTimeout
 
 from dicelang.function import Function
@@ -38,46 +46,93 @@ from dicelang.alias import Alias
 from dicelang.undefined import Undefined
 
 from dicelang.identifier import Identifier
+from dicelang.identifier import ScopedGet
+from dicelang.identifier import ScopedSet
 from dicelang.ownership import ScopingData
-from dicelang.print_queue import PrintQueue
+from dicelang.execution import Execution
+from dicelang.ranges import Range
+from dicelang.ranges import mutable
+from dicelang.compiler import Constant
+from dicelang.compiler import compile_tree
+from dicelang.compiler import is_constant
 
 class Visitor(object):
+  step_fields = ('commands', 'steps', 'most')
+  # Timeouts a loop reports as they are rather than as its own.
+  own_timeouts = (LoopTimeout, StepLimitExceeded)
+  
   def __init__(self, data, timeout=12):
     self.variable_data = data
-    self.scoping_data = None
     
     # Timeout is parameterized as its value may vary due to load in later
     # versions of Atropos.
     self.loop_timeout = timeout
     self.execution_timeout = timeout * 3
-    self.depth = 0
-    self.must_finish_by = None
-    self.print_queue = PrintQueue()
-  
-  def get_print_queue_on_error(self, user):
-    '''Reset the interpreter for the next command and release all
-    debug output to the user.'''
-    self.depth = 0
-    return self.print_queue.flush(user)
+    self.fold_timeout = 0.05
+    self.max_steps = None
     
-  def walk(self, parse_tree, scoping_data, from_interpreter=False):
-    '''Start execution of a syntax tree.'''
+    # The command being run in the current thread or task. See Execution.
+    self.execution = contextvars.ContextVar('execution', default=None)
+    self.step_counts = { }
+    self.lock = threading.Lock()
+  
+  @property
+  def scoping_data(self):
+    return self.execution.get().scoping_data
+  
+  @property
+  def must_finish_by(self):
+    return self.execution.get().must_finish_by
+  
+  @property
+  def print_queue(self):
+    return self.execution.get().print_queue
+  
+  def step_stats(self, server=None):
+    '''How many commands have been run and how many steps they took, in
+    total and at most, for one server or for each server.'''
+    with self.lock:
+      if server is None:
+        return {k: dict(v) for k, v in self.step_counts.items()}
+      counts = self.step_counts.get(server)
+      return dict(counts) if counts else dict.fromkeys(Visitor.step_fields, 0)
+  
+  def walk(self, parse_tree, scoping_data, from_interpreter=False,
+      max_steps=None):
+    '''Start execution of a syntax tree. The interpreter starts each
+    command here, and functions run their bodies here. A command may take
+    at most `max_steps` steps, or `self.max_steps` if not given.'''
     if from_interpreter:
-      self.must_finish_by = self.execution_timeout + time.time()
-    self.scoping_data = scoping_data
+      execution = Execution(
+        scoping_data,
+        self.execution_timeout + time.monotonic(),
+        self.max_steps if max_steps is None else max_steps)
+      token = self.execution.set(execution)
+      try:
+        return self.walk(parse_tree, scoping_data)
+      except Exception as e:
+        # What a failed command printed goes with its error.
+        e.printout = execution.print_queue.flush(scoping_data.user)
+        raise
+      finally:
+        scoping_data.release()
+        self.execution.reset(token)
+        self.count_steps(scoping_data.server, execution.steps)
     
-    self.depth += 1
+    execution = self.execution.get()
+    execution.scoping_data = scoping_data
+    execution.depth += 1
     try:
-      result = self.handle_instruction(parse_tree)
+      result = self.handle_instruction(self.compile(parse_tree))
     except BreakSignal: # Occurs when break is used outside a loop
       raise BreakError()
     except SkipSignal:  # Occurs when skip is used outside a loop
       raise SkipError()
     except ReturnSignal as rs:
-      if self.depth == 1: # Case when return is used outside a function
+      if execution.depth == 1: # Case when return is used outside a function
         raise ReturnError()
       result = rs.data
-    self.depth -= 1
+    execution.depth -= 1
     
     # Reentrancy case -- when a dicelang Function is executed,
     # we don't want to erase our scoping data since we're still
@@ -85,282 +140,107 @@ class Visitor(object):
     # are finished executing. Furthermore, we only want to return
     # the current working value to the previous depth level; print
     # queue output doesn't come until we bottom out at depth=0.
-    tmp_user = self.scoping_data.user
-    if not self.depth:
-      out = (result, self.print_queue.flush(self.scoping_data.user))
-      self.scoping_data = None
+    if not execution.depth:
+      out = (result, execution.print_queue.flush(scoping_data.user))
     else:
       out = result
     return out
   
+  def count_steps(self, server, steps):
+    with self.lock:
+      counts = self.step_counts.get(server)
+      if counts is None:
+        counts = dict.fromkeys(Visitor.step_fields, 0)
+        self.step_counts[server] = counts
+      counts['commands'] += 1
+      counts['steps'] += steps
+      counts['most'] = max(counts['most'], steps)
+  
   def process_operands(self, children):
     '''Avoid typing the following list comprehension in a majority
     of handlers.'''
     return [self.handle_instruction(c) for c in children]
   
+  def compile(self, tree):
+    '''Resolve the handler of every node of a syntax tree ahead of time,
+    evaluate the nodes whose value can never change, and give the nodes
+    that read or assign scoped variables handlers that know their names.'''
+    return compile_tree(
+      tree, Visitor.select_handler, pass_through, self.optimize)
+  
+  def optimize(self, node):
+    return self.fold(resolve(node))
+  
+  def fold(self, node):
+    '''Replace the handler of a node with its value if the node is pure and
+    all of its operands are constants. Anything that fails or takes too long
+    to evaluate is left for run time, so errors are still reported then.'''
+    guard = foldable.get(node.data)
+    operands = [c for c in node.children if isinstance(c, Tree)]
+    if guard is None or not all(map(is_constant, operands)):
+      return node
+    if not guard(*[c.handler.value for c in operands]):
+      return node
+    
+    # Folding runs as an execution of its own, with a much shorter limit.
+    execution = Execution(None, time.monotonic() + self.fold_timeout)
+    token = self.execution.set(execution)
+    try:
+      node.handler = Constant(node.handler(self, node.operands))
+    except Exception:
+      pass
+    finally:
+      self.execution.reset(token)
+    return node
+  
   def handle_instruction(self, tree):
-    '''Dispatch execution recursively through the syntax tree.'''
+    '''Dispatch execution recursively through the compiled syntax tree.'''
     
-    # Each time we address a new instruction, we check to see if we've
-    # taken longer than we promised to at the start of the interpreter call.
-    # If we have, then we must bail out and report failure to the user.
-    now = time.time()
-    if now > self.must_finish_by:
+    # Each instruction is a step. Every so often, we check to see if we've
+    # taken longer than we promised to at the start of the interpreter call,
+    # or more steps than we were allowed. If we have, then we must bail out
+    # and report failure to the user.
+    execution = self.execution.get()
+    execution.steps += 1
+    if execution.steps >= execution.next_check:
       e = 'Dicelang command took too long! You may have chained '
       e += 'too many dice together, constructed an extremely large '
       e += 'number, or just tried to do too much at once.'
-      raise ExecutionTimeout(e)
-    
-    if tree.data == 'start':
-      out = [self.handle_instruction(c) for c in tree.children][-1]
-    elif tree.data == 'body':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'block' or tree.data == 'short_body':
-      out = self.handle_block(tree.children)
-    elif tree.data == 'function':
-      out = self.handle_function(tree.children)
-    elif tree.data == 'alias':
-      out = self.handle_alias(tree.children)
-   
-    elif tree.data == 'for_loop':
-      out = self.handle_for_loop(tree.children)
-    elif tree.data == 'while_loop':
-      out = self.handle_while_loop(tree.children)
-    elif tree.data == 'do_while_loop':
-      out = self.handle_do_while_loop(tree.children)
-    elif tree.data == 'conditional':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'if':
-      out = self.handle_if(tree.children)
-    elif tree.data == 'if_else':
-      out = self.handle_if_else(tree.children)
-    
-    elif tree.data == 'expression':
-      out = self.handle_instruction(tree.children[0])
-    
-    elif tree.data == 'import':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'standard_import':
-      out = self.handle_standard_import(tree.children)
-    elif tree.data == 'standard_getattr_import':
-      out = self.handle_standard_getattr_import(tree.children)
-    elif tree.data == 'as_import':
-      out = self.handle_as_import(tree.children)
-    elif tree.data == 'as_getattr_import':
-      out = self.handle_as_getattr_import(tree.children)
-    
-    elif tree.data == 'deletion':
-      out = self.handle_deletion(tree.children)
-    elif tree.data == 'deletable':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'identifier_deletable':
-      out = self.handle_identifier_deletable(tree.children)
-    elif tree.data == 'subscript_deletable':
-      out = self.handle_subscript_deletable(tree.children)
-    
-    elif tree.data == 'assignment':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'identifier_set':
-      out = self.handle_identifier_set(tree.children)
-    elif tree.data == 'subscript_set':
-      out = self.handle_subscript_set(tree.children)
-    elif tree.data == 'subscript_chain':
-      out = self.handle_subscript_chain(tree.children)
-    elif tree.data == 'subscript':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data.endswith('_subscript'):
-      out = self.handle_subscript(tree.data, tree.children)
-    
-    elif tree.data == 'if_expr':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'inline_if':
-      out = self.handle_inline_if(tree.children)
-    elif tree.data == 'inline_if_binary':
-      out = self.handle_inline_if_binary(tree.children)
-    elif tree.data == 'repeat':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'repetition':
-      out = self.handle_repetition(tree.children)
-    
-    elif tree.data == 'bool_or':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'logical_or':
-      out = self.handle_logical_or(tree.children)
-    elif tree.data == 'bool_xor':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'logical_xor':
-      out = self.handle_logical_xor(tree.children)
-    elif tree.data == 'bool_and':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'logical_and':
-      out = self.handle_logical_and(tree.children)
-    elif tree.data == 'bool_not':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'logical_not':
-      out = self.handle_logical_not(tree.children)
-    
-    elif tree.data == 'comp':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'comp_math':
-      out = self.handle_comp_math(tree.children)
-    elif tree.data == 'comp_obj':
-      out = self.handle_comp_obj(tree.children)
-    elif tree.data == 'math_comp':
-      out = tree.children[0].value
-    elif tree.data == 'obj_comp':
-      out = 'is' if len(tree.children) == 1 else 'is not'
-    elif tree.data == 'present':
-      out = self.handle_present(tree.children)
-    elif tree.data == 'absent':
-      out = self.handle_present(tree.children, negate=True)
-    
-    elif tree.data == 'arithm':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'addition':
-      out = self.handle_addition(tree.children)
-    elif tree.data == 'subtraction':
-      out = self.handle_subtraction(tree.children)
-    elif tree.data == 'catenation':
-      out = self.handle_catenation(tree.children)
-    
-    elif tree.data == 'term':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'multiplication':
-      out = self.handle_multiplication(tree.children)
-    elif tree.data == 'division':
-      out = self.handle_division(tree.children)
-    elif tree.data == 'remainder':
-      out = self.handle_remainder(tree.children)
-    elif tree.data == 'floor_division':
-      out = self.handle_floor_division(tree.children)
-    elif tree.data == 'left_shift':
-      out = self.handle_left_shift(tree.children)
-    elif tree.data == 'right_shift':
-      out = self.handle_right_shift(tree.children)
-    
-    elif tree.data == 'factor':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'negation':
-      out = self.handle_negation(tree.children)
-    elif tree.data == 'real_part_or_nop':
-      out = self.handle_real_part_or_nop(tree.children)
-    
-    elif tree.data == 'power':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'exponent':
-      out = self.handle_exponent(tree.children)
-    elif tree.data == 'logarithm':
-      out = self.handle_logarithm(tree.children)
-    
-    elif tree.data == 'reduction':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'sum_or_join':
-      out = self.handle_sum_or_join(tree.children)
-    elif tree.data == 'length':
-      out = self.handle_length(tree.children)
-    elif tree.data == 'selection':
-      out = self.handle_selection(tree.children)
-    elif tree.data in ('minimum', 'maximum'):
-      out = self.handle_extrema(tree.children, tree.data)
-    elif tree.data == 'flatten_or_abs':
-      out = self.handle_flatten_or_abs(tree.children)
-    elif tree.data == 'stats':
-      out = self.handle_stats(tree.children)
-    elif tree.data == 'sort':
-      out = self.handle_sort(tree.children)
-    elif tree.data == 'shuffle':
-      out = self.handle_shuffle(tree.children)
-    
-    elif tree.data == 'die':
-      out = self.handle_instruction(tree.children[0])
-    elif 'vector_die' in tree.data or 'scalar_die' in tree.data:
-      out = self.handle_dice(tree.data, tree.children)
+      execution.check(ExecutionTimeout, e)
     
-    elif tree.data == 'primary':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'typeof':
-      out = self.handle_typeof(tree.children)
-    elif tree.data == 'function_call':
-      out = self.handle_function_call(tree.children)
-    elif tree.data == 'getattr':
-      out = self.handle_getattr(tree.children)
-    elif tree.data == 'apply':
-      out = self.handle_apply(tree.children)
-    elif tree.data == 'match':
-      out = self.handle_match(tree.children)
-    elif tree.data == 'search':
-      out = self.handle_search(tree.children)
-    elif tree.data == 'plugin_call':
-      out = self.handle_plugin_call(tree.children)
-    
-    elif tree.data == 'slice':
-      out = self.handle_instruction(tree.children[0])
-    elif '_slice' in tree.data:
-      out = self.handle_slices(tree.data, tree.children)
-    elif tree.data == 'sliced':
-      out = self.handle_sliced(tree.children)
-    
-    elif tree.data == 'keyword_expr':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'printline':
-      out = self.handle_print(tree.children, '\n')
-    elif tree.data == 'printword':
-      out = self.handle_print(tree.children, ' ')
-    elif tree.data in ('break_expr', 'skip_expr', 'return_expr'):
-      out = self.handle_signal(tree.children, bare=False)
-    elif tree.data in ('break_bare', 'skip_bare', 'return_bare'):
-      out = self.handle_signal(tree.children, bare=True)
-    elif tree.data == 'inspection':
-      out = self.handle_inspection(tree.children)
- 
-    
-    elif tree.data == 'atom' or tree.data == 'priority':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data == 'number_literal':
-      out = self.handle_number_literal(tree.children)
-    elif tree.data == 'boolean_literal':
-      out = self.handle_boolean_literal(tree.children)
-    elif tree.data == 'string_literal':
-      out = self.handle_string_literal(tree.children)
-    elif tree.data == 'populated_list':
-      out = self.handle_list_literal(tree.children)
-    elif tree.data == 'empty_list':
-      out = self.handle_list_literal(None)
-    elif tree.data == 'range_list' or tree.data == 'range_list_stepped':
-      out = self.handle_list_range_literal(tree.children)
-    elif tree.data == 'closed_list' or tree.data == 'closed_list_stepped':
-      out = self.handle_closed_list_literal(tree.children)
-    elif tree.data == 'tuple_literal':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data in ('mono_tuple', 'multi_tuple', 'empty_tuple'):
-      out = self.handle_tuple(tree.children)
-    elif tree.data == 'populated_dict':
-      out = self.handle_dict_literal(tree.children)
-    elif tree.data == 'empty_dict':
-      out = self.handle_dict_literal(None)
-    elif tree.data == 'identifier':
-      out = self.handle_instruction(tree.children[0])
-    elif tree.data in ('core_identifier',
-                       'scoped_identifier',
-                       'global_identifier',
-                       'server_identifier',
-                       'private_identifier'):
-      out = self.handle_identifiers(tree.data, tree.children)
-    elif tree.data == 'undefined_literal':
-      out = Undefined
-    elif tree.data == 'identifier_get':
-      ident = self.handle_instruction(tree.children[0])
-      out = ident.get()
-    else:
-      print(tree.data, tree.children)
-      out = f'__UNIMPLEMENTED__: {tree.data}'
+    out = tree.handler(self, tree.operands)
     
     if isinstance(out, Alias):
       out = out(self)
       
     return out 
-    
-    
+  
+  @staticmethod
+  def select_handler(rule):
+    '''Look up the handler registered for the grammar rule `rule`.'''
+    try:
+      out = handlers[rule]
+    except KeyError:
+      def out(visitor, children):
+        print(rule, children)
+        return f'__UNIMPLEMENTED__: {rule}'
+    return out
+  
+  def handle_start(self, children):
+    '''Evaluates each top-level statement in order, giving the last value.'''
+    return [self.handle_instruction(c) for c in children][-1]
+  
+  def handle_pass_through(self, children):
+    '''Rules that only wrap a single alternative evaluate to that
+    alternative.'''
+    return self.handle_instruction(children[0])
+  
+  def handle_identifier_get(self, children):
+    '''Looks up the value of a variable.'''
+    ident = self.handle_instruction(children[0])
+    return ident.get()
+  
+
   def handle_block(self, children):
     '''Compound expression consisting of `;`-separated expressions and
     evaluating to the last expression in the sequence.'''
@@ -378,7 +258,7 @@ class Visitor(object):
     params = [c.value for c in children[:-1]]
     closed = self.scoping_data.calling_environment()
     out = Function(code, param_names=params, closed_vars=closed)
-    out.visitor = self
+    out.compiled = True
     return out
   
   def handle_alias(self, children):
@@ -445,45 +325,61 @@ class Visitor(object):
     a list of the results of each of the loop's iterations.'''
     self.scoping_data.push_scope()
     results = [ ]
-    timeout = time.time() + self.loop_timeout
-    while self.handle_instruction(children[0]):
-      if time.time() > timeout:
-        times = len(results)
-        raise WhileLoopTimeout(times)
-      try:
-        results.append(self.handle_instruction(children[1]))
-      except BreakSignal as bs:
-        if bs.is_set:
-          results.append(bs.data)
-        break
-      except SkipSignal as ss:
-        if ss.is_set:
-          results.append(ss.data)
-        continue
+    with self.loop_time_limit(WhileLoopTimeout, results):
+      while self.handle_instruction(children[0]):
+        try:
+          results.append(self.handle_instruction(children[1]))
+        except BreakSignal as bs:
+          if bs.is_set:
+            results.append(bs.data)
+          break
+        except SkipSignal as ss:
+          if ss.is_set:
+            results.append(ss.data)
+          continue
     self.scoping_data.pop_scope()
     return results
  
   def handle_do_while_loop(self, children):
     '''Same as a while loop, but is guaranteed to execute at least once.'''
     self.scoping_data.push_scope()
-    results = [self.handle_instruction(children[0])]
-    timeout = time.time() + self.loop_timeout
-    while self.handle_instruction(children[1]):
-      if time.time() > timeout:
-        times = len(results)
-        raise DoWhileLoopTimeout(times)
-      try:
-        results.append(self.handle_instruction(children[0]))
-      except BreakSignal as bs:
-        if bs.is_set:
-          results.append(bs.data)
-        break
-      except SkipSignal as ss:
-        if ss.is_set:
-          results.append(ss.data)
-        continue 
+    results = [ ]
+    with self.loop_time_limit(DoWhileLoopTimeout, results):
+      results.append(self.handle_instruction(children[0]))
+      while self.handle_instruction(children[1]):
+        try:
+          results.append(self.handle_instruction(children[0]))
+        except BreakSignal as bs:
+          if bs.is_set:
+            results.append(bs.data)
+          break
+        except SkipSignal as ss:
+          if ss.is_set:
+            results.append(ss.data)
+          continue 
     self.scoping_data.pop_scope()
     return results
+  
+  @contextlib.contextmanager
+  def loop_time_limit(self, error, results):
+    '''Give a while loop at most `loop_timeout` seconds, or less if a loop
+    around it has less left. The deadline is checked on the execution's
+    usual schedule of steps rather than on every iteration. If time runs
+    out for a loop rather than for the whole command, the innermost loop
+    raises `error` with the number of results it has so far.'''
+    execution = self.execution.get()
+    outer = execution.loop_must_finish_by
+    deadline = time.monotonic() + self.loop_timeout
+    execution.loop_must_finish_by = min(outer, deadline)
+    try:
+      yield
+    except ExecutionTimeout as e:
+      if isinstance(e, self.own_timeouts) \
+          or time.monotonic() > execution.must_finish_by:
+        raise
+      raise error(len(results))
+    finally:
+      execution.loop_must_finish_by = outer
 
   def handle_if(self, children):
     '''Executes its code only if the conditional expression evaluates to
@@ -613,7 +509,7 @@ class Visitor(object):
     '''Handle deletion of mixed index/key and getattr subscripts of an object.'''
     ident, subscripts = self.process_operands(children)
     chain = ''.join([f'[{s!r}]' for s in subscripts])
-    target = ident.get()
+    target = mutable_path(ident.get(), subscripts, self.scoping_data)
     val_repr = f'target{chain}'
     with Function.SerializableRepr():
       out = eval(val_repr)
@@ -626,7 +522,7 @@ class Visitor(object):
     an identifier. This allows for mixed index/key and getattr operations.'''
     ident, subscripts, value = self.process_operands(children)
     chain = ''.join([f'[{s!r}]' for s in subscripts])
-    target = ident.get()
+    target = mutable_path(ident.get(), subscripts, self.scoping_data)
     with Function.SerializableRepr():
       stmt = f'target{chain} = {value!r}'
       exec(stmt)
@@ -670,12 +566,23 @@ class Visitor(object):
     '''For loop shorthand. Left side is an expression to be evaluated, right
     side is the number of times to evaluate it. Return value is a list
     containing the result of each evaluation of the left side.'''
+    return list(self.repetitions(children))
+  
+  def repetitions(self, children):
+    '''The results of a repetition, evaluated one at a time.'''
     times = self.handle_instruction(children[1])
-    out = [ ]
     for time in range(times):
-      out.append(self.handle_instruction(children[0]))
-    return out
-    
+      yield self.handle_instruction(children[0])
+  
+  def handle_simulation(self, children):
+    '''Evaluate the left side as many times as the right side says, and
+    summarize the results like `?` without keeping them in a list. If a
+    margin is given after `within`, stop as soon as the average is known to
+    within that margin.'''
+    times = self.handle_instruction(children[1])
+    margin = self.handle_instruction(children[2]) if len(children) > 2 else None
+    return simulation.simulate(children[0], times, margin, self)
+  
   def handle_logical_or(self, children):
     '''Boolean disjunction of two objects, with short circuit behavior.'''
     left = self.handle_instruction(children[0])
@@ -762,7 +669,7 @@ class Visitor(object):
     try:
       result = minuend - subtrahend
     except TypeError as e:
-      result = minuend[:]
+      result = mutable(minuend[:])
       try:
         for x in subtrahend:
           if x in minuend:
@@ -791,34 +698,15 @@ class Visitor(object):
 
   def handle_division(self, children):
     '''Ordinary floating point division.'''
-    dividend, divisor = self.process_operands(children)
-    if divisor == 0:
-      sign = 1 if dividend >= 0 else -1
-      sign *= 1 if divisor >= 0 else -1
-      out = sign * inf
-    else:
-      out = dividend / divisor
-    return out
+    return util.division(*self.process_operands(children))
   
   def handle_remainder(self, children):
     '''Remainder for float or int.'''
-    dividend, divisor = self.process_operands(children)
-    if divisor == 0 and isinstance(dividend, Number):
-      out = nan
-    else:
-      out = dividend % divisor
-    return out
+    return util.remainder(*self.process_operands(children))
   
   def handle_floor_division(self, children):
     '''Divide and always round down, returning integer.'''
-    dividend, divisor = self.process_operands(children)
-    if divisor == 0:
-      sign = 1 if dividend >= 0 else -1
-      sign *= 1 if divisor >= 0 else -1
-      out = sign * inf
-    else:
-      out = dividend // divisor
-    return out
+    return util.floor_division(*self.process_operands(children))
   
   def handle_negation(self, children):
     '''Get the arithmetic inverse of a numeric value, or the reverse of
@@ -848,13 +736,17 @@ class Visitor(object):
     if util.is_noninteger(exponent) and isinstance(mantissa, Number):
       out = mantissa ** exponent
     elif isinstance(exponent, Integral) and isinstance(mantissa, Number):
-      e = ExponentiationTimeout('Base or exponent too large in magnitude!')
+      e = 'Base or exponent too large in magnitude!'
       out = 1
       if exponent != 0:
-        for x in range(abs(exponent)):
-          if time.time() > self.must_finish_by:
-            raise e
-          out = out * mantissa
+        execution = self.execution.get()
+        remaining = abs(exponent)
+        while remaining:
+          steps = min(remaining, Execution.check_every)
+          execution.spend(steps, ExponentiationTimeout, e)
+          for x in range(steps):
+            out = out * mantissa
+          remaining -= steps
         if exponent < 0:
           out = 1 / out
       else:
@@ -882,7 +774,9 @@ class Visitor(object):
     this will give the imaginary part.'''
     operand = self.process_operands(children)[0]
     if isinstance(operand, Iterable) and operand:
-      out = operand[0]
+      # The first element is copied, so that adding to it does not change
+      # the operand, which may be held by a variable.
+      out = operand[0][:] if isinstance(operand[0], list) else operand[0]
       for element in operand[1:]:
         out += element
     elif isinstance(operand, Iterable) and not operand:
@@ -933,26 +827,27 @@ class Visitor(object):
     return out
   
   def handle_stats(self, children):
-    '''Generate a number summary from some iterable.'''
-    operand = self.process_operands(children)[0]
-    out = { }
+    '''Generate a number summary from some iterable. The results of a
+    repetition are summarized as they come in, without listing them.'''
+    node = children[0]
+    while node.data == 'priority':
+      node = node.children[0]
+    if node.data == 'repetition':
+      operand = self.repetitions(node.operands)
+    else:
+      operand = self.handle_instruction(children[0])
     if isinstance(operand, Number):
       operand = [operand]
     elif isinstance(operand, dict):
       operand = operand.values()
-    out['average'] = statistics.mean(operand)
-    out['minimum'] = min(operand)
-    out['median' ] = statistics.median(operand)
-    out['maximum'] = max(operand)
-    out['size'   ] = len(operand)
-    out['sum'    ] = sum(operand)
-    out['stddev' ] = statistics.pstdev(operand, out['average'])
-    lower = [value for value in operand if value < out['median']]
-    upper = [value for value in operand if value > out['median']]
-    out['q1'] = statistics.median(lower)
-    out['q3'] = statistics.median(upper)
-    return out
+    return running_stats.summarize(operand)
 
+  def handle_odds(self, children):
+    '''Work out the exact distribution of a dice expression instead of
+    rolling it, and summarize it like `?` along with some percentiles and
+    the chance of each outcome.'''
+    return odds.analyze(children[0], self).summary()
+  
   def handle_sort(self, children):
     '''Return a sorted copy of an iterable.'''
     operand = self.process_operands(children)[0]
@@ -961,14 +856,14 @@ class Visitor(object):
     elif isinstance(operand, dict):
       out = sorted(operand.values())
     elif isinstance(operand, Sequence):
-      out = type(operand)(sorted(operand))
+      out = type(mutable(operand))(sorted(operand))
     else:
       out = operand
     return out
   
   def handle_shuffle(self, children):
     '''Return a shuffled copy of an iterable.'''
-    operand = self.process_operands(children)[0][:]
+    operand = mutable(self.process_operands(children)[0][:])
     if isinstance(operand, str):
       operand = list(operand)
       random.shuffle(operand)
@@ -1031,7 +926,7 @@ class Visitor(object):
     dice, sides = operands[:2]
     count = operands[2] if len(operands) > 2 else None
     as_sum = result_type == 'scalar'
-    d = util.roll(dice, sides, count, keep_mode, as_sum, self.must_finish_by)
+    d = util.roll(dice, sides, count, keep_mode, as_sum, self.execution.get())
     return d
   
   def handle_apply(self, children):
@@ -1074,6 +969,8 @@ class Visitor(object):
     obj, ident = self.process_operands(children)
     out = obj[ident.name]
     if isinstance(out, Function):
+      # Bind a copy, since the function may be shared by other commands.
+      out = copy.copy(out)
       out.this = obj
     return out
 
@@ -1102,6 +999,8 @@ class Visitor(object):
     obj = self.handle_instruction(children[1])
     if isinstance(obj, Function):
       out = 'func'
+    elif isinstance(obj, Range):
+      out = 'list'
     else:
       out = type(obj).__name__
     return out
@@ -1166,12 +1065,12 @@ class Visitor(object):
     return out
   
   def handle_list_range_literal(self, children):
-    '''Constructs a list literal on the interval [1, n).'''
-    return util.range_list(False, *self.process_operands(children))
+    '''Constructs a lazy list on the interval [1, n).'''
+    return Range.between(False, *self.process_operands(children))
   
   def handle_closed_list_literal(self, children):
-    '''Constructs a list on the interval [1, n].'''
-    return util.range_list(True, *self.process_operands(children))
+    '''Constructs a lazy list on the interval [1, n].'''
+    return Range.between(True, *self.process_operands(children))
   
   def handle_tuple(self, children):
     '''Constructs a tuple from the literal syntax.'''
@@ -1202,3 +1101,299 @@ class Visitor(object):
       mode,
       self.variable_data)
 
+def mutable_path(target, subscripts, scoping_data):
+  '''A variable's value, with any range on the way to the subscripts being
+  assigned or deleted turned into a list, so that it can be changed.
+  Subscripts that do not exist are left for the assignment to report. Any
+  closure sharing the value or a part of it on the way is given copies of
+  its values first.'''
+  path = [target]
+  for subscript in subscripts[:-1]:
+    try:
+      path.append(path[-1][subscript])
+    except (KeyError, IndexError, TypeError):
+      break
+  scoping_data.unshare(path)
+  target = container = mutable(target)
+  for subscript in subscripts[:-1]:
+    try:
+      inner = container[subscript]
+      if isinstance(inner, Range):
+        container[subscript] = inner = list(inner)
+    except (KeyError, IndexError, TypeError):
+      break
+    container = inner
+  return target
+
+def resolve(node):
+  '''Replace the handler of a node reading or assigning a plain scoped
+  variable with one holding the variable's name, which skips evaluating
+  the identifier node and making an Identifier each time. Which scope holds
+  a variable is only known when it runs, since scopes are made and
+  assigned as the code runs, so that is still looked up then.'''
+  target = node.operands[0] if node.operands else None
+  if not isinstance(target, Tree) or target.data != 'scoped_identifier' \
+      or target.handler is not handlers.get('scoped_identifier'):
+    return node
+  if node.handler is Visitor.handle_identifier_get:
+    node.handler = ScopedGet(target.children[-1].value)
+  elif node.handler is Visitor.handle_identifier_set:
+    node.handler = ScopedSet(target.children[-1].value)
+  return node
+
+def with_rule(method, rule):
+  '''Make a handler for a method that also needs to know which of several
+  rules it is executing.'''
+  return lambda visitor, children: method(visitor, rule, children)
+
+# Associate each grammar rule with the handler that executes its nodes. A
+# handler is called with the visitor and the operands of the node.
+handlers = {
+  'start'                   : Visitor.handle_start,
+  'block'                   : Visitor.handle_block,
+  'short_body'              : Visitor.handle_block,
+  'function'                : Visitor.handle_function,
+  'alias'                   : Visitor.handle_alias,
+  'for_loop'                : Visitor.handle_for_loop,
+  'while_loop'              : Visitor.handle_while_loop,
+  'do_while_loop'           : Visitor.handle_do_while_loop,
+  'if'                      : Visitor.handle_if,
+  'if_else'                 : Visitor.handle_if_else,
+  'standard_import'         : Visitor.handle_standard_import,
+  'standard_getattr_import' : Visitor.handle_standard_getattr_import,
+  'as_import'               : Visitor.handle_as_import,
+  'as_getattr_import'       : Visitor.handle_as_getattr_import,
+  'deletion'                : Visitor.handle_deletion,
+  'identifier_deletable'    : Visitor.handle_identifier_deletable,
+  'subscript_deletable'     : Visitor.handle_subscript_deletable,
+  'identifier_set'          : Visitor.handle_identifier_set,
+  'subscript_set'           : Visitor.handle_subscript_set,
+  'subscript_chain'         : Visitor.handle_subscript_chain,
+  'inline_if'               : Visitor.handle_inline_if,
+  'inline_if_binary'        : Visitor.handle_inline_if_binary,
+  'repetition'              : Visitor.handle_repetition,
+  'simulation'              : Visitor.handle_simulation,
+  'logical_or'              : Visitor.handle_logical_or,
+  'logical_xor'             : Visitor.handle_logical_xor,
+  'logical_and'             : Visitor.handle_logical_and,
+  'logical_not'             : Visitor.handle_logical_not,
+  'comp_math'               : Visitor.handle_comp_math,
+  'comp_obj'                : Visitor.handle_comp_obj,
+  'math_comp'               : lambda v, children: children[0].value,
+  'obj_comp'                : lambda v, children: (
+                                'is' if len(children) == 1 else 'is not'),
+  'present'                 : Visitor.handle_present,
+  'absent'                  : lambda v, children: v.handle_present(
+                                children, negate=True),
+  'addition'                : Visitor.handle_addition,
+  'subtraction'             : Visitor.handle_subtraction,
+  'catenation'              : Visitor.handle_catenation,
+  'multiplication'          : Visitor.handle_multiplication,
+  'division'                : Visitor.handle_division,
+  'remainder'               : Visitor.handle_remainder,
+  'floor_division'          : Visitor.handle_floor_division,
+  'left_shift'              : Visitor.handle_left_shift,
+  'right_shift'             : Visitor.handle_right_shift,
+  'negation'                : Visitor.handle_negation,
+  'real_part_or_nop'        : Visitor.handle_real_part_or_nop,
+  'exponent'                : Visitor.handle_exponent,
+  'logarithm'               : Visitor.handle_logarithm,
+  'sum_or_join'             : Visitor.handle_sum_or_join,
+  'length'                  : Visitor.handle_length,
+  'selection'               : Visitor.handle_selection,
+  'minimum'                 : lambda v, children: v.handle_extrema(
+                                children, 'minimum'),
+  'maximum'                 : lambda v, children: v.handle_extrema(
+                                children, 'maximum'),
+  'flatten_or_abs'          : Visitor.handle_flatten_or_abs,
+  'stats'                   : Visitor.handle_stats,
+  'odds'                    : Visitor.handle_odds,
+  'sort'                    : Visitor.handle_sort,
+  'shuffle'                 : Visitor.handle_shuffle,
+  'typeof'                  : Visitor.handle_typeof,
+  'function_call'           : Visitor.handle_function_call,
+  'getattr'                 : Visitor.handle_getattr,
+  'apply'                   : Visitor.handle_apply,
+  'match'                   : Visitor.handle_match,
+  'search'                  : Visitor.handle_search,
+  'plugin_call'             : Visitor.handle_plugin_call,
+  'sliced'                  : Visitor.handle_sliced,
+  'printline'               : lambda v, children: v.handle_print(
+                                children, '\n'),
+  'printword'               : lambda v, children: v.handle_print(
+                                children, ' '),
+  'break_expr'              : lambda v, children: v.handle_signal(
+                                children, bare=False),
+  'skip_expr'               : lambda v, children: v.handle_signal(
+                                children, bare=False),
+  'return_expr'             : lambda v, children: v.handle_signal(
+                                children, bare=False),
+  'break_bare'              : lambda v, children: v.handle_signal(
+                                children, bare=True),
+  'skip_bare'               : lambda v, children: v.handle_signal(
+                                children, bare=True),
+  'return_bare'             : lambda v, children: v.handle_signal(
+                                children, bare=True),
+  'inspection'              : Visitor.handle_inspection,
+  'number_literal'          : Visitor.handle_number_literal,
+  'boolean_literal'         : Visitor.handle_boolean_literal,
+  'string_literal'          : Visitor.handle_string_literal,
+  'populated_list'          : Visitor.handle_list_literal,
+  'empty_list'              : lambda v, children: v.handle_list_literal(None),
+  'range_list'              : Visitor.handle_list_range_literal,
+  'range_list_stepped'      : Visitor.handle_list_range_literal,
+  'closed_list'             : Visitor.handle_closed_list_literal,
+  'closed_list_stepped'     : Visitor.handle_closed_list_literal,
+  'mono_tuple'              : Visitor.handle_tuple,
+  'multi_tuple'             : Visitor.handle_tuple,
+  'empty_tuple'             : Visitor.handle_tuple,
+  'populated_dict'          : Visitor.handle_dict_literal,
+  'empty_dict'              : lambda v, children: v.handle_dict_literal(None),
+  'undefined_literal'       : lambda v, children: Undefined,
+  'identifier_get'          : Visitor.handle_identifier_get,
+  'key_value_pair'          : Visitor.process_operands,
+}
+
+for rule in ('identifier_subscript', 'bracket_subscript'):
+  handlers[rule] = with_rule(Visitor.handle_subscript, rule)
+
+for rule in ('whole_slice', 'start_slice', 'start_step_slice',
+             'start_stop_slice', 'fine_slice', 'stop_slice',
+             'stop_step_slice', 'step_slice', 'not_a_slice'):
+  handlers[rule] = with_rule(Visitor.handle_slices, rule)
+
+for result_type in ('scalar', 'vector'):
+  for keep_mode in ('all', 'highest', 'lowest'):
+    rule = f'{result_type}_die_{keep_mode}'
+    handlers[rule] = with_rule(Visitor.handle_dice, rule)
+
+for mode in ('core', 'scoped', 'global', 'server', 'private'):
+  rule = f'{mode}_identifier'
+  handlers[rule] = with_rule(Visitor.handle_identifiers, rule)
+
+# Rules that only ever wrap a single other node. Most of them are removed
+# from trees by parsing.compact, and compiled nodes of any that remain take
+# on the handler of the node they wrap, so that executing them costs nothing.
+pass_through = set(parsing.pass_through) | {'priority'}
+
+for rule in pass_through:
+  handlers[rule] = Visitor.handle_pass_through
+
+# Compile-time evaluation is capped so that a huge range or power inside
+# a branch which never runs cannot stall compilation.
+fold_limit = 4096
+
+def small(*values):
+  '''Whether every value is small enough to compute with when compiling.'''
+  for value in values:
+    if isinstance(value, Integral) and value.bit_length() > fold_limit:
+      return False
+    if isinstance(value, (str, list, tuple, dict)) and len(value) > fold_limit:
+      return False
+  return True
+
+def small_product(left, right):
+  '''Multiplication repeats sequences, so bound the length of the result.'''
+  for seq, times in ((left, right), (right, left)):
+    if isinstance(seq, Sequence) and isinstance(times, Number):
+      return small(seq, times) and len(seq) * abs(times) <= fold_limit
+  return small(left, right)
+
+def small_power(mantissa, exponent):
+  if not isinstance(exponent, Real):
+    return False
+  return small(mantissa) and abs(exponent) <= 64
+
+def small_shift(left, right):
+  if not isinstance(right, Integral):
+    return False
+  return small(left) and abs(right) <= fold_limit
+
+def small_range(start, stop, step=1):
+  '''Only short ranges are folded, so that what is done with them at
+  compile time is quick too.'''
+  if not all(isinstance(x, Real) for x in (start, stop, step)) or not step:
+    return False
+  return abs((stop - start) / step) <= fold_limit
+
+# Rules whose nodes are pure: given the same operands they always have the
+# same value and change nothing else. When all of a node's operands are
+# constants and its guard accepts their values, the node is evaluated once
+# at compile time. Dice, `@`, `><`, plugins and anything that reads or
+# writes variables must never appear here.
+foldable = {
+  'number_literal'      : small,
+  'string_literal'      : small,
+  'boolean_literal'     : small,
+  'undefined_literal'   : small,
+  'math_comp'           : small,
+  'obj_comp'            : small,
+  'comp_math'           : small,
+  'present'             : small,
+  'absent'              : small,
+  'logical_or'          : small,
+  'logical_xor'         : small,
+  'logical_and'         : small,
+  'logical_not'         : small,
+  'inline_if'           : small,
+  'inline_if_binary'    : small,
+  'addition'            : small,
+  'subtraction'         : small,
+  'catenation'          : small,
+  'multiplication'      : small_product,
+  'division'            : small,
+  'remainder'           : small,
+  'floor_division'      : small,
+  'left_shift'          : small_shift,
+  'right_shift'         : small_shift,
+  'negation'            : small,
+  'real_part_or_nop'    : small,
+  'exponent'            : small_power,
+  'logarithm'           : small,
+  'sum_or_join'         : small,
+  'length'              : small,
+  'minimum'             : small,
+  'maximum'             : small,
+  'flatten_or_abs'      : small,
+  'stats'               : small,
+  'sort'                : small,
+  'typeof'              : small,
+  'sliced'              : small,
+  'populated_list'      : small,
+  'empty_list'          : small,
+  'range_list'          : small_range,
+  'range_list_stepped'  : small_range,
+  'closed_list'         : small_range,
+  'closed_list_stepped' : small_range,
+  'mono_tuple'          : small,
+  'multi_tuple'         : small,
+  'empty_tuple'         : small,
+  'key_value_pair'      : small,
+  'populated_dict'      : small,
+  'empty_dict'          : small,
+}
+
+for rule in ('whole_slice', 'start_slice', 'start_step_slice',
+             'start_stop_slice', 'fine_slice', 'stop_slice',
+             'stop_step_slice', 'step_slice', 'not_a_slice'):
+  foldable[rule] = small
+
+def register(rule, handler, pure=False):
+  '''Execute nodes of the grammar rule `rule` with `handler`, which is called
+  with the visitor and the node's children. Extensions to the grammar use
+  this to teach the visitor their rules; registering an existing rule
+  replaces its handler. If `pure` is true, nodes whose operands are all
+  constants are evaluated when compiled. Only trees compiled afterwards are
+  affected.'''
+  pass_through.discard(rule)
+  handlers[rule] = handler
+  if pure:
+    foldable[rule] = small
+  else:
+    foldable.pop(rule, None)
+
+def register_pass_through(rule):
+  '''Declare that nodes of the grammar rule `rule` only wrap one other node
+  and evaluate to it.'''
+  pass_through.add(rule)
+  handlers[rule] = Visitor.handle_pass_through